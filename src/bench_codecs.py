@@ -0,0 +1,106 @@
+import os
+import tempfile
+import time
+from optparse import OptionParser
+
+import h5py
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from tile_writer import CODECS, TileWriter, format_write_stats, storage_options
+
+
+def synthetic_tiles(n_tiles, size=255, seed=0):
+    """
+        Tiles of a synthetic H&E slide: smooth pink and purple tissue with a little noise on a
+        white background, so the codecs see data about as compressible as real tiles.
+    """
+    rng = np.random.default_rng(seed)
+    tiles = np.empty((n_tiles, size, size, 3), dtype=np.uint8)
+    background = np.array([240, 238, 242], dtype=np.float32)
+    stains = np.array([[200, 110, 170], [110, 60, 150]], dtype=np.float32)
+
+    for i in range(n_tiles):
+        tissue = gaussian_filter(rng.random((size, size)), 8)
+        tissue = np.clip((tissue - tissue.mean()) / (tissue.std() + 1e-6) + rng.uniform(-1, 1), 0, 1)[..., None]
+        nuclei = gaussian_filter(rng.random((size, size)), 2)[..., None] > 0.55
+
+        tile = background * (1 - tissue) + stains[0] * tissue
+        tile = np.where(nuclei & (tissue > 0.3), stains[1], tile)
+        tile += rng.normal(0, 2, tile.shape)
+        tiles[i] = np.clip(tile, 0, 255).astype(np.uint8)
+
+    return tiles
+
+
+def bench_codec(tiles, path, codec, shuffle, chunk_size, n_reads=256, seed=0):
+    """
+        Write the tiles to a dataset with the given storage settings, then read random tiles
+        back one at a time and every tile in whole chunks, as TileLoader does.
+
+        Returns:
+            - The write stats, the compression ratio, and the random and chunk reads per second
+    """
+    size = tiles.shape[1:]
+    with h5py.File(path, "w") as h5_file:
+        storage = h5_file.create_dataset("images", shape=(0,) + size, maxshape=(None,) + size,
+                                         chunks=(chunk_size,) + size, dtype=np.uint8,
+                                         **storage_options(codec, shuffle=shuffle))
+        writer = TileWriter(storage, None)
+        for tile in tiles:
+            writer.add(tile, None)
+        writer.close()
+
+        h5_file.flush()
+        ratio = tiles.nbytes / max(storage.id.get_storage_size(), 1)
+
+    indices = np.random.default_rng(seed).integers(0, len(tiles), n_reads)
+    with h5py.File(path, "r") as h5_file:
+        storage = h5_file["images"]
+        start = time.perf_counter()
+        for index in indices:
+            storage[index]
+        read_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for block in range(0, len(tiles), chunk_size):
+            storage[block:block + chunk_size]
+        chunk_time = time.perf_counter() - start
+
+    return writer.stats(), ratio, n_reads / read_time, len(tiles) / chunk_time
+
+
+def bench_codecs(codecs, chunk_sizes, n_tiles=512, size=255, n_reads=256):
+    tiles = synthetic_tiles(n_tiles, size)
+    print(f"Tiles: {n_tiles} ({tiles.nbytes / 1e6:.1f} MB)")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        path = os.path.join(output_dir, "tiles.h5")
+        for codec in codecs:
+            try:
+                storage_options(codec)
+            except ImportError as error:
+                print(f"{codec:<14} skipped: {error}")
+                continue
+
+            for shuffle in ((False,) if codec == "none" else (False, True)):
+                for chunk_size in chunk_sizes:
+                    write_stats, ratio, reads, chunk_reads = bench_codec(tiles, path, codec, shuffle, chunk_size, n_reads)
+                    name = f"{codec}{'+shuffle' if shuffle else ''}"
+                    print(f"{name:<14} chunk {chunk_size:>3} | ratio {ratio:5.2f} | "
+                          f"write {format_write_stats(write_stats)} | random reads {reads:.0f} tiles/s | "
+                          f"chunk reads {chunk_reads:.0f} tiles/s")
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-n', '--n_tiles', dest='n_tiles', type='int', default=512, help='Number of synthetic tiles written, default=512')
+    parser.add_option('-s', '--size', dest='tile_size', type='int', default=255, help='tile size, default=255')
+    parser.add_option('-c', '--chunk_sizes', dest='chunk_sizes', type='string', default='1,8,32', help='Comma separated numbers of tiles per HDF5 chunk, default=1,8,32')
+    parser.add_option('--codecs', dest='codecs', type='string', default=','.join(CODECS), help=f'Comma separated codecs, default={",".join(CODECS)}')
+    parser.add_option('-r', '--n_reads', dest='n_reads', type='int', default=256, help='Number of random single tile reads, default=256')
+
+    (opts, args) = parser.parse_args()
+
+    bench_codecs(opts.codecs.split(','), [int(c) for c in opts.chunk_sizes.split(',')], opts.n_tiles,
+                 opts.tile_size, opts.n_reads)
@@ -0,0 +1,71 @@
+import tempfile
+import time
+import warnings
+from optparse import OptionParser
+
+import numpy as np
+
+from tile_export import MemmapTiles, export_memmap, export_tar, iter_tar_batches
+from tile_loader import TileIndex, TileLoader
+from tile_writer import format_write_stats
+
+
+def time_batches(batches):
+    """
+        Returns:
+            - The stats of reading every batch of an iterator
+    """
+    stats = {"tiles": 0, "bytes": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    for batch in batches:
+        stats["tiles"] += len(batch["images"])
+        stats["bytes"] += batch["images"].nbytes
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def random_tile_batches(index, batch_size=64, n_tiles=1024, seed=0):
+    """
+        Batches of tiles read from the HDF5 files one at a time in a random order, as a dataset
+        indexing the set files per tile does.
+    """
+    order = np.random.default_rng(seed).permutation(len(index))[:n_tiles]
+    for start in range(0, len(order), batch_size):
+        yield {"images": np.stack([index.read([i])[0] for i in order[start:start + batch_size]])}
+
+
+def bench_export(set_paths, batch_size=64, shard_size=1000, n_random=1024, seed=0):
+    index = TileIndex(set_paths)
+    print(f"Tiles: {len(index)}")
+
+    with tempfile.TemporaryDirectory() as memmap_dir, tempfile.TemporaryDirectory() as tar_dir:
+        print(f"memmap export: {format_write_stats(export_memmap(index, memmap_dir))}")
+        print(f"tar export:    {format_write_stats(export_tar(index, tar_dir, shard_size, seed=seed))}")
+
+        results = [
+            ("HDF5 random tiles", time_batches(random_tile_batches(index, batch_size, n_random, seed))),
+            ("HDF5 TileLoader", time_batches(TileLoader(index, batch_size, seed=seed))),
+            ("memmap", time_batches(MemmapTiles(memmap_dir).iter_batches(batch_size, seed=seed))),
+            ("tar shards", time_batches(iter_tar_batches(tar_dir, batch_size, seed=seed)))
+        ]
+
+    index.close()
+    for name, stats in results:
+        print(f"{name:<18} | {format_write_stats(stats)}")
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog <set_file> [<set_file> ...] [options]')
+    parser.add_option('-b', '--batch_size', dest='batch_size', type='int', default=64, help='Number of tiles per batch, default=64')
+    parser.add_option('--shard_size', dest='shard_size', type='int', default=1000, help='Number of tiles per tar shard, default=1000')
+    parser.add_option('-r', '--n_random', dest='n_random', type='int', default=1024, help='Number of tiles read one at a time from the HDF5 files, default=1024')
+    parser.add_option('--seed', dest='seed', type='int', default=0, help='Seed of the shuffles, default=0')
+
+    (opts, args) = parser.parse_args()
+
+    if len(args) == 0:
+        parser.error('Missing set file argument.')
+
+    # PyTables warns about the object columns of the label table
+    warnings.simplefilter("ignore")
+    bench_export(args, opts.batch_size, opts.shard_size, opts.n_random, opts.seed)
@@ -0,0 +1,99 @@
+import time
+from optparse import OptionParser
+
+import numpy as np
+from openslide import open_slide
+from openslide.deepzoom import DeepZoomGenerator
+
+from tile import Tile
+from tissue_filter import TissueFilter, format_filter_stats
+
+
+def read_tiles(slide_loc, size=255, n_tiles=256):
+    """
+        Read up to n_tiles full size tiles from the highest zoom level of a slide.
+    """
+    dz = DeepZoomGenerator(open_slide(slide_loc), size, 0)
+    level = dz.level_count - 1
+    cols, rows = dz.level_tiles[level]
+
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            tile = np.array(dz.get_tile(level, (col, row)))
+            if tile.shape == (size, size, 3):
+                tiles.append(tile)
+            if len(tiles) == n_tiles:
+                return np.stack(tiles)
+
+    return np.stack(tiles)
+
+
+def membrane_tiles(size=255, seed=0):
+    """
+        Tiles of thin tissue membranes on glass: grids of 1 px lines every 24 px and 2 px lines
+        every 48 px, at every offset from the stride 4 grid of the glass stage subsample, and the
+        same grids with most of their lines removed. Tile._keep_tile fills the holes of the full
+        grids, so any stage which only looks at the subsample would reject tiles it keeps.
+    """
+    rng = np.random.default_rng(seed)
+    background = np.array([240, 238, 242], dtype=np.float32)
+    membrane = np.array([190, 110, 170], dtype=np.float32)
+
+    tiles = []
+    for spacing, width in ((24, 1), (48, 2)):
+        for offset in range(1, 4):
+            lines = (np.arange(size) % spacing >= offset) & (np.arange(size) % spacing < offset + width)
+            for keep in (1.0, 0.3):
+                rows = lines & (rng.random(size) < keep)
+                cols = lines & (rng.random(size) < keep)
+                mask = (rows[:, None] | cols[None, :])[..., None]
+                tile = np.where(mask, membrane, background) + rng.normal(0, 2, (size, size, 3))
+                tiles.append(np.clip(tile, 0, 255).astype(np.uint8))
+
+    return np.stack(tiles)
+
+
+def bench_filter(tiles, background=0.2, batch_size=32):
+    """
+        Compare Tile._keep_tile and TissueFilter on the same tiles.
+    """
+    size = tiles.shape[1]
+    tissue_threshold = 1 - background
+
+    start = time.perf_counter()
+    reference = np.array([Tile._keep_tile(None, tile, size, tissue_threshold) for tile in tiles])
+    reference_time = time.perf_counter() - start
+
+    print(f"Tiles: {len(tiles)} | kept: {reference.sum()}")
+    print(f"_keep_tile:            {len(tiles) / reference_time:.1f} tiles/s")
+
+    for name, tissue_filter in [("TissueFilter:", TissueFilter(tissue_threshold, cascade=False)),
+                                ("TissueFilter cascade:", TissueFilter(tissue_threshold))]:
+        start = time.perf_counter()
+        batched = np.concatenate([tissue_filter.filter(tiles[i:i+batch_size])[0] for i in range(0, len(tiles), batch_size)])
+        batched_time = time.perf_counter() - start
+
+        print(f"{name:<22} {len(tiles) / batched_time:.1f} tiles/s | decisions equal: {np.array_equal(reference, batched)}")
+
+    print(f"Cascade stages | {format_filter_stats(tissue_filter.stats)}")
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog [<slide>] [options]')
+    parser.add_option('-n', '--n_tiles', dest='n_tiles', type='int', default=256, help='Number of tiles to filter, default=256')
+    parser.add_option('-b', '--background', dest='background', type='float', default=0.2, help='Percentage of background allowed, default=0.2')
+    parser.add_option('--batch_size', dest='batch_size', type='int', default=32, help='Number of tiles filtered together, default=32')
+    parser.add_option('--membranes', dest='membranes', action="store_true", help='Filter synthetic tiles of thin tissue membranes instead of a slide, default=False')
+
+    (opts, args) = parser.parse_args()
+
+    if opts.membranes:
+        bench_filter(membrane_tiles(), opts.background, opts.batch_size)
+    else:
+        try:
+            slide_path = args[0]
+        except IndexError:
+            parser.error('Missing slide argument')
+
+        bench_filter(read_tiles(slide_path, n_tiles=opts.n_tiles), opts.background, opts.batch_size)
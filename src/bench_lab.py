@@ -0,0 +1,103 @@
+import time
+import warnings
+from optparse import OptionParser
+
+import numpy as np
+
+from bench_filter import read_tiles
+from lab_convert import BACKENDS, lab_converter
+from normalize import Normalizer
+
+
+def normalize_block(normalizer, tiles):
+    """
+        Normalize an (N, H, W, 3) stack of tiles with one colour conversion per direction for the
+        whole block, the per tile LAB statistics reduced along axis 1 of an (N, H * W, 3) view.
+        Benchmarked against Normalizer.normalize_tiles, which converts tile by tile.
+    """
+    mu, sig = normalizer.freeze()
+    converter = lab_converter(normalizer.backend)
+    lab = converter.rgb2lab(tiles)
+
+    flat = lab.reshape(len(tiles), -1, 3)
+    t_mean = flat.mean(axis=1, keepdims=True)
+    t_std = flat.std(axis=1, keepdims=True)
+    flat = (flat - t_mean) * (sig / t_std) + mu
+    np.clip(flat[..., 0], 0, 100, out=flat[..., 0])
+    np.clip(flat[..., 1:], -127, 127, out=flat[..., 1:])
+
+    return converter.lab2rgb(flat.reshape(lab.shape).astype(lab.dtype))
+
+
+def bench_lab(tiles, backends=BACKENDS):
+    """
+        Compare the speed of each LAB backend and its largest deviation from skimage on the same
+        tiles: the LAB values of rgb2lab and the uint8 output of Normalizer.normalize_tile. The
+        tile by tile Normalizer.normalize_tiles is also timed against normalize_block.
+    """
+    reference = Normalizer(backend="skimage")
+    for tile in tiles:
+        reference.fit_tile(tile)
+    target = reference.freeze()
+
+    skimage_lab = lab_converter("skimage")
+    lab = [skimage_lab.rgb2lab(tile) for tile in tiles]
+    normalized = [reference.normalize_tile(tile) for tile in tiles]
+
+    print(f"Tiles: {len(tiles)}")
+    for backend in backends:
+        converter = lab_converter(backend)
+        normalizer = Normalizer(backend=backend)
+        normalizer.stats = reference.stats
+        normalizer.target = target
+
+        start = time.perf_counter()
+        backend_lab = [converter.rgb2lab(tile) for tile in tiles]
+        rgb2lab_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        backend_rgb = [converter.lab2rgb(tile_lab) for tile_lab in lab]
+        lab2rgb_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        backend_normalized = [normalizer.normalize_tile(tile) for tile in tiles]
+        normalize_time = time.perf_counter() - start
+
+        block = np.stack(tiles)
+        start = time.perf_counter()
+        by_tile = normalizer.normalize_tiles(block)
+        by_tile_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        by_block = normalize_block(normalizer, block)
+        by_block_time = time.perf_counter() - start
+
+        lab_error = max(np.abs(a - b).max() for a, b in zip(backend_lab, lab))
+        rgb_error = max(np.abs(a.astype(int) - b).max() for a, b in zip(backend_rgb, tiles))
+        normalize_error = max(np.abs(a.astype(int) - b).max() for a, b in zip(backend_normalized, normalized))
+        normalize_changed = np.mean([np.mean(a != b) for a, b in zip(backend_normalized, normalized)])
+
+        print(f"{backend:<9} rgb2lab: {len(tiles) / rgb2lab_time:6.1f} tiles/s, max LAB error {lab_error:.2e} | "
+              f"lab2rgb: {len(tiles) / lab2rgb_time:6.1f} tiles/s, max round trip error {rgb_error} | "
+              f"normalize_tile: {len(tiles) / normalize_time:6.1f} tiles/s, max error {normalize_error}, "
+              f"{100 * normalize_changed:.2f}% of values changed")
+        print(f"{'':<9} normalize_tiles: {len(tiles) / by_tile_time:6.1f} tiles/s | "
+              f"whole block: {len(tiles) / by_block_time:6.1f} tiles/s, "
+              f"{100 * np.mean(by_tile != by_block):.2f}% of values changed")
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog <slide> [options]')
+    parser.add_option('-n', '--n_tiles', dest='n_tiles', type='int', default=64, help='Number of tiles to convert, default=64')
+    parser.add_option('-s', '--size', dest='tile_size', type='int', default=255, help='tile size, default=255')
+
+    (opts, args) = parser.parse_args()
+
+    try:
+        slide_path = args[0]
+    except IndexError:
+        parser.error('Missing slide argument')
+
+    # skimage warns about out of gamut colours on every normalized tile
+    warnings.simplefilter("ignore")
+    bench_lab(read_tiles(slide_path, opts.tile_size, opts.n_tiles))
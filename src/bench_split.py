@@ -0,0 +1,101 @@
+import os
+import tempfile
+import time
+import warnings
+from optparse import OptionParser
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from get_set_data import split_dataset
+
+
+def synthetic_cohort(n_cases, n_projects=4, n_symbols=200, seed=0):
+    """
+        A cohort in the format of get_projects_info, with one or two slides per case, one sample
+        per slide, 65 signatures and a sparse hugo symbol matrix.
+    """
+    rng = np.random.default_rng(seed)
+    data_dict = {f"TCGA-P{p}": {} for p in range(n_projects)}
+    case_to_images = {}
+    image_to_sample = {}
+    samples = []
+
+    for i in range(n_cases):
+        case = f"TCGA-{i % n_projects:02d}-{i:06d}"
+        project = f"TCGA-P{i % n_projects}"
+        images = []
+        for j in range(1 + i % 2):
+            sample = f"{case}-0{j + 1}A"
+            image = f"{sample}-01-TS1.{i:08x}.svs"
+            images.append(image)
+            image_to_sample[image] = sample
+            samples.append({"case_barcode": case, "project": project, "sample.barcode": sample,
+                            "demographic.age": int(rng.integers(20, 90))})
+
+        case_to_images[case] = images
+        data_dict[project][case] = {"demographic": {}, "samples": [], "case_id": case, "hugo_symbols": [],
+                                    "mutational_signature": []}
+
+    cases = list(case_to_images.keys())
+    signatures = pd.DataFrame(rng.poisson(1, (n_cases, 65)).astype(np.float32), columns=[f"SBS{k}" for k in range(65)])
+    signatures["case_id"] = cases
+
+    counts = sparse.random(n_cases, n_symbols, density=0.05, format="coo", random_state=seed,
+                           data_rvs=lambda n: rng.integers(1, 5, n))
+    hugos = pd.DataFrame.sparse.from_spmatrix(counts.astype(np.int64), columns=[f"GENE{k}" for k in range(n_symbols)])
+    hugos["case_barcode"] = cases
+
+    return {"data dict": data_dict, "image to sample": image_to_sample, "case to images": case_to_images,
+            "labels": pd.DataFrame.from_records(samples), "mutational signatures": signatures,
+            "hugo symbols": hugos}, cases
+
+
+def quadratic_case_to_images(case_set, data):
+    """
+        The case to images lookup of the earlier get_case_to_images, which split_to_sets ran
+        three times per set.
+    """
+    set_case_to_images = {}
+    for case in case_set:
+        for key, value in data["case to images"].items():
+            if case == key:
+                set_case_to_images[key] = value
+    return set_case_to_images
+
+
+def bench_split(sizes, max_reference=5000):
+    for n_cases in sizes:
+        data, cases = synthetic_cohort(n_cases)
+        case_sets = [cases[:int(0.8 * n_cases)], cases[int(0.8 * n_cases):int(0.9 * n_cases)], cases[int(0.9 * n_cases):]]
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            paths = [os.path.join(output_dir, f"{name}.h5") for name in ("train", "val", "test")]
+            start = time.perf_counter()
+            sets = split_dataset(case_sets, data, paths)
+            split_time = time.perf_counter() - start
+
+        n_labels = sum(len(split["labels"]) for split in sets)
+        line = f"{n_cases:>6} cases | split_dataset: {split_time:6.2f}s, {n_labels} labels"
+
+        if n_cases <= max_reference:
+            start = time.perf_counter()
+            for case_set in case_sets:
+                for _ in range(3):
+                    quadratic_case_to_images(case_set, data)
+            line += f" | earlier case to images lookups alone: {time.perf_counter() - start:6.2f}s"
+
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-n', '--n_cases', dest='n_cases', type='string', default='1000,2500,5000,10000', help='Comma separated cohort sizes, default=1000,2500,5000,10000')
+    parser.add_option('--max_reference', dest='max_reference', type='int', default=5000, help='Largest cohort the earlier quadratic lookup is timed on, default=5000')
+
+    (opts, args) = parser.parse_args()
+
+    # PyTables warns about the object columns of the label table
+    warnings.simplefilter("ignore")
+    bench_split([int(n) for n in opts.n_cases.split(',')], opts.max_reference)
@@ -1,16 +1,65 @@
+import contextlib
 import os
 from optparse import OptionParser
 import numpy as np
 from random import shuffle
 import h5py
+import shutil
 
 from tile import Tile
 from normalize import Normalizer
 from labeling_util import *
-from get_set_data import split_to_sets, load_set_data
+from get_set_data import split_dataset, load_set_data
+from tile_writer import CODECS, merge_write_stats, format_write_stats
+from parallel_tile import tile_slides
+from tissue_filter import merge_filter_stats, format_filter_stats
+from download_manager import GDC_API, DownloadManager, format_download_stats
+from gdc_client import GDCClient, format_gdc_stats
+from shard_store import SHARD_DIR, split_shard_dir, shard_path, open_shard, stitch_shards
 
-def build_dataset(slide_dir, output_dir, projects, background=0.2, size=255, reject_rate=0.1, ignore_repeat=False):
+def slide_name(slide_loc):
+    """
+        Returns:
+            - The name of a slide without its folder and extension, as its group is named
+    """
+    return ".".join(os.path.basename(slide_loc).split(".")[:-1])
+
+
+def fit_sample(slide_locs, normalizer, tile_kwargs, seed=None):
+    """
+        Fit a sampling normalizer before any tile is written. The rows of every level of every
+        slide are visited in a random order until the reservoir of that slide and level is full,
+        so only a small part of each slide is read.
+    """
+    rng = np.random.default_rng(seed)
+    for slide_loc in slide_locs:
+        tile = Tile(slide_loc, None, **tile_kwargs)
+        tissue_mask = tile.tissue_mask()
+
+        print(f"\rFitting normalizer on {tile.file_name}", end="")
+        for level, _, _, rows in tile.levels():
+            stratum = (tile.file_name, level)
+            for row in rng.permutation(rows):
+                for keep, array, _ in tile.iter_tiles(level, row, row + 1, tissue_mask):
+                    if keep:
+                        normalizer.fit_tile(array, stratum)
+                if normalizer.reservoir.sampled(stratum) == normalizer.sample_size:
+                    break
+
+    normalizer.freeze()
+    print(f"\rFitted normalizer on {normalizer.stats.tiles} sampled tiles")
+    return normalizer
+
+
+def build_dataset(slide_dir, output_dir, projects, background=0.2, size=255, reject_rate=0.1, ignore_repeat=False,
+                  chunk_size=32, buffer_size=256, use_mask=True, workers=1, ordered=False, seed=None,
+                  glass_fraction=0.05, normalize_on_write=False, stats_path=None, sample_size=None, keep_raw=False,
+                  lab_backend="skimage", pyramid=False, magnifications=None, region_cols=16, region_rows=1,
+                  slide_cache=None, downloads=4, cache_size=None, eviction="lru", gdc_api=GDC_API,
+                  gdc_cache=None, cache_ttl=7 * 24 * 3600, offline=False, codec="none", codec_level=None,
+                  byte_shuffle=False, sharded=False, fit_slides=16):
     proceed = None
+    stats_file = os.path.join(output_dir, "normalizer.json")
     train_path = os.path.join(output_dir, "train.h5")
     val_path = os.path.join(output_dir, "val.h5")
     test_path = os.path.join(output_dir, "test.h5")
@@ -29,6 +78,8 @@ def build_dataset(slide_dir, output_dir, projects, background=0.2, size=255, rej
                 os.remove(train_path)
                 os.remove(val_path)
                 os.remove(test_path)
+                if os.path.isdir(os.path.join(output_dir, SHARD_DIR)):
+                    shutil.rmtree(os.path.join(output_dir, SHARD_DIR))
 
     if proceed == "C":
         train_data = load_set_data(train_path)
@@ -41,11 +92,11 @@ def build_dataset(slide_dir, output_dir, projects, background=0.2, size=255, rej
     elif proceed == "R" or proceed == None:
         if projects is None:
             raise ValueError("Missing list of projects to download.")
-        data = get_projects_info(projects)
-
-        train_h5 = h5py.File(train_path, 'a')
-        val_h5 = h5py.File(val_path, 'a')
-        test_h5 = h5py.File(test_path, 'a')
+        # Responses are cached so repeated builds start without querying the GDC again
+        client = GDCClient(gdc_api, gdc_cache or os.path.join(output_dir, "gdc_cache"), cache_ttl, offline)
+        data = get_projects_info(projects, client)
+        client.close()
+        print(f"GDC queries: {format_gdc_stats(client.stats)}")
 
         all_cases = list(data['case to images'].keys())
         shuffle(all_cases)
@@ -60,15 +111,19 @@ def build_dataset(slide_dir, output_dir, projects, background=0.2, size=255, rej
         val_set = all_cases[:val_len]
         test_set = all_cases[val_len:]
 
-        train_data = split_to_sets(train_set, data, train_path)
-        val_data = split_to_sets(val_set, data, val_path)
-        test_data = split_to_sets(test_set, data, test_path)
+        train_data, val_data, test_data = split_dataset([train_set, val_set, test_set], data,
+                                                        [train_path, val_path, test_path])
+
+        # The set files are only opened once the split is saved, as pandas writes the tables itself
+        train_h5 = h5py.File(train_path, 'a')
+        val_h5 = h5py.File(val_path, 'a')
+        test_h5 = h5py.File(test_path, 'a')
 
     if proceed != "Q":
         dataset = [
-            (list(train_data["image to sample"].keys()), train_h5),
-            (list(val_data["image to sample"].keys()), val_h5),
-            (list(test_data["image to sample"].keys()), test_h5)
+            (list(train_data["image to sample"].keys()), train_h5, split_shard_dir(output_dir, "train")),
+            (list(val_data["image to sample"].keys()), val_h5, split_shard_dir(output_dir, "val")),
+            (list(test_data["image to sample"].keys()), test_h5, split_shard_dir(output_dir, "test"))
         ]
 
         # train_images = ["TCGA-44-7671-01A-01-BS1.914604a2-de9c-404d-9fa5-23fbd0b76da3.svs"]
@@ -85,31 +140,118 @@ def build_dataset(slide_dir, output_dir, projects, background=0.2, size=255, rej
         #     (test_images, test_h5)
         # ]
 
-        normalizer = Normalizer()
-        for images, h5_file in dataset:
+        write_stats = merge_write_stats()
+        filter_stats = merge_filter_stats()
+        tile_kwargs = {
+            "background": background,
+            "size": size,
+            "reject_rate": reject_rate,
+            "chunk_size": chunk_size,
+            "buffer_size": buffer_size,
+            "use_mask": use_mask,
+            "seed": seed,
+            "glass_fraction": glass_fraction,
+            "pyramid": pyramid,
+            "magnifications": magnifications,
+            "region_cols": region_cols,
+            "region_rows": region_rows,
+            "slide_cache": slide_cache,
+            "codec": codec,
+            "codec_level": codec_level,
+            "byte_shuffle": byte_shuffle
+        }
+
+        # A resumed build reuses the statistics the earlier tiles were normalized with
+        if stats_path is None and proceed == "C" and os.path.isfile(stats_file):
+            stats_path = stats_file
+
+        # Slides download in the background while the earlier ones are tiled
+        manager = DownloadManager(slide_dir, workers=downloads, api=gdc_api, max_bytes=cache_size, eviction=eviction,
+                                  offline=offline)
+
+        if stats_path is not None:
+            # Loaded statistics are used as they are instead of being fit again
+            normalizer = Normalizer.load(stats_path, lab_backend)
+        elif normalize_on_write:
+            normalizer = Normalizer(sample_size or 64, seed, lab_backend)
+            # The normalizer is fit on a random subset of the training slides, which are tiled
+            # first so they are still on disk when their tiles are written
+            train_images = dataset[0][0]
+            order = np.random.default_rng(seed).permutation(len(train_images))
+            fit_images = [train_images[i] for i in order[:fit_slides or len(train_images)]]
+            fit_sample(manager.prefetch(fit_images, done=False), normalizer, tile_kwargs, seed)
+            fit_set = set(fit_images)
+            dataset[0] = (fit_images + [filename for filename in train_images if filename not in fit_set],) + dataset[0][1:]
+        else:
+            normalizer = Normalizer(sample_size, seed, lab_backend)
+
+        # Tiles only fit the normalizer in the two pass mode when no statistics were loaded
+        tile_normalizer = normalizer if normalize_on_write or stats_path is None else None
+        if normalize_on_write:
+            tile_kwargs["normalize_on_write"] = True
+            tile_kwargs["keep_raw"] = keep_raw
+            normalizer.save(stats_file)
+
+        for images, h5_file, set_shard_dir in dataset:
             image_h5_file = h5_file.require_group("images")
+            if sharded:
+                # Resumed builds only tile the slides without a completed shard
+                images = [filename for filename in images
+                          if proceed != "C" or not os.path.isfile(shard_path(set_shard_dir, slide_name(filename)))]
+            else:
+                images = [filename for filename in images
+                          if proceed != "C" or slide_name(filename) not in image_h5_file]
+
+            if workers > 1:
+                # A single pool tiles the whole set, taking each slide as soon as it is downloaded.
+                # Slides stay pinned until the pool has written them.
+                slides = ((slide_loc, open_shard(set_shard_dir, slide_name(slide_loc)) if sharded else image_h5_file)
+                          for slide_loc in manager.prefetch(images, release=False))
+                set_write_stats, set_filter_stats = tile_slides(slides, workers=workers, normalizer=tile_normalizer,
+                                                                ignore_repeat=ignore_repeat, ordered=ordered,
+                                                                on_slide_done=lambda slide_loc: manager.release(os.path.basename(slide_loc)),
+                                                                **tile_kwargs)
+                write_stats = merge_write_stats(write_stats, set_write_stats)
+                filter_stats = merge_filter_stats(filter_stats, set_filter_stats)
+            else:
+                for slide_loc in manager.prefetch(images):
+                    # Each slide is written to its own shard file, or to the set file
+                    if sharded:
+                        slide_file = open_shard(set_shard_dir, slide_name(slide_loc))
+                    else:
+                        slide_file = contextlib.nullcontext(image_h5_file)
 
-            for filename in images:
-                if proceed != "C" or ".".join(filename.split(".")[:-1]) not in image_h5_file:
-                    download_image(filename, slide_dir)
-                    
-                    Tile(
-                        slide_loc=os.path.join(slide_dir, filename),
-                        set_hdf5_file=image_h5_file,
-                        normalizer=normalizer,
-                        background=background,
-                        size=size,
-                        reject_rate=reject_rate,
-                        ignore_repeat=ignore_repeat
-                    )
-            
+                    with slide_file as slide_h5_file:
+                        tile = Tile(
+                            slide_loc=slide_loc,
+                            set_hdf5_file=slide_h5_file,
+                            normalizer=tile_normalizer,
+                            ignore_repeat=ignore_repeat,
+                            **tile_kwargs
+                        )
+
+                    write_stats = merge_write_stats(write_stats, tile.write_stats)
+                    filter_stats = merge_filter_stats(filter_stats, tile.filter_stats)
+
+            if sharded:
+                stitch_shards(h5_file, set_shard_dir, ("images", "raw_images") if keep_raw else ("images",))
             h5_file.close()
-            
-        normalizer.normalize_dir(output_dir)
+
+        manager.close()
+        print(f"Downloads: {format_download_stats(manager.stats)}")
+        print(f"Tile writes: {format_write_stats(write_stats)}")
+        print(f"Filter stages: {format_filter_stats(filter_stats)}")
+
+        if not normalize_on_write:
+            normalizer.normalize_dir(output_dir, workers=workers)
+            normalizer.save(stats_file)
 
 def list_callback(option, opt, value, parser):
   setattr(parser.values, option.dest, value.split(','))
 
+def float_list_callback(option, opt, value, parser):
+  setattr(parser.values, option.dest, [float(x) for x in value.split(',')])
+
 if __name__ == "__main__":
     parser = OptionParser(usage='Usage: %prog <slide_folder> <output_folder> -p <projects> [options]')
     parser.add_option('-p', '--projects', dest="projects", type='string', action='callback', help="List of TCGA cases e.g. TCGA-LUAD,TCGA-BRCA", callback=list_callback)
@@ -117,6 +259,36 @@ if __name__ == "__main__":
     parser.add_option('-s', '--size', dest='tile_size', type='int', default=255, help='tile size, defualt=255')
     parser.add_option('-r', '--reject', dest='reject', type='float', default=0.1, help='Precentage of rejected background tiles to save, defualt=0.1')
     parser.add_option('-i', '--ignore_repeat', dest='ignore_repeat', action="store_true", help='Automatically overwrte repeated files in the dataset, defualt=False')
+    parser.add_option('-c', '--chunk_size', dest='chunk_size', type='int', default=32, help='Number of tiles per HDF5 chunk, default=32')
+    parser.add_option('--codec', dest='codec', type='choice', choices=list(CODECS), default='none', help='Compression of the tile datasets: none, gzip, lzf, blosc or lz4 (blosc and lz4 need hdf5plugin), default=none')
+    parser.add_option('--codec_level', dest='codec_level', type='int', default=None, help='Compression level of gzip or blosc, default=the codec\'s own')
+    parser.add_option('--byte_shuffle', dest='byte_shuffle', action="store_true", default=False, help='Apply the byte shuffle filter before compressing the tile datasets, default=False')
+    parser.add_option('--sharded', dest='sharded', action="store_true", help='Write every slide to its own file under <output_folder>/shards, linked into the set files, default=False')
+    parser.add_option('--buffer_size', dest='buffer_size', type='int', default=256, help='Number of tiles buffered before each write, default=256')
+    parser.add_option('--no_mask', dest='use_mask', action="store_false", default=True, help='Read every tile instead of skipping tiles outside the thumbnail tissue mask')
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=1, help='Number of tiling and normalization processes, default=1')
+    parser.add_option('--ordered', dest='ordered', action="store_true", help='Write tiles in the same order as a serial run when using several workers, default=False')
+    parser.add_option('-g', '--glass_fraction', dest='glass_fraction', type='float', default=0.05, help='Fraction of dark pixels below which the cheap first filter stage checks a tile against an upper bound of the tissue check, rejecting it as glass only if the bound fails, 0 disables the stage, default=0.05')
+    parser.add_option('--seed', dest='seed', type='int', default=None, help='Seed for sampling rejected tiles so runs save the same tiles, default=None')
+    parser.add_option('--normalize_on_write', dest='normalize_on_write', action="store_true", help='Write tiles already normalized instead of normalizing the dataset in a second pass, default=False')
+    parser.add_option('--stats', dest='stats_path', type='string', default=None, help='Normalizer statistics file saved by an earlier build, default=fit on a sample of the training slides')
+    parser.add_option('-n', '--sample_size', dest='sample_size', type='int', default=None, help='Fit the normalizer on a random sample of this many tiles per slide and magnification, default=every tile, or 64 with --normalize_on_write')
+    parser.add_option('--fit_slides', dest='fit_slides', type='int', default=16, help='Number of random training slides the normalizer is fit on with --normalize_on_write, 0 uses every training slide, default=16')
+    parser.add_option('--keep_raw', dest='keep_raw', action="store_true", help='Also keep the unnormalized tiles in raw_images with --normalize_on_write, default=False')
+
+    parser.add_option('--lab_backend', dest='lab_backend', type='choice', choices=['skimage', 'fast'], default='skimage', help='RGB/LAB conversion backend of the normalizer: skimage or fast, default=skimage')
+    parser.add_option('--pyramid', dest='pyramid', action="store_true", help='Only read the highest saved magnification and build the lower ones by 2x2 downsampling, default=False')
+    parser.add_option('-m', '--magnifications', dest='magnifications', type='string', action='callback', callback=float_list_callback, help='Magnifications to save e.g. 20,10,5, default=every level')
+    parser.add_option('--region_cols', dest='region_cols', type='int', default=16, help='Number of tile columns read from the slide in a single region, 0 reads tile by tile, default=16')
+    parser.add_option('--region_rows', dest='region_rows', type='int', default=1, help='Number of tile rows read from the slide in a single region, default=1')
+    parser.add_option('--slide_cache', dest='slide_cache', type='int', default=None, help='Size of the OpenSlide tile cache in MB, default=OpenSlide\'s default')
+    parser.add_option('-d', '--downloads', dest='downloads', type='int', default=4, help='Number of slides downloaded at once while tiling, default=4')
+    parser.add_option('--cache_size', dest='cache_size', type='float', default=None, help='Disk budget of the slides in the slide folder in GB, default=keep every slide')
+    parser.add_option('--eviction', dest='eviction', type='choice', choices=['lru', 'tiled'], default='lru', help='Slide eviction policy: lru only evicts the least recently used slides to stay within --cache_size, tiled also deletes every slide once it is tiled, default=lru')
+    parser.add_option('--gdc_api', dest='gdc_api', type='string', default=GDC_API, help=f'GDC API endpoint, default={GDC_API}')
+    parser.add_option('--gdc_cache', dest='gdc_cache', type='string', default=None, help='Directory GDC responses are cached in, default=<output_folder>/gdc_cache')
+    parser.add_option('--cache_ttl', dest='cache_ttl', type='float', default=168, help='Hours cached GDC responses are used for, default=168')
+    parser.add_option('--offline', dest='offline', action="store_true", help='Only use cached GDC responses and slides already in the slide folder, default=False')
 
     (opts, args) = parser.parse_args()
 
@@ -140,5 +312,34 @@ if __name__ == "__main__":
         background=opts.background,
         size=opts.tile_size,
         reject_rate=opts.reject,
-        ignore_repeat=opts.ignore_repeat
+        ignore_repeat=opts.ignore_repeat,
+        chunk_size=opts.chunk_size,
+        buffer_size=opts.buffer_size,
+        use_mask=opts.use_mask,
+        workers=opts.workers,
+        ordered=opts.ordered,
+        seed=opts.seed,
+        glass_fraction=opts.glass_fraction,
+        normalize_on_write=opts.normalize_on_write,
+        stats_path=opts.stats_path,
+        sample_size=opts.sample_size,
+        keep_raw=opts.keep_raw,
+        lab_backend=opts.lab_backend,
+        pyramid=opts.pyramid,
+        magnifications=opts.magnifications,
+        region_cols=opts.region_cols,
+        region_rows=opts.region_rows,
+        slide_cache=None if opts.slide_cache is None else opts.slide_cache << 20,
+        downloads=opts.downloads,
+        cache_size=None if opts.cache_size is None else int(opts.cache_size * 1e9),
+        eviction=opts.eviction,
+        gdc_api=opts.gdc_api,
+        gdc_cache=opts.gdc_cache,
+        cache_ttl=opts.cache_ttl * 3600,
+        offline=opts.offline,
+        codec=opts.codec,
+        codec_level=opts.codec_level,
+        byte_shuffle=opts.byte_shuffle,
+        sharded=opts.sharded,
+        fit_slides=opts.fit_slides
     )
\ No newline at end of file
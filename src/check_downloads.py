@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+
+import numpy as np
+
+from download_manager import DownloadManager, md5_file, stream_download
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+        A local stand-in for the /files and /data endpoints of the GDC API. Files are served with
+        HTTP Range support, and the first transfer of every file in server.cut, or every transfer
+        of the files in server.fail, is cut off a third of the way through, as a dropped
+        connection would.
+    """
+
+    def log_message(self, *args):
+        pass
+
+
+    def _send_json(self, item):
+        body = json.dumps(item).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        files = self.server.files
+
+        if url.path == "/files":
+            query = urllib.parse.parse_qs(url.query)
+            file_name = json.loads(query["filters"][0])["content"]["value"]
+            hits = [{"file_id": file_id, "file_size": len(data), "md5sum": hashlib.md5(data).hexdigest()}
+                    for file_id, (name, data) in files.items() if name == file_name]
+            return self._send_json({"data": {"hits": hits}})
+
+        file_id = url.path[len("/data/"):]
+        if not url.path.startswith("/data/") or file_id not in files:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        data = files[file_id][1]
+        byte_range = self.headers.get("Range")
+        self.server.ranges.append((file_id, byte_range))
+
+        start = 0
+        if byte_range is not None:
+            start = int(re.match(r"bytes=(\d+)-", byte_range).group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+
+        body = data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if file_id in self.server.cut or file_id in self.server.fail:
+            self.server.cut.discard(file_id)
+            self.wfile.write(body[:len(body) // 3])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+
+        self.wfile.write(body)
+
+
+def serve(files):
+    """
+        Start the stand-in GDC on a free localhost port.
+
+        Args:
+            - files: A dictionary from file_id to the (file_name, bytes) of each file
+
+        Returns:
+            - The server and its API URL
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.files = files
+    server.cut = set()
+    server.fail = set()
+    server.ranges = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def check(name, condition):
+    if not condition:
+        raise AssertionError(f"{name} failed")
+    print(f"{name}: ok")
+
+
+def check_downloads(size=1 << 20, chunk_size=1 << 16):
+    data = np.random.default_rng(0).integers(0, 256, size, dtype=np.uint8).tobytes()
+    md5 = hashlib.md5(data).hexdigest()
+    server, api = serve({"slide-id": ("slide.svs", data)})
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        file_path = os.path.join(output_dir, "slide.svs")
+        part_path = file_path + ".part"
+
+        # A dropped connection is resumed from the end of the .part file
+        server.cut.add("slide-id")
+        transferred = stream_download(f"{api}/data/slide-id", file_path, size, md5, chunk_size)
+        # Only whole chunks received before the cut reach the .part file, so the resume starts
+        # at or before the cut
+        ranges = [byte_range for _, byte_range in server.ranges]
+        resumed = len(ranges) == 2 and ranges[0] is None and re.fullmatch(r"bytes=(\d+)-", ranges[1] or "")
+        check("Dropped connection resumed with a Range request",
+              resumed and 0 < int(resumed.group(1)) <= size // 3)
+        check("Resumed download is complete", transferred == size and md5_file(file_path) == md5)
+        check("No .part file left behind", not os.path.exists(part_path))
+
+        # A .part file left by an earlier run is resumed rather than downloaded again
+        os.remove(file_path)
+        with open(part_path, "wb") as part_file:
+            part_file.write(data[:size // 2])
+        server.ranges.clear()
+        transferred = stream_download(f"{api}/data/slide-id", file_path, size, md5, chunk_size)
+        check("Existing .part file resumed",
+              server.ranges == [("slide-id", f"bytes={size // 2}-")] and transferred == size - size // 2)
+        check("Resumed .part file passes its md5 check", md5_file(file_path) == md5)
+
+        # A corrupt .part file fails the md5 check and is removed so the next run starts over
+        os.remove(file_path)
+        with open(part_path, "wb") as part_file:
+            part_file.write(bytes(size // 2))
+        try:
+            stream_download(f"{api}/data/slide-id", file_path, size, md5, chunk_size)
+            failed = False
+        except IOError:
+            failed = True
+        check("Corrupt download fails its md5 check",
+              failed and not os.path.exists(part_path) and not os.path.exists(file_path))
+
+        # A .part file larger than the file is removed so the next attempt starts over
+        with open(part_path, "wb") as part_file:
+            part_file.write(bytes(size + 1))
+        try:
+            stream_download(f"{api}/data/slide-id", file_path, size, md5, chunk_size)
+            failed = False
+        except IOError:
+            failed = True
+        check("Oversized .part file fails its size check and is removed", failed and not os.path.exists(part_path))
+
+        # The manager looks the slide up by name and downloads it through the same path
+        server.cut.add("slide-id")
+        with DownloadManager(output_dir, workers=1, api=api, chunk_size=chunk_size) as manager:
+            path = manager.submit("slide.svs").result()
+            manager.release("slide.svs", done=False)
+            check("DownloadManager download verified", md5_file(path) == md5 and manager.stats["misses"] == 1)
+            path = manager.submit("slide.svs").result()
+            manager.release("slide.svs", done=False)
+            check("DownloadManager reuses the slide on disk", manager.stats["hits"] == 1)
+
+        # A download which keeps failing leaves no .part file outside the disk budget
+        server.files["broken-id"] = ("broken.svs", data)
+        server.fail.add("broken-id")
+        with DownloadManager(output_dir, workers=1, api=api, chunk_size=chunk_size, retries=1,
+                             max_bytes=4 * size) as manager:
+            try:
+                manager.submit("broken.svs").result()
+                failed = False
+            except IOError:
+                failed = True
+            manager.release("broken.svs", done=False)
+            check("Failed download removes its .part file within a disk budget",
+                  failed and not os.path.exists(os.path.join(output_dir, "broken.svs.part")) and manager.used == size)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-s', '--size', dest='size', type='int', default=1 << 20, help='Size of the served file in bytes, default=1048576')
+    parser.add_option('-c', '--chunk_size', dest='chunk_size', type='int', default=1 << 16, help='Number of bytes written at once, default=65536')
+
+    (opts, args) = parser.parse_args()
+
+    check_downloads(opts.size, opts.chunk_size)
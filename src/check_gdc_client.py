@@ -0,0 +1,123 @@
+import json
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+
+from check_downloads import check
+from gdc_client import GDCClient, format_gdc_stats
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+        A local stand-in for the paginated /cases endpoint of the GDC API, holding server.projects[p]
+        cases for every project p. Every request is recorded in server.requests.
+    """
+
+    def log_message(self, *args):
+        pass
+
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        with self.server.lock:
+            self.server.requests.append((url.path, query))
+
+        if url.path != "/cases":
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        project = json.loads(query["filters"])["content"]["value"]
+        total = self.server.projects[project]
+        start, size = int(query.get("from", 0)), int(query.get("size", 10))
+        hits = [{"case_id": f"{project}-{i:05d}"} for i in range(start, min(total, start + size))]
+
+        body = json.dumps({"data": {"hits": hits, "pagination": {
+            "total": total, "count": len(hits), "from": start, "size": size, "pages": -(-total // size)
+        }}}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(projects):
+    """
+        Start the stand-in GDC on a free localhost port.
+
+        Args:
+            - projects: A dictionary from project id to its number of cases
+
+        Returns:
+            - The server and its API URL
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.projects = projects
+    server.requests = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def project_params(project):
+    return {"filters": json.dumps({"op": "=", "content": {"field": "project.project_id", "value": project}}),
+            "fields": "case_id"}
+
+
+def check_gdc_client(page_size=100, workers=4):
+    projects = {"TCGA-AAA": 1234, "TCGA-BBB": 7}
+    server, api = serve(projects)
+    params_list = [project_params(project) for project in projects]
+    expected = [[f"{project}-{i:05d}" for i in range(total)] for project, total in projects.items()]
+    pages = sum(-(-total // page_size) for total in projects.values())
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Every page of every project is fetched once and the hits come back in order
+        client = GDCClient(api, cache_dir, ttl=3600, workers=workers, page_size=page_size)
+        hits = client.query_all("cases", params_list)
+        check("Multi-page results are complete and in order",
+              [[hit["case_id"] for hit in project_hits] for project_hits in hits] == expected)
+        check("Every page is requested once", len(server.requests) == pages and client.stats["misses"] == pages)
+        client.close()
+
+        # A new client within the TTL answers from the cache without reaching the server
+        server.requests.clear()
+        client = GDCClient(api, cache_dir, ttl=3600, workers=workers, page_size=page_size)
+        check("Cache hit within the TTL",
+              client.query_all("cases", params_list) == hits and len(server.requests) == 0
+              and client.stats["hits"] == pages)
+        print(f"GDC queries: {format_gdc_stats(client.stats)}")
+        client.close()
+
+        # Once the TTL has passed the pages are requested again
+        client = GDCClient(api, cache_dir, ttl=0, workers=workers, page_size=page_size)
+        client.query_all("cases", params_list)
+        check("Expired responses are requested again", len(server.requests) == pages)
+        client.close()
+
+        # Offline mode answers cached queries and raises an IOError for the rest
+        server.requests.clear()
+        client = GDCClient(api, cache_dir, ttl=0, offline=True, workers=workers, page_size=page_size)
+        check("Offline mode uses the cache whatever its age", client.query_all("cases", params_list) == hits)
+        try:
+            client.query("cases", project_params("TCGA-CCC"))
+            failed = False
+        except IOError:
+            failed = True
+        check("Offline mode raises an IOError on a cache miss", failed and len(server.requests) == 0)
+        client.close()
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-p', '--page_size', dest='page_size', type='int', default=100, help='Number of hits requested per page, default=100')
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=4, help='Number of concurrent requests, default=4')
+
+    (opts, args) = parser.parse_args()
+
+    check_gdc_client(opts.page_size, opts.workers)
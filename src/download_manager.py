@@ -0,0 +1,361 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+GDC_API = "https://api.gdc.cancer.gov"
+
+SLIDE_EXTENSIONS = (".svs", ".tif", ".tiff", ".ndpi", ".scn", ".bif", ".vms", ".vmu", ".mrxs")
+EVICTION = ("lru", "tiled")
+
+
+def file_info(file_name, api=GDC_API, session=None):
+    """
+        Look a file up in the GDC by name.
+
+        Returns:
+            - A dictionary with the file_id, file_size and md5sum of the file
+    """
+    filters = {
+        "op": "=",
+        "content": {
+            "field": "file_name",
+            "value": file_name
+        }
+    }
+    params = {
+        "filters": json.dumps(filters),
+        "fields": "file_id,file_size,md5sum",
+        "format": "json",
+        "size": "5",
+    }
+
+    response = (session or requests).get(f"{api}/files", params=params)
+    response.raise_for_status()
+    hits = response.json()["data"]["hits"]
+    if len(hits) == 0:
+        raise ValueError(f"{file_name} was not found in the GDC.")
+
+    return hits[0]
+
+
+def md5_file(file_path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def stream_download(url, file_path, size=None, md5=None, chunk_size=1 << 20, retries=3, session=None):
+    """
+        Stream a file to disk in chunks. The data goes to file_path.part, which is resumed with an
+        HTTP Range request if it already exists or the connection drops, and is only renamed to
+        file_path once its size and md5 have been checked. A .part file larger than size or
+        failing the md5 check is deleted, so the next attempt starts over.
+
+        Args:
+            - url: The URL of the file
+            - file_path: Where to save the file
+            - size: The expected size in bytes, None skips the check
+            - md5: The expected md5 hex digest, None skips the check
+            - chunk_size: The number of bytes written at once
+            - retries: The number of times a failed or incomplete transfer is resumed
+
+        Returns:
+            - The number of bytes transferred
+    """
+    session = session or requests
+    part_path = file_path + ".part"
+    transferred = 0
+
+    for attempt in range(retries + 1):
+        start = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if size is not None and start >= size:
+            break
+
+        headers = {"Range": f"bytes={start}-"} if start > 0 else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                response.raise_for_status()
+
+                # Servers which ignore the Range header send the whole file again
+                mode = "ab" if response.status_code == 206 else "wb"
+                with open(part_path, mode) as output_file:
+                    for chunk in response.iter_content(chunk_size):
+                        output_file.write(chunk)
+                        transferred += len(chunk)
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+            continue
+
+        if size is None or os.path.getsize(part_path) >= size:
+            break
+
+    if size is not None and os.path.getsize(part_path) != size:
+        part_size = os.path.getsize(part_path)
+        # A .part file larger than the file can never be completed, so the next attempt starts over.
+        # A shorter one is kept to be resumed.
+        if part_size > size:
+            os.remove(part_path)
+        raise IOError(f"{file_path} has {part_size} bytes, expected {size}.")
+
+    if md5 is not None and md5_file(part_path, chunk_size) != md5:
+        os.remove(part_path)
+        raise IOError(f"{file_path} failed its md5 check.")
+
+    os.replace(part_path, file_path)
+    return transferred
+
+
+def format_download_stats(stats):
+    seconds = max(stats["seconds"], 1e-9)
+    return (f"{stats['misses']} slides downloaded ({stats['bytes'] / 1e6:.1f} MB), {stats['hits']} already on disk | "
+            f"{stats['evicted']} evicted ({stats['evicted_bytes'] / 1e6:.1f} MB) | "
+            f"{stats['bytes'] / 1e6 / seconds:.1f} MB/s while downloading")
+
+
+class DownloadManager:
+    """
+        This class manages the slides of a directory as a cache of the GDC. Slides are downloaded
+        with a pool of threads, so they can be tiled while the next ones are downloading, and the
+        directory can be kept within a disk budget.
+
+        Every slide requested with submit is pinned until it is released. Slides which are not
+        pinned are evicted in least recently used order when a download needs their space, and
+        with the "tiled" eviction policy slides are deleted as soon as they are released as done.
+        Downloads reserve their space in the order they were submitted, and only wait for slides
+        submitted before them to be released. Once nothing earlier holds any space a download goes
+        ahead even if it exceeds the budget, e.g. for a slide larger than the budget or one whose
+        space is held by slides due after it, rather than waiting forever.
+    """
+
+    def __init__(self, path, workers=4, ahead=None, api=GDC_API, chunk_size=1 << 20, retries=3, max_bytes=None,
+                 eviction="lru", offline=False):
+        """
+            Args:
+                - path: The directory the slides are saved to
+                - workers: The number of concurrent downloads
+                - ahead: The number of slides prefetch downloads ahead of the one being used,
+                         default=workers
+                - api: The GDC API endpoint, e.g. a local stand-in for tests
+                - chunk_size: The number of bytes written at once
+                - retries: The number of times a failed or incomplete transfer is resumed
+                - max_bytes: The disk budget of the slides in path, None keeps every slide
+                - eviction: "lru" to only evict slides when a download needs their space, or
+                            "tiled" to also delete slides as soon as they are released as done
+                - offline: Only use the slides already on disk
+        """
+        if eviction not in EVICTION:
+            raise ValueError(f"Unknown eviction policy {eviction}, expected one of {', '.join(EVICTION)}.")
+
+        self.path = path
+        self.workers = workers
+        self.ahead = ahead or workers
+        self.api = api
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.offline = offline
+
+        self.executor = ThreadPoolExecutor(workers)
+        self.futures = {}
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.stats = {"hits": 0, "misses": 0, "bytes": 0, "seconds": 0.0, "evicted": 0, "evicted_bytes": 0}
+
+        # Slides on disk and their sizes, least recently used first
+        self.slides = collections.OrderedDict()
+        # The submit order of every pending use of a slide, and of the downloads yet to reserve space
+        self.pinned = {}
+        self.reservations = collections.deque()
+        self.submitted = 0
+        self.used = 0
+
+        os.makedirs(path, exist_ok=True)
+        entries = [entry for entry in os.scandir(path)
+                   if entry.is_file() and entry.name.lower().endswith(SLIDE_EXTENSIONS)]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            self.slides[entry.name] = entry.stat().st_size
+            self.used += entry.stat().st_size
+
+
+    def _session(self):
+        # requests sessions are not thread safe, so each thread keeps its own
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+
+    def _evict(self, file_name):
+        size = self.slides.pop(file_name)
+        os.remove(os.path.join(self.path, file_name))
+        self.used -= size
+        self.stats["evicted"] += 1
+        self.stats["evicted_bytes"] += size
+
+
+    def _reserve(self, order, size):
+        """
+            Wait until every download submitted earlier has reserved its space, then make room
+            for size bytes by evicting slides which are not pinned, waiting for slides submitted
+            earlier to be released if that is not enough.
+        """
+        with self.condition:
+            while self.reservations[0] != order:
+                self.condition.wait()
+
+            while self.max_bytes is not None and self.used + size > self.max_bytes:
+                evictable = [file_name for file_name in self.slides if file_name not in self.pinned]
+                if len(evictable) > 0:
+                    self._evict(evictable[0])
+                elif any(orders[0] < order for orders in self.pinned.values()):
+                    self.condition.wait()
+                else:
+                    break
+
+            self.used += size
+            self.reservations.popleft()
+            self.condition.notify_all()
+
+
+    def _download(self, file_name, order):
+        file_path = os.path.join(self.path, file_name)
+        with self.condition:
+            if order not in self.reservations:
+                self.stats["hits"] += 1
+                return file_path
+
+        start_time = time.perf_counter()
+        size = 0
+        try:
+            if self.offline:
+                raise IOError(f"{file_name} is not in {self.path} in offline mode.")
+            info = file_info(file_name, self.api, self._session())
+            size = int(info.get("file_size") or 0)
+            self._reserve(order, size)
+            print(f"\rdownloading image {file_name} to path {file_path}")
+            transferred = stream_download(f"{self.api}/data/{info['file_id']}", file_path, info.get("file_size"),
+                                          info.get("md5sum"), self.chunk_size, self.retries, self._session())
+        except BaseException:
+            # The partial download would sit outside the disk budget once its space is released
+            part_path = file_path + ".part"
+            if self.max_bytes is not None and os.path.exists(part_path):
+                os.remove(part_path)
+            with self.condition:
+                if order in self.reservations:
+                    self.reservations.remove(order)
+                else:
+                    self.used -= size
+                self.condition.notify_all()
+            raise
+
+        with self.condition:
+            self.slides[file_name] = os.path.getsize(file_path)
+            self.used += self.slides[file_name] - size
+            self.stats["misses"] += 1
+            self.stats["bytes"] += transferred
+            self.stats["seconds"] += time.perf_counter() - start_time
+
+        return file_path
+
+
+    def submit(self, file_name):
+        """
+            Pin a slide and start downloading it unless it is on disk or already downloading.
+            Every call should be matched by a call to release.
+
+            Returns:
+                - A Future giving the path of the slide
+        """
+        with self.condition:
+            order = self.submitted
+            self.submitted += 1
+            self.pinned.setdefault(file_name, []).append(order)
+
+            # A finished future is not reused as its slide may have been evicted since
+            if file_name not in self.futures or self.futures[file_name].done():
+                if file_name in self.slides:
+                    self.slides.move_to_end(file_name)
+                else:
+                    self.reservations.append(order)
+                self.futures[file_name] = self.executor.submit(self._download, file_name, order)
+
+            return self.futures[file_name]
+
+
+    def release(self, file_name, done=True):
+        """
+            Unpin a slide after using it.
+
+            Args:
+                - file_name: The name of the slide
+                - done: Whether the slide is no longer needed, so the "tiled" eviction policy deletes
+                        it. Slides released with done=False are only evicted for space.
+        """
+        with self.condition:
+            orders = self.pinned[file_name]
+            orders.pop(0)
+            if len(orders) == 0:
+                del self.pinned[file_name]
+
+                if file_name in self.slides:
+                    self.slides.move_to_end(file_name)
+                    if done and self.eviction == "tiled":
+                        self._evict(file_name)
+
+            self.condition.notify_all()
+
+
+    def prefetch(self, file_names, done=True, release=True):
+        """
+            Yield the paths of the slides in order as they are on disk, keeping up to ahead
+            downloads running in the background. Each slide is released when the next one is
+            requested.
+
+            Args:
+                - file_names: The names of the slides
+                - done: Whether the slides are released as done
+                - release: With release=False the slides yielded stay pinned and the caller
+                           releases each one with release once it is finished with it, e.g.
+                           when several slides are tiled at once
+        """
+        queue = collections.deque()
+        try:
+            for next_name in list(file_names) + [None]:
+                if next_name is not None:
+                    queue.append((next_name, self.submit(next_name)))
+
+                while len(queue) > self.ahead or (next_name is None and len(queue) > 0):
+                    file_name, future = queue[0]
+                    try:
+                        yield future.result()
+                    finally:
+                        queue.popleft()
+                        if release:
+                            self.release(file_name, done)
+        finally:
+            # Slides left when the loop stops early stay on disk for the next use
+            for file_name, _ in queue:
+                self.release(file_name, done=False)
+
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from download_manager import GDC_API
+
+
+class GDCClient:
+    """
+        This class queries the GDC API with a pool of threads, fetching every page of paginated
+        queries concurrently, and keeps the responses in an on-disk cache keyed by the query.
+
+        Cached responses are used until they are older than ttl seconds. In offline mode every
+        cached response is used whatever its age and queries which are not cached raise an
+        IOError instead of reaching the network.
+    """
+
+    def __init__(self, api=GDC_API, cache_dir=None, ttl=7 * 24 * 3600, offline=False, workers=8, page_size=500):
+        """
+            Args:
+                - api: The GDC API endpoint, e.g. a local stand-in for tests
+                - cache_dir: The directory the responses are cached in, None disables the cache
+                - ttl: The number of seconds a cached response is used for, None never expires
+                - offline: Only answer queries from the cache
+                - workers: The number of concurrent requests
+                - page_size: The number of hits requested per page
+        """
+        if offline and cache_dir is None:
+            raise ValueError("Offline mode needs a cache directory.")
+
+        self.api = api
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        self.page_size = page_size
+
+        self.executor = ThreadPoolExecutor(workers)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+
+    def _session(self):
+        # requests sessions are not thread safe, so each thread keeps its own
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+
+    def _cache_path(self, endpoint, params):
+        query = json.dumps({"url": f"{self.api}/{endpoint}", "params": params}, sort_keys=True)
+        return os.path.join(self.cache_dir, hashlib.sha256(query.encode("utf-8")).hexdigest() + ".json")
+
+
+    def query(self, endpoint, params):
+        """
+            Args:
+                - endpoint: The API endpoint, e.g. "cases"
+                - params: The query parameters
+
+            Returns:
+                - The decoded JSON response, from the cache if it holds a fresh copy
+        """
+        cache_path = None if self.cache_dir is None else self._cache_path(endpoint, params)
+
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path) as cache_file:
+                cached = json.load(cache_file)
+            if self.offline or self.ttl is None or time.time() - cached["time"] < self.ttl:
+                with self.lock:
+                    self.stats["hits"] += 1
+                return cached["response"]
+
+        if self.offline:
+            raise IOError(f"No cached response for {endpoint} with {json.dumps(params)} in offline mode.")
+
+        response = self._session().get(f"{self.api}/{endpoint}", params=params)
+        response.raise_for_status()
+        data = response.json()
+
+        with self.lock:
+            self.stats["misses"] += 1
+
+        if cache_path is not None:
+            # Written to a temporary file first so readers never see a partial response
+            temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as cache_file:
+                json.dump({"time": time.time(), "endpoint": endpoint, "params": params, "response": data}, cache_file)
+            os.replace(temp_path, cache_path)
+
+        return data
+
+
+    def _page(self, endpoint, params, page):
+        return self.query(endpoint, {**params, "from": str(page * self.page_size), "size": str(self.page_size)})
+
+
+    def query_all(self, endpoint, params_list):
+        """
+            Fetch every page of a number of queries. The first page of every query is fetched
+            concurrently, then the remaining pages of all of them.
+
+            Args:
+                - endpoint: The API endpoint, e.g. "cases"
+                - params_list: The query parameters of each query, without from or size
+
+            Returns:
+                - The list of hits of each query
+        """
+        first_pages = list(self.executor.map(lambda params: self._page(endpoint, params, 0), params_list))
+
+        pages = [(index, page) for index, response in enumerate(first_pages)
+                 for page in range(1, response["data"]["pagination"]["pages"])]
+        responses = self.executor.map(lambda item: self._page(endpoint, params_list[item[0]], item[1]), pages)
+
+        hits = [list(response["data"]["hits"]) for response in first_pages]
+        for (index, _), response in zip(pages, responses):
+            hits[index].extend(response["data"]["hits"])
+
+        for index, response in enumerate(first_pages):
+            total = response["data"]["pagination"]["total"]
+            if len(hits[index]) != total:
+                print(f"warning: {endpoint} query returned {len(hits[index])} of {total} hits, "
+                      "the GDC may have changed between pages")
+
+        return hits
+
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def format_gdc_stats(stats):
+    return f"{stats['hits']} cached responses, {stats['misses']} requests"
@@ -1,105 +1,175 @@
+import json
 import os
 
 import h5py
+import numpy as np
 import pandas as pd
 
-from src.labeling_util import store_hugo, load_hugo
-
-def recursive_save_to_h5(h5_file, path, item):
-    if isinstance(item, dict):
-        for key, value in item.items():
-            recursive_save_to_h5(h5_file, f"{path}{key}/", value)
-    elif isinstance(item, list):
-        if len(item) > 0:
-            for key, value in enumerate(item):
-                recursive_save_to_h5(h5_file, f"{path}{key}/", value)
-        else:
-            h5_file.create_group(f"{path}/")
-    elif item is None:
-        h5_file[path] = h5py.Empty("f")
-    else:
-        h5_file[path] = item
+from labeling_util import store_hugo, load_hugo
+
+METADATA_FORMAT = "json"
+
+def save_metadata(h5_file, name, item):
+    """
+        Store a section of the split metadata as a single gzip compressed JSON blob, replacing the
+        section if it exists.
+    """
+    if name in h5_file:
+        del h5_file[name]
+
+    blob = np.frombuffer(json.dumps(item).encode("utf-8"), dtype=np.uint8)
+    dataset = h5_file.create_dataset(name, data=blob, compression="gzip")
+    dataset.attrs["format"] = METADATA_FORMAT
+
+
+def load_metadata(h5_file, name):
+    """
+        Load a section of the split metadata saved by save_metadata, or with
+        recursive_load_from_h5 the tree of groups of set files written before it.
+    """
+    item = h5_file[name]
+    if isinstance(item, h5py.Dataset) and item.attrs.get("format") == METADATA_FORMAT:
+        return json.loads(item[()].tobytes().decode("utf-8"))
+
+    return recursive_load_from_h5(h5_file, name)
 
-    h5_file[path].attrs["type"] = type(item).__name__
 
+def case_projects(data):
+    """
+        Returns:
+            - A dictionary from each case of the data dict to the projects it is in
+    """
+    projects = {}
+    for project, cases in data["data dict"].items():
+        for case in cases:
+            projects.setdefault(case, []).append(project)
 
-def get_data_dict(case_set, data, h5_file_name):
+    return projects
+
+
+def get_data_dict(case_set, data, h5_file_name, projects=None):
+    projects = projects or case_projects(data)
     set_data_dict = {}
     for case in case_set:
-        for key, value in data["data dict"].items():
-            if case in value:
-                if key not in set_data_dict:
-                    set_data_dict[key] = {}
+        for key in projects.get(case, []):
+            if key not in set_data_dict:
+                set_data_dict[key] = {}
 
-                set_data_dict[key][case] = value[case]
+            set_data_dict[key][case] = data["data dict"][key][case]
 
     with h5py.File(h5_file_name, "a") as h5_file:
-        recursive_save_to_h5(h5_file, "data_dict/", set_data_dict)
+        save_metadata(h5_file, "data_dict", set_data_dict)
 
     return set_data_dict
 
 
 def get_case_to_images(case_set, data, h5_file_name=None):
-    set_case_to_images = {}
-    for case in case_set:
-        for key, value in data["case to images"].items():
-            if case == key:
-                set_case_to_images[key] = value
+    set_case_to_images = {case: data["case to images"][case] for case in case_set if case in data["case to images"]}
     
     if h5_file_name is not None:
         with h5py.File(h5_file_name, "a") as h5_file:
-            recursive_save_to_h5(h5_file, "case_to_images/", set_case_to_images)
+            save_metadata(h5_file, "case_to_images", set_case_to_images)
 
     return set_case_to_images
 
 
-def get_image_to_sample(case_set, data, h5_file_name=None):
+def get_image_to_sample(case_set, data, h5_file_name=None, set_case_to_images=None):
+    if set_case_to_images is None:
+        set_case_to_images = get_case_to_images(case_set, data)
+
     set_image_to_sample = {}
-    for key, value in get_case_to_images(case_set, data).items():
+    for key, value in set_case_to_images.items():
         for image in value:
             set_image_to_sample[image] = key
     
     if h5_file_name is not None:
         with h5py.File(h5_file_name, "a") as h5_file:
-            recursive_save_to_h5(h5_file, "image_to_sample/", set_image_to_sample)
+            save_metadata(h5_file, "image_to_sample", set_image_to_sample)
 
     return set_image_to_sample
         
 
-def get_mutational_signatures(case_set, data, h5_file_name):
-    mutational_signatures = data["mutational signatures"][data["mutational signatures"]["case_id"].isin(case_set)]
-    mutational_signatures.to_hdf(h5_file_name, "/mutational_signatures", format="table")
+def get_mutational_signatures(case_set, data, h5_file_name, mask=None):
+    if mask is None:
+        mask = data["mutational signatures"]["case_id"].isin(case_set)
+    mutational_signatures = data["mutational signatures"][mask]
+    mutational_signatures.to_hdf(h5_file_name, key="/mutational_signatures", format="table")
 
     return mutational_signatures
 
 
-def get_labels(case_set, data, h5_file_name):
-    sample_ids = list(map( lambda x : data['image to sample'][x], list(get_image_to_sample(case_set, data).keys())))
-    labels = data['labels'][data['labels']['sample.barcode'].isin(sample_ids)]
-    labels.to_hdf(h5_file_name, "/labels", format="table")
+def get_labels(case_set, data, h5_file_name, mask=None):
+    if mask is None:
+        sample_ids = [data['image to sample'][image] for image in get_image_to_sample(case_set, data)]
+        mask = data['labels']['sample.barcode'].isin(sample_ids)
+    labels = data['labels'][mask]
+    labels.to_hdf(h5_file_name, key="/labels", format="table")
 
     return labels
 
 
-def get_hugo_symbols(case_set, data, h5_file_name):
-    hugo_symbols = data["hugo symbols"][data["hugo symbols"]["case_barcode"].isin(case_set)]
+def get_hugo_symbols(case_set, data, h5_file_name, mask=None):
+    if mask is None:
+        mask = data["hugo symbols"]["case_barcode"].isin(case_set)
+    hugo_symbols = data["hugo symbols"][mask]
     with h5py.File(h5_file_name, "a") as h5_file:
         store_hugo(h5_file,hugo_symbols,overwrite=True)
 
     return hugo_symbols
 
 
+def split_dataset(case_sets, data, h5_file_names):
+    """
+        Split the data of get_projects_info into sets of cases in a single pass. The projects of
+        every case and the set of every case and sample are looked up once, and the label,
+        signature and hugo symbol tables are each mapped to their sets with one vectorized join.
+
+        Args:
+            - case_sets: The list of cases of each set
+            - data: The dictionary returned by get_projects_info
+            - h5_file_names: The file each set is saved to
+
+        Returns:
+            - The data of each set, as split_to_sets
+    """
+    projects = case_projects(data)
+
+    case_split = {}
+    sample_split = {}
+    for split, case_set in enumerate(case_sets):
+        for case in case_set:
+            case_split[case] = split
+            for image in data["case to images"].get(case, []):
+                sample_split[data["image to sample"][image]] = split
+
+    label_splits = data["labels"]["sample.barcode"].map(sample_split).to_numpy()
+    signature_splits = data["mutational signatures"]["case_id"].map(case_split).to_numpy()
+    hugo_splits = data["hugo symbols"]["case_barcode"].map(case_split).to_numpy()
+
+    sets = []
+    for split, (case_set, h5_file_name) in enumerate(zip(case_sets, h5_file_names)):
+        set_case_to_images = get_case_to_images(case_set, data, h5_file_name)
+        sets.append({
+            "data dict": get_data_dict(case_set, data, h5_file_name, projects),
+            "image to sample": get_image_to_sample(case_set, data, h5_file_name, set_case_to_images),
+            "case to images": set_case_to_images,
+            "labels": get_labels(case_set, data, h5_file_name, label_splits == split),
+            "mutational signatures": get_mutational_signatures(case_set, data, h5_file_name, signature_splits == split),
+            "hugo symbols": get_hugo_symbols(case_set, data, h5_file_name, hugo_splits == split)
+        })
+
+    return sets
+
+
 def split_to_sets(case_set, data, h5_file_name):
-    return {
-        "data dict": get_data_dict(case_set, data, h5_file_name),
-        "image to sample": get_image_to_sample(case_set, data, h5_file_name),
-        "case to images":  get_case_to_images(case_set, data, h5_file_name),
-        "labels": get_labels(case_set, data, h5_file_name),
-        "mutational signatures": get_mutational_signatures(case_set, data, h5_file_name),
-        "hugo symbols": get_hugo_symbols(case_set, data, h5_file_name)
-    }
+    return split_dataset([case_set], data, [h5_file_name])[0]
 
 def recursive_load_from_h5(h5_file, path):
+    """
+        Read the split metadata of set files written before save_metadata, which stored every
+        value as its own HDF5 object with its type as an attribute. Only kept so these files
+        can still be read.
+    """
     if h5_file[path].attrs["type"] == dict.__name__:
         return_dict = {}
         for key, value in h5_file[path].items():
@@ -120,9 +190,9 @@ def recursive_load_from_h5(h5_file, path):
 def load_set_data(h5_file_loc):
     with h5py.File(h5_file_loc, "r") as h5_file:
         return {
-            "data dict": recursive_load_from_h5(h5_file, "data_dict"),
-            "image to sample": recursive_load_from_h5(h5_file, "image_to_sample/"),
-            "case to images":  recursive_load_from_h5(h5_file, "case_to_images/"),
+            "data dict": load_metadata(h5_file, "data_dict"),
+            "image to sample": load_metadata(h5_file, "image_to_sample"),
+            "case to images":  load_metadata(h5_file, "case_to_images"),
             "labels": pd.read_hdf(h5_file_loc, key="labels"),
             "mutational signatures": pd.read_hdf(h5_file_loc, key="mutational_signatures"),
             "hugo symbols": load_hugo(h5_file)
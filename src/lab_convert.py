@@ -0,0 +1,130 @@
+import numpy as np
+from skimage import color
+
+
+# sRGB primaries and the D65 2 degree reference white used by skimage.color
+XYZ_FROM_RGB = np.array([
+    [0.412453, 0.357580, 0.180423],
+    [0.212671, 0.715160, 0.072169],
+    [0.019334, 0.119193, 0.950227]
+])
+RGB_FROM_XYZ = np.linalg.inv(XYZ_FROM_RGB)
+REF_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+BACKENDS = ("skimage", "fast")
+
+
+def srgb_to_linear(values):
+    """
+        The sRGB transfer function for values in [0, 1], as in skimage.color.rgb2xyz.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(values > 0.04045, ((values + 0.055) / 1.055) ** 2.4, values / 12.92)
+
+
+def linear_to_srgb(values):
+    """
+        The inverse sRGB transfer function, clipped to [0, 1] as in skimage.color.xyz2rgb.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = np.where(values > 0.0031308, 1.055 * np.power(np.maximum(values, 0), 1 / 2.4) - 0.055, values * 12.92)
+    return np.clip(values, 0, 1)
+
+
+class SkimageLab:
+    """
+        The float64 conversions of skimage.color, which the other backends are checked against.
+    """
+
+    def rgb2lab(self, tile):
+        return color.rgb2lab(tile)
+
+
+    def lab2rgb(self, lab):
+        return (color.lab2rgb(lab) * 255).astype(np.uint8)
+
+
+class FastLab:
+    """
+        RGB <-> LAB conversions for uint8 tiles in float32.
+
+        The forward path looks the linear value of each uint8 channel up in a 256 entry table and
+        applies a single 3x3 matrix with the reference white folded in. The reverse path applies
+        the inverse matrix and looks the gamma compressed uint8 value up in a table of gamma_levels
+        linear values.
+    """
+
+    def __init__(self, gamma_levels=1 << 16):
+        """
+            Args:
+                - gamma_levels: The number of linear values in the gamma compression table
+        """
+        self.to_linear = srgb_to_linear(np.arange(256) / 255).astype(np.float32)
+        self.xyz_from_rgb = (XYZ_FROM_RGB / REF_WHITE[:, np.newaxis]).T.astype(np.float32)
+        self.rgb_from_xyz = (RGB_FROM_XYZ * REF_WHITE[np.newaxis, :]).T.astype(np.float32)
+
+        self.gamma_scale = np.float32(gamma_levels - 1)
+        self.from_linear = (linear_to_srgb(np.arange(gamma_levels) / (gamma_levels - 1)) * 255).astype(np.uint8)
+        # 1.055 - 0.055 rounds to just below 1, while skimage clips linear values above 1 to 255
+        self.from_linear[-1] = 255
+
+
+    def rgb2lab(self, tile):
+        """
+            Args:
+                - tile: An (..., 3) uint8 array
+
+            Returns:
+                - The (..., 3) float32 LAB values
+        """
+        xyz = self.to_linear[tile] @ self.xyz_from_rgb
+        f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + np.float32(16 / 116))
+
+        lab = np.empty(f.shape, dtype=np.float32)
+        lab[..., 0] = 116 * f[..., 1] - 16
+        lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+        lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+        return lab
+
+
+    def lab2rgb(self, lab):
+        """
+            Args:
+                - lab: An (..., 3) array of LAB values
+
+            Returns:
+                - The (..., 3) uint8 RGB values
+        """
+        lab = np.asarray(lab, dtype=np.float32)
+        f = np.empty(lab.shape, dtype=np.float32)
+        f[..., 1] = (lab[..., 0] + 16) / 116
+        f[..., 0] = lab[..., 1] / 500 + f[..., 1]
+        f[..., 2] = np.maximum(f[..., 1] - lab[..., 2] / 200, 0)
+
+        xyz = np.where(f > 0.2068966, f * f * f, (f - np.float32(16 / 116)) / np.float32(7.787))
+        linear = xyz @ self.rgb_from_xyz
+
+        np.clip(linear, 0, 1, out=linear)
+        return self.from_linear[np.rint(linear * self.gamma_scale).astype(np.intp)]
+
+
+_CONVERTERS = {}
+
+def lab_converter(backend="skimage"):
+    """
+        The converter of a backend. Converters are built once per process and cached, so objects
+        holding a backend only need to store its name.
+
+        Args:
+            - backend: One of "skimage" or "fast"
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown LAB backend {backend}, expected one of {', '.join(BACKENDS)}.")
+
+    if backend not in _CONVERTERS:
+        if backend == "skimage":
+            _CONVERTERS[backend] = SkimageLab()
+        else:
+            _CONVERTERS[backend] = FastLab()
+
+    return _CONVERTERS[backend]
@@ -1,18 +1,17 @@
-import re
 import gzip
-import shutil
-import requests
 import json
 import numpy as np
 import pandas as pd
 import os
-import collections
 import h5py
 from scipy import sparse
-import csv
+
+from download_manager import GDC_API, stream_download
+from gdc_client import GDCClient
+from signature_store import SignatureStore
 
 #main gdc api querry function
-def get_projects_info(project_names):
+def get_projects_info(project_names, client=None):
     '''
     a method for retrieveing data about cases and their related samples for specified gdc projects.
     The method looks for which of the projects specified actually exist in the GDC and then for each
@@ -21,6 +20,7 @@ def get_projects_info(project_names):
     
     Input:
     List of project names for which data should be retrieved
+    GDCClient used for the queries, by default one without a response cache
     
     Output:
     dict:
@@ -36,9 +36,9 @@ def get_projects_info(project_names):
     if not(isinstance(project_names,list) and all(isinstance(i,str) for i in project_names)):
         raise TypeError("project_names expects a list of strings")
     
-    #define api endpoints
-    cases_endpt = 'https://api.gdc.cancer.gov/cases'
-    projects_endpt = 'https://api.gdc.cancer.gov/projects'
+    #queries are paginated, fetched concurrently and cached by the client
+    if client is None:
+        client = GDCClient()
     
     
     #check which of the specified project names are in gdc
@@ -55,11 +55,9 @@ def get_projects_info(project_names):
         "filters": json.dumps(filters),
         "fields":"project_id",
         "format":"json",
-        "pretty":"true",
     }
     
-    response = requests.get(projects_endpt, params = params)
-    response = json.loads(response.content.decode("utf-8"))
+    response = client.query("projects", dict(params, size=str(len(project_names))))
     print(80*'-')
     
     if not(response['warnings']=={}):
@@ -72,19 +70,22 @@ def get_projects_info(project_names):
     projects_data={}
     image_to_sample={}
     case_to_images={}
-    out_hugos = []
+    symbol_to_col = {}
+    hugo_rows = []
+    hugo_cols = []
+    hugo_counts = []
     all_barcodes = []
     
-    #mutational signature file for the entire tcga dataset
-    signatures = pd.read_csv(os.path.join("manifest", 'TCGA_WES_sigProfiler_SBS_signatures_in_samples.csv'))
-    signatures['case_id'] = signatures['Sample Names'].apply(lambda x : '-'.join(x.split('-')[:3]))
-    signatures = signatures.iloc[:,3:]
-    #search for cases for each project
+    #mutational signature file for the entire tcga dataset, indexed by case id and cached next to the csv
+    signature_store = SignatureStore.load(os.path.join("manifest", 'TCGA_WES_sigProfiler_SBS_signatures_in_samples.csv'))
+    signatures = signature_store.to_frame()
+    #search for cases for each project, every page of every project at once
     print(80*'-')
+    print("looking for cases for projects:",found_projects)
+    fields = ['case_id','project.project_id',"submitter_id","files.file_id","files.file_name"]
+    fields = ','.join(fields)
+    params_list = []
     for project in found_projects:
-        
-        print("looking for cases for project:",project)
-        
         filters = {
             "op":"=",
             "content":{
@@ -92,26 +93,18 @@ def get_projects_info(project_names):
                 "value":project
             }
         }
-        
-        fields = ['case_id','project.project_id',"submitter_id","files.file_id","files.file_name"]
-        fields = ','.join(fields)
-        
-        params = {
+        params_list.append({
             "filters":json.dumps(filters),
             "fields" :fields,
             "format" :"json",
-            "pretty" :"true",
-            "size"   : "1100",
             "expand" : "demographic,samples,files,diagnoses"
-            }
+            })
+    project_cases = client.query_all("cases", params_list)
 
-        response = requests.get(cases_endpt, params = params)
-        cases = json.loads(response.content.decode("utf-8"))
-        print("retrieved",cases['data']['pagination']['count'],"cases in the",project,"project")
-                
+    for project, found_cases in zip(found_projects, project_cases):
+        print("retrieved",len(found_cases),"cases in the",project,"project")
         
         #add cases to dictionary
-        found_cases = cases['data']['hits']
         out_cases = {}
         for case in found_cases:
             
@@ -149,12 +142,7 @@ def get_projects_info(project_names):
             #dict section
             demographic = case.get('demographic',{})
             samples = case.get('samples',[])
-            mutational_signatures = signatures[signatures['case_id']==case['submitter_id']]
-            
-            if mutational_signatures.shape[0] != 0:
-                mutational_signatures = mutational_signatures.iloc[0,:-1].to_list()
-            else:
-                mutational_signatures = []
+            mutational_signatures = signature_store.lookup(case['submitter_id'])
 
             out_cases[case['submitter_id']]={"demographic":demographic,"samples":samples,
                                              "case_id":case['case_id'],"hugo_symbols":[],
@@ -190,37 +178,35 @@ def get_projects_info(project_names):
         
         #download maf file to add hugo symbols to each case
         print("downloading maf file for project",project)
-        zip_file,maf_file = download_maf_for_proj(project)
+        maf_file = download_maf_for_proj(project, client)
         
-        #if maf file for the given project was found and extracted then add it to 
+        #if maf file for the given project was found then count the hugo symbols of each case
         if maf_file != None:
-            print("downloaded file:",zip_file)
-            print("file extracted to:",maf_file)
+            print("reading maf file:",maf_file)
+            case_ids = list(out_cases.keys())
+            rows,cols,counts,unknown,order_rows,order_cols = read_maf_counts(maf_file,case_ids,symbol_to_col,keep_order=True)
+            if unknown > 0:
+                print("skipped",unknown,"mutations of cases without slide images")
 
-            with open(maf_file) as maf:
-                rd = csv.reader(maf,delimiter='\t', quotechar='"')
-                #skip headers
-                for i in range(6):
-                    next(rd)
-                #add hugo symbols to each case
-                for line in rd:
-                    symbol = line[0]
-                    case_id = '-'.join(line[15].split('-')[:3])
-                    out_cases[case_id]['hugo_symbols'].append(symbol)
+            #keep the symbols of each case in the data dict, in the order of the maf file
+            symbols = np.array(list(symbol_to_col.keys()),dtype=object)
+            order = np.argsort(order_rows,kind='stable')
+            splits = np.searchsorted(order_rows[order],np.arange(1,len(case_ids)))
+            for case_id,case_cols in zip(case_ids,np.split(order_cols[order],splits)):
+                out_cases[case_id]['hugo_symbols'] = symbols[case_cols].tolist()
 
-            #add cases to hugo symbol dataframe
-            all_barcodes = all_barcodes+list(out_cases.keys())
-            for case in out_cases:
-                symbols = out_cases[case]['hugo_symbols']
-                symbols = dict(collections.Counter(symbols))
-                out_hugos.append(symbols)
+            #add cases to hugo symbol matrix
+            hugo_rows.append(rows+len(all_barcodes))
+            hugo_cols.append(cols)
+            hugo_counts.append(counts)
+            all_barcodes = all_barcodes+case_ids
         
         #add the cases doctionary for given project to the projects dictionary
         projects_data[project]=out_cases
         print(80*'-')
     
     #create sparse dataframe for hugos
-    hugos = dicts_to_sparse(out_hugos)
+    hugos = counts_to_sparse(hugo_rows,hugo_cols,hugo_counts,(len(all_barcodes),len(symbol_to_col)),list(symbol_to_col.keys()))
     hugos['case_barcode'] = all_barcodes
 
     samples = pd.DataFrame.from_records(out_samples)
@@ -231,23 +217,73 @@ def get_projects_info(project_names):
             "hugo symbols" : hugos}
 
 #file download functionality
-def download_extract(file_id,project_name):
-    download_endpt = "https://api.gdc.cancer.gov/data/{}".format(file_id)
-    response = requests.get(download_endpt, headers = {"Content-Type": "application/json"})
-    response_head_cd = response.headers["Content-Disposition"]
-    file_name = os.path.join("manifest", re.findall("filename=(.+)", response_head_cd)[0])
-    out_name = os.path.join("manifest", project_name+'-maf.tsv')
-    
-    with open(file_name, "wb") as output_file:
-        output_file.write(response.content)
-    
-    with gzip.open(file_name, 'rb') as f_in:
-        with open(out_name, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    return file_name,out_name
+def download_maf(file_data,api=GDC_API):
+    #stream the compressed maf file to manifest, it is read without being extracted
+    file_name = os.path.join("manifest", file_data['file_name'])
+    download_endpt = "{}/data/{}".format(api, file_data['file_id'])
+    stream_download(download_endpt, file_name, file_data.get('file_size'), file_data.get('md5sum'))
+    return file_name
+
+def read_maf_counts(maf_file,case_ids,symbol_to_col,chunk_size=1<<16,keep_order=False):
+    '''
+    count the mutations of every hugo symbol in every case of a gzipped maf file. The file is read
+    straight from the compressed stream in chunks of chunk_size lines, keeping only the symbol and
+    barcode columns, so memory depends on the number of distinct case and symbol pairs rather than
+    on the size of the file.
+
+    Input:
+    path of the .maf.gz file
+    list of case barcodes, mutations of other cases are skipped
+    dict from hugo symbol to column, new symbols are added to it
+    keep_order, also return the row and column of every mutation in file order
+
+    Output:
+    row of each case and symbol pair in case_ids, sorted
+    column of each pair
+    number of mutations of each pair
+    number of mutations skipped
+    with keep_order, the rows and the columns of every mutation in file order
+    '''
+    case_index = pd.Index(case_ids)
+    keys = np.zeros(0,dtype=np.int64)
+    counts = np.zeros(0,dtype=np.int64)
+    unknown = 0
+    order_rows,order_cols = [],[]
 
-def download_maf_for_proj(project_name):
-    files_endpt = "https://api.gdc.cancer.gov/files"
+    with gzip.open(maf_file,'rt') as maf:
+        #skip the comment lines, the first other line is the header
+        header = maf.readline()
+        while header.startswith('#'):
+            header = maf.readline()
+        columns = header.rstrip('\n').split('\t')
+
+        chunks = pd.read_csv(maf,sep='\t',header=None,names=columns,usecols=['Hugo_Symbol','Tumor_Sample_Barcode'],
+                             dtype=str,keep_default_na=False,chunksize=chunk_size)
+        for chunk in chunks:
+            barcodes = chunk['Tumor_Sample_Barcode'].str.split('-',n=3).str[:3].str.join('-')
+            rows = case_index.get_indexer(barcodes)
+            known = rows >= 0
+            unknown += int(np.count_nonzero(~known))
+
+            codes,uniques = pd.factorize(chunk['Hugo_Symbol'].to_numpy()[known])
+            cols = np.array([symbol_to_col.setdefault(symbol,len(symbol_to_col)) for symbol in uniques],dtype=np.int64)
+            if keep_order:
+                order_rows.append(rows[known].astype(np.int64))
+                order_cols.append(cols[codes])
+
+            #merge the counts of the chunk into the running counts of each (row, col) pair
+            chunk_keys,chunk_counts = np.unique((rows[known].astype(np.int64)<<32)|cols[codes],return_counts=True)
+            keys,inverse = np.unique(np.concatenate([keys,chunk_keys]),return_inverse=True)
+            counts = np.bincount(inverse,weights=np.concatenate([counts,chunk_counts]),minlength=len(keys)).astype(np.int64)
+
+    if keep_order:
+        return (keys>>32,keys&0xffffffff,counts,unknown,
+                np.concatenate([np.zeros(0,dtype=np.int64)]+order_rows),np.concatenate([np.zeros(0,dtype=np.int64)]+order_cols))
+    return keys>>32,keys&0xffffffff,counts,unknown
+
+def download_maf_for_proj(project_name, client=None):
+    if client is None:
+        client = GDCClient()
 
     workflow = {"op":"=",
                     "content":{
@@ -281,84 +317,34 @@ def download_maf_for_proj(project_name):
     }
     params = {
         "filters":json.dumps(filters),
-        "fields" : "data_type,data_category,file_id,cases.project.project_id",
+        "fields" : "data_type,data_category,file_id,file_name,file_size,md5sum,cases.project.project_id",
         "format" :"json",
-        "pretty" :"true",
         "size"   : "5",
         "expand" : "analysis",
         }
 
-    response = requests.get(files_endpt, params = params)
-    file_data = json.loads(response.content.decode("utf-8"))
+    file_data = client.query("files", params)
     
     #if no maf file found do nothing
     if(file_data['data']['pagination']['total']==0):
         print("no maf file found for project",project_name)
-        return None,None
+        return None
     
-    file_id = file_data['data']['hits'][0]['file_id']
-    return download_extract(file_id,project_name)
-
-def download_image(file_name,path=""):
-    file_path = os.path.join(path,file_name)
-    #check if image already exists
-    if not os.path.exists(file_path):
-        if not os.path.exists(path):
-            os.makedirs(path)
-        files_endpt = "https://api.gdc.cancer.gov/files"
-
-        context = {"op":"=",
-                    "content":{
-                        "field":"file_name",
-                        "value":file_name
-                        }
-                    }
-        params = {
-        "filters":json.dumps(context),
-        "fields" : "file_id",
-        "format" :"json",
-        "pretty" :"true",
-        "size"   : "5",
-        }
+    #reuse the maf file downloaded by an earlier run
+    maf_file = os.path.join("manifest", file_data['data']['hits'][0]['file_name'])
+    if os.path.exists(maf_file):
+        return maf_file
+    if client.offline:
+        raise IOError("maf file {} is not in manifest in offline mode".format(maf_file))
 
-        response = requests.get(files_endpt, params = params)
-        file_data = json.loads(response.content.decode("utf-8"))
-        file_id = file_data['data']['hits'][0]['file_id']
+    return download_maf(file_data['data']['hits'][0],client.api)
 
-        data_endpt = "https://api.gdc.cancer.gov/data/{}".format(file_id)
-        print("downloading image {} to path {}".format(file_name,file_path))
-        response = requests.get(data_endpt, headers = {"Content-Type": "application/json"})
-
-        with open(file_path, "wb") as output_file:
-            output_file.write(response.content)
-    else:
-        print("{} already exists, not downloading anything".format(file_path))
-
-def dicts_to_sparse(dicts):
-    symbol_to_col = {}
-    idx = 0
-    #create maping from hugo symbol to col in coo matrix
-    for case in dicts:
-        for symbol in case:
-            if symbol not in symbol_to_col:
-                symbol_to_col[symbol]=idx
-                idx+=1
-    row = []
-    col = []
-    data = []
-    #build arrays
-    row_idx=0
-    for case in dicts:
-        for symbol in case:
-            row.append(row_idx)
-            col.append(symbol_to_col[symbol])
-            data.append(case[symbol])
-        row_idx += 1
-    #build coo
-    coo = sparse.coo_matrix((data,(row,col)))
-    #convert coo to df
-    df = pd.DataFrame.sparse.from_spmatrix(coo,columns=list(symbol_to_col.keys()))
-    return df
+def counts_to_sparse(rows,cols,counts,shape,symbols):
+    #build the sparse hugo symbol dataframe from the lists of (row, col, count) arrays of each project
+    coo = sparse.coo_matrix((np.concatenate([np.zeros(0,dtype=np.int64)]+counts),
+                             (np.concatenate([np.zeros(0,dtype=np.int64)]+rows),
+                              np.concatenate([np.zeros(0,dtype=np.int64)]+cols))),shape)
+    return pd.DataFrame.sparse.from_spmatrix(coo,columns=symbols)
 
 def store_hugo(file,hugo,overwrite=False):
     #store a hugo symbol dataframe in an existing h5 file
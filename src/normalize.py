@@ -1,63 +1,446 @@
+import collections
+import json
+import multiprocessing as mp
 import os
+import time
 from optparse import OptionParser
 
 import h5py
 import numpy as np
-from skimage import color
 from PIL import Image
 
-class Normalizer:
+try:
+    # Tiles written with the blosc or lz4 codecs can only be read with the hdf5plugin filters
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+from lab_convert import BACKENDS, lab_converter
+
+
+def zoom_groups(patient_image):
+    """
+        Yield the zoom level groups of a slide group, skipping other slide level datasets
+        such as the tissue mask.
+    """
+    for zoom in patient_image.values():
+        if isinstance(zoom, h5py.Group) and "images" in zoom:
+            yield zoom
+
+
+def aligned_block_size(dataset, block_size):
+    """
+        Round a number of tiles down to a whole number of the dataset's chunks, keeping at least
+        one chunk.
+    """
+    chunk = dataset.chunks[0] if dataset.chunks is not None else 1
+    return max(chunk, block_size // chunk * chunk)
+
+
+def image_blocks(h5_set, block_size, slides=None):
+    """
+        Yield (dataset name, start, end) for chunk aligned blocks of every accepted tile dataset
+        of a set, or only of the given slide groups.
+    """
+    if slides is None:
+        slides = h5_set["images"].values()
+
+    for patient_image in slides:
+        for zoom in zoom_groups(patient_image):
+            images = zoom["images"]
+            step = aligned_block_size(images, block_size)
+
+            for start in range(0, images.shape[0], step):
+                yield images.name, start, min(start + step, images.shape[0])
+
+
+def format_throughput(n_tiles, n_bytes, seconds):
+    seconds = max(seconds, 1e-9)
+    return (f"{n_tiles} tiles ({n_bytes / 1e6:.1f} MB) in {seconds:.2f}s | "
+            f"{n_tiles / seconds:.0f} tiles/s | {n_bytes / 1e6 / seconds:.1f} MB/s")
+
+
+class LabStatistics:
+    """
+        Running statistics of the per tile LAB channel means and standard deviations, kept in O(1)
+        memory per channel. Two accumulators can be merged, e.g. after fitting in worker processes.
+
+        The state holds, per channel:
+            - tiles: The number of tiles
+            - n: The total number of pixels
+            - weighted_mean: The pixel weighted mean of the tile means
+            - m2: sum[ n_i(y_bar_i - weighted_mean)^2 ], updated with Welford's method and merged
+                  with Chan's parallel method
+            - spread: sum[ (n_i - 1)sig_i ]
+            - mean_of_means: The unweighted mean of the tile means
+    """
+
     def __init__(self):
-        self.means = np.empty((0, 3))        
-        self.stds = np.empty((0, 3))
-        self.size = np.empty((0, 3))
+        self.tiles = 0
+        self.n = np.zeros(3)
+        self.weighted_mean = np.zeros(3)
+        self.m2 = np.zeros(3)
+        self.spread = np.zeros(3)
+        self.mean_of_means = np.zeros(3)
+
+
+    def update(self, mean, std, n):
+        """
+            Add the statistics of a single tile.
+
+            Args:
+                - mean: The mean of each LAB channel of the tile
+                - std: The standard deviation of each LAB channel of the tile
+                - n: The number of pixels in the tile
+        """
+        self.tiles += 1
+        self.n = self.n + n
+
+        delta = mean - self.weighted_mean
+        self.weighted_mean = self.weighted_mean + delta * n / self.n
+        self.m2 = self.m2 + delta * n * (mean - self.weighted_mean)
+
+        self.spread = self.spread + (n - 1) * std
+        self.mean_of_means = self.mean_of_means + (mean - self.mean_of_means) / self.tiles
+
+
+    def merge(self, other):
+        """
+            Add the statistics of another accumulator.
+        """
+        if other.tiles == 0:
+            return
+
+        tiles = self.tiles + other.tiles
+        n = self.n + other.n
+        delta = other.weighted_mean - self.weighted_mean
+
+        self.weighted_mean = self.weighted_mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + delta**2 * self.n * other.n / n
+        self.spread = self.spread + other.spread
+        self.mean_of_means = (self.tiles * self.mean_of_means + other.tiles * other.mean_of_means) / tiles
+        self.n = n
+        self.tiles = tiles
+
+
+    def target(self):
+        """
+        sig = sum[ (n_i - 1)sig_i + n_i(y_bar_i - y_bar)^2 ]/ sum[ n_i ]-1
+
+        Returns:
+            - mu: The target mean of each LAB channel
+            - sig: The target standard deviation of each LAB channel
+        """
+        if self.tiles == 0:
+            raise Exception("Normalizer has not been fit yet.")
+
+        sig = np.sqrt((self.spread + self.m2) / self.n)
+
+        return self.mean_of_means, sig
 
 
-    def fit_tile(self, tile_array):
-        lab = color.rgb2lab(tile_array)
+    def to_dict(self):
+        return {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in self.__dict__.items()}
+
+
+    @classmethod
+    def from_dict(cls, state):
+        stats = cls()
+        for key, value in state.items():
+            setattr(stats, key, value if key == "tiles" else np.array(value, dtype=np.float64))
+        return stats
+
+
+def tile_statistics(tile_array, backend="skimage"):
+    """
+        Returns:
+            - The mean and standard deviation of each LAB channel of a tile and its number of pixels
+    """
+    lab = lab_converter(backend).rgb2lab(tile_array)
+
+    mean = np.array([np.mean(lab[:,:,i]) for i in range(3)])
+    std = np.array([np.std(lab[:,:,i]) for i in range(3)])
+    return mean, std, lab.shape[0] * lab.shape[1]
+
+
+class TileReservoir:
+    """
+        A stratified reservoir sample of tiles, e.g. with one stratum per slide and magnification.
+        Each stratum keeps a uniform sample of at most size of the tiles offered to it (Algorithm R).
+        Only the LAB statistics of the sampled tiles are stored, and they are only computed for
+        tiles entering the reservoir, about size * (1 + ln(offered / size)) tiles per stratum.
+    """
+
+    def __init__(self, size=64, seed=None, backend="skimage"):
+        """
+            Args:
+                - size: The number of tiles sampled from each stratum
+                - seed: A seed, or a list of seeds, for the sampling
+                - backend: The LAB conversion backend, see lab_convert.BACKENDS
+        """
+        if size < 1:
+            raise ValueError("size must be at least 1.")
+
+        self.size = size
+        self.backend = backend
+        self.rng = np.random.default_rng(seed)
+        self.offered = {}
+        self.samples = {}
+
+
+    def offer(self, stratum, tile_array):
+        """
+            Offer a tile to the sample of a stratum.
+        """
+        offered = self.offered.get(stratum, 0) + 1
+        self.offered[stratum] = offered
+        samples = self.samples.setdefault(stratum, [])
+
+        if len(samples) < self.size:
+            samples.append(tile_statistics(tile_array, self.backend))
+        else:
+            index = self.rng.integers(offered)
+            if index < self.size:
+                samples[index] = tile_statistics(tile_array, self.backend)
+
+
+    def sampled(self, stratum):
+        return len(self.samples.get(stratum, []))
+
+
+    def merge(self, other):
+        """
+            Combine with the reservoir of another part of the same streams. The number of tiles
+            taken from each side is hypergeometric, so the result is a uniform sample of the union.
+        """
+        for stratum, other_samples in other.samples.items():
+            samples = self.samples.get(stratum, [])
+            offered = self.offered.get(stratum, 0)
+            other_offered = other.offered[stratum]
+            n_samples = min(self.size, offered + other_offered)
+
+            n_self = self.rng.hypergeometric(offered, other_offered, n_samples) if offered > 0 else 0
+            keep_self = self.rng.choice(len(samples), n_self, replace=False)
+            keep_other = self.rng.choice(len(other_samples), n_samples - n_self, replace=False)
+
+            self.samples[stratum] = [samples[i] for i in keep_self] + [other_samples[i] for i in keep_other]
+            self.offered[stratum] = offered + other_offered
+
+
+    def statistics(self):
+        """
+            Returns:
+                - A LabStatistics of every sampled tile
+        """
+        stats = LabStatistics()
+        for samples in self.samples.values():
+            for mean, std, n in samples:
+                stats.update(mean, std, n)
+        return stats
+
+
+class Normalizer:
+    def __init__(self, sample_size=None, seed=None, backend="skimage"):
+        """
+            Args:
+                - sample_size: Fit a reservoir sample of this many tiles from each stratum (slide
+                               and magnification) instead of every tile
+                - seed: The seed of the reservoir sampling
+                - backend: The RGB <-> LAB conversion backend, "skimage" (float64, the reference)
+                           or "fast" (float32 with lookup tables). bench_lab.py compares their
+                           speed and accuracy.
+        """
+        lab_converter(backend)
+        self.stats = LabStatistics()
+        self.target = None
+        self.source = None
+        self.sample_size = sample_size
+        self.seed = seed
+        self.backend = backend
+        self.reservoir = TileReservoir(sample_size, seed, backend) if sample_size is not None else None
+
+
+    def fit_tile(self, tile_array, stratum=None):
+        """
+            Fit a tile, or offer it to the reservoir sample of its stratum in sampling mode.
+        """
+        if self.reservoir is not None:
+            self.reservoir.offer(stratum, tile_array)
+        else:
+            self.stats.update(*tile_statistics(tile_array, self.backend))
+        self.target = None
 
-        self.means = np.append(self.means, [[np.mean(lab[:,:,i]) for i in range(3)]], axis=0)
-        self.stds = np.append(self.stds, [[np.std(lab[:,:,i]) for i in range(3)]], axis=0)
-        self.size = np.append(self.size, [[lab[:, :, i].shape[0] * lab[:, :, i].shape[1] for i in range(3)]], axis=0)
+
+    def spawn(self, key=None):
+        """
+            Returns:
+                - An empty Normalizer with the same sampling settings, e.g. for a worker process
+                  task. The key is mixed into the seed so each task samples independently.
+        """
+        seed = self.seed if self.seed is None or key is None else [self.seed, key]
+        return Normalizer(self.sample_size, seed, self.backend)
+
+
+    def merge(self, other):
+        """
+            Add the tile statistics collected by another Normalizer, e.g. in a worker process.
+        """
+        if self.reservoir is not None and other.reservoir is not None:
+            self.reservoir.merge(other.reservoir)
+        else:
+            self.stats.merge(other.stats)
+        self.target = None
+
+
+    def freeze(self):
+        """
+            Compute the target statistics once so they are not recomputed for every tile.
+            Fitting more tiles clears the frozen target. In sampling mode the statistics are
+            those of the tiles in the reservoir.
+
+            Returns:
+                - The target (mu, sig) of each LAB channel
+        """
+        if self.reservoir is not None and len(self.reservoir.samples) > 0:
+            self.stats = self.reservoir.statistics()
+        self.target = self.stats.target()
+        return self.target
+
+
+    def save(self, path):
+        """
+            Save the fitted statistics and the target they give to a JSON file, or to the
+            normalizer_stats attribute of an .h5 file.
+        """
+        mu, sig = self.freeze()
+        state = {"stats": self.stats.to_dict(), "mu": mu.tolist(), "sig": sig.tolist()}
+
+        if path.endswith(".h5"):
+            with h5py.File(path, 'a') as set_hdf5_file:
+                set_hdf5_file.attrs["normalizer_stats"] = json.dumps(state)
+        else:
+            with open(path, "w") as stats_file:
+                json.dump(state, stats_file, indent=4)
+
+
+    @classmethod
+    def load(cls, path, backend="skimage"):
+        """
+            Load a Normalizer saved with Normalizer.save. The loaded target is used as is, so
+            later builds need not scan the data again.
+        """
+        if path.endswith(".h5"):
+            with h5py.File(path, 'r') as set_hdf5_file:
+                if "normalizer_stats" not in set_hdf5_file.attrs:
+                    raise ValueError(f"{path} holds no normalizer statistics.")
+                state = json.loads(set_hdf5_file.attrs["normalizer_stats"])
+        else:
+            with open(path) as stats_file:
+                state = json.load(stats_file)
+
+        normalizer = cls(backend=backend)
+        normalizer.stats = LabStatistics.from_dict(state["stats"])
+        normalizer.freeze()
+        normalizer.source = os.path.abspath(path)
+        return normalizer
+
+
+    def record(self, h5_group):
+        """
+            Mark a slide group as normalized and store the target statistics that were used.
+        """
+        mu, sig = self.freeze()
+        h5_group.attrs["normalized"] = True
+        h5_group.attrs["normalizer_mu"] = mu
+        h5_group.attrs["normalizer_sig"] = sig
+        h5_group.attrs["normalizer_tiles"] = self.stats.tiles
+        h5_group.attrs["normalizer_source"] = self.source or "fit"
+        h5_group.attrs["normalizer_backend"] = self.backend
 
     
-    def fit_h5_set(self, h5_set):
+    def fit_h5_set(self, h5_set, block_size=64):
+        """
+            Fit every accepted tile of a set, reading blocks of tiles aligned to the HDF5 chunks.
+            In sampling mode only sample_size randomly chosen tiles of each zoom level are read.
+
+            Returns:
+                - The number of tiles and bytes read
+        """
+        n_tiles, n_bytes = 0, 0
         for patient_image in h5_set["images"].values():
             print(f"\rFitting {patient_image.name[1:]}", end="")
-            for zoom in patient_image.values():
-                num_images = zoom["images"].shape[0]
-                for i in range(num_images):
-                    self.fit_tile(zoom["images"][i]) 
+            for zoom in zoom_groups(patient_image):
+                images = zoom["images"]
 
+                if self.reservoir is not None:
+                    index = self.reservoir.rng.choice(images.shape[0], min(self.sample_size, images.shape[0]), replace=False)
+                    tiles = images[np.sort(index)]
+                    for tile in tiles:
+                        self.fit_tile(tile, zoom.name)
+                    n_tiles += len(tiles)
+                    n_bytes += tiles.nbytes
+                    continue
 
-    def fit_dir(self, current_path):
-        print("Fitting directory...")
-        for filename in os.listdir(current_path):
-            if filename.endswith(".h5"):
-                set_hdf5_path = os.path.join(current_path, filename)
-                set_hdf5_file = h5py.File(set_hdf5_path, 'r+')
+                step = aligned_block_size(images, block_size)
 
-                self.fit_h5_set(set_hdf5_file)
+                for start in range(0, images.shape[0], step):
+                    tiles = images[start:start+step]
+                    for tile in tiles:
+                        self.fit_tile(tile)
+                    n_tiles += len(tiles)
+                    n_bytes += tiles.nbytes
 
+        return n_tiles, n_bytes
 
-    def normalize_tile(self, tile):
+
+    def fit_dir(self, current_path, block_size=64, workers=1):
         """
-        sig = sum[ (n_i - 1)sig_i + n_i(y_bar_i - y_bar)^2 ]/ sum[ n_i ]-1
+            Fit every .h5 file in a directory.
+
+            Args:
+                - current_path: The directory holding the train/val/test files
+                - block_size: The number of tiles read at once
+                - workers: The number of processes. Each reads blocks of tiles from the file in
+                           read-only mode and returns its partial statistics, which are merged.
+                           Sampling mode reads few tiles and always runs in this process.
         """
-        if self.means.shape == (0,3) or self.stds.shape == (0,3) or self.size.shape == (0,3):
-            raise Exception("Normalizer has not been fit yet.")
+        print("Fitting directory...")
+        pool = mp.Pool(workers) if workers > 1 and self.reservoir is None else None
+
+        try:
+            for filename in sorted(os.listdir(current_path)):
+                if filename.endswith(".h5"):
+                    set_hdf5_path = os.path.join(current_path, filename)
+                    start_time = time.perf_counter()
 
-        total_n = np.sum(self.size, axis=0)
-        weighted_avg = np.sum(np.multiply(self.size, self.means), axis=0)/ total_n
-        
-        sig_2 = np.sum(np.multiply(self.size-1, self.stds) + np.multiply(self.size, (self.means - weighted_avg)**2), axis=0)/total_n
-        
-        sig = np.sqrt(sig_2)
+                    if pool is None:
+                        with h5py.File(set_hdf5_path, 'r') as set_hdf5_file:
+                            n_tiles, n_bytes = self.fit_h5_set(set_hdf5_file, block_size)
+                    else:
+                        with h5py.File(set_hdf5_path, 'r') as set_hdf5_file:
+                            tasks = [(set_hdf5_path, self.backend) + block for block in image_blocks(set_hdf5_file, block_size)]
 
-        mu = np.mean(self.means, axis=0)
+                        n_tiles, n_bytes = 0, 0
+                        for stats, block_tiles, block_bytes in pool.imap_unordered(_fit_block, tasks):
+                            self.stats.merge(stats)
+                            n_tiles += block_tiles
+                            n_bytes += block_bytes
+
+                    print(f"\rFitted {filename} | {format_throughput(n_tiles, n_bytes, time.perf_counter() - start_time)}")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+
+    def normalize_tile(self, tile):
+        if self.target is None:
+            self.freeze()
+        mu, sig = self.target
 
         # print(tile.shape)
-        lab = color.rgb2lab(tile)
+        converter = lab_converter(self.backend)
+        lab = converter.rgb2lab(tile)
 
         t_mean = [0,0,0]
         t_std  = [1,1,1]
@@ -76,30 +459,137 @@ class Normalizer:
                 tmp[tmp>=127] = 127
                 lab[:,:,i] = tmp
 
-        return (color.lab2rgb(lab)*255).astype(np.uint8)
+        return converter.lab2rgb(lab)
 
 
-    def normalize_h5_set(self, h5_set):
-        for patient_image in h5_set["images"].values():
-            print(f"\rNormalizing {patient_image.name[1:]}", end="")
-            for zoom in patient_image.values():
-                num_images = zoom["images"].shape[0]
-                for i in range(num_images):
-                    zoom["images"][i] = self.normalize_tile(zoom["images"][i])       
+    def normalize_tiles(self, tiles):
+        """
+            Normalize an (N, H, W, 3) stack of tiles. The colour conversions run tile by tile: the LAB
+            copy of a whole block does not fit in cache, and bench_lab.py measures the vectorized
+            whole block version (normalize_block) at 1.7x slower with skimage and 3x with fast.
+        """
+        out = np.empty_like(tiles)
+        for i in range(len(tiles)):
+            out[i] = self.normalize_tile(tiles[i])
+
+        return out
+
+
+    def normalize_h5_set(self, h5_set, block_size=64, pool=None, window=2):
+        """
+            Normalize every accepted tile of a set in place, reading and writing blocks of tiles
+            aligned to the HDF5 chunks of the images dataset.
+
+            Args:
+                - h5_set: An opened train/val/test HDF5 file
+                - block_size: The number of tiles normalized at once, rounded down to a whole
+                              number of chunks
+                - pool: A multiprocessing pool started with init_worker. Blocks are sent to the
+                        pool to be normalized while this process stays the only reader and
+                        writer of the file.
+                - window: The maximum number of blocks in flight in the pool
+
+            Returns:
+                - The number of tiles and bytes normalized
+        """
+        n_tiles, n_bytes = 0, 0
+        pending = collections.deque()
+
+        def write_oldest():
+            name, start, end, result = pending.popleft()
+            h5_set[name][start:end] = result.get()
+
+        # Slides tiled with normalize_on_write, or normalized by an earlier run, are skipped
+        slides = [patient_image for patient_image in h5_set["images"].values()
+                  if not patient_image.attrs.get("normalized", False)]
+
+        for name, start, end in image_blocks(h5_set, block_size, slides):
+            print(f"\rNormalizing {name}", end="")
+            tiles = h5_set[name][start:end]
+            n_tiles += len(tiles)
+            n_bytes += tiles.nbytes
+
+            if pool is None:
+                h5_set[name][start:end] = self.normalize_tiles(tiles)
+            else:
+                pending.append((name, start, end, pool.apply_async(_normalize_block, (tiles,))))
+                if len(pending) >= window:
+                    write_oldest()
 
+        while len(pending) > 0:
+            write_oldest()
 
-    def normalize_dir(self, current_path):
+        for patient_image in slides:
+            self.record(patient_image)
+
+        return n_tiles, n_bytes
+
+
+    def normalize_dir(self, current_path, block_size=64, workers=1):
+        """
+            Normalize every .h5 file in a directory in place.
+
+            Args:
+                - current_path: The directory holding the train/val/test files
+                - block_size: The number of tiles normalized at once
+                - workers: The number of processes normalizing blocks. Each file is only opened by
+                           this process, which reads the blocks and writes the results back.
+        """
         print("Starting normalization...")
-        for filename in os.listdir(current_path):
-            if filename.endswith(".h5"):
-                set_hdf5_path = os.path.join(current_path, filename)
-                set_hdf5_file = h5py.File(set_hdf5_path, 'r+')
+        self.freeze()
+        pool = mp.Pool(workers, initializer=init_worker, initargs=(self,)) if workers > 1 else None
+
+        try:
+            for filename in sorted(os.listdir(current_path)):
+                if filename.endswith(".h5"):
+                    set_hdf5_path = os.path.join(current_path, filename)
+                    start_time = time.perf_counter()
+
+                    with h5py.File(set_hdf5_path, 'r+') as set_hdf5_file:
+                        n_tiles, n_bytes = self.normalize_h5_set(set_hdf5_file, block_size, pool, 2 * workers)
+
+                    print(f"\rNormalized {filename} | {format_throughput(n_tiles, n_bytes, time.perf_counter() - start_time)}")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
-                self.normalize_h5_set(set_hdf5_file)
+
+_WORKER_NORMALIZER = None
+
+def init_worker(normalizer):
+    """
+        Pool initializer storing the fitted normalizer in each worker process.
+    """
+    global _WORKER_NORMALIZER
+    _WORKER_NORMALIZER = normalizer
+
+
+def _normalize_block(tiles):
+    return _WORKER_NORMALIZER.normalize_tiles(tiles)
+
+
+def _fit_block(task):
+    set_hdf5_path, backend, name, start, end = task
+    with h5py.File(set_hdf5_path, 'r') as set_hdf5_file:
+        tiles = set_hdf5_file[name][start:end]
+
+    # Blocks are fit with the backend of the normalizer, as in the serial path
+    normalizer = Normalizer(backend=backend)
+    for tile in tiles:
+        normalizer.fit_tile(tile)
+
+    return normalizer.stats, len(tiles), tiles.nbytes
 
 
 if __name__ == "__main__":
-    parser = OptionParser(usage='Usage: %prog <tile_dir>')
+    parser = OptionParser(usage='Usage: %prog <tile_dir> [options]')
+    parser.add_option('-b', '--block_size', dest='block_size', type='int', default=64, help='Number of tiles normalized at once, default=64')
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=1, help='Number of processes used to fit and normalize, default=1')
+    parser.add_option('-n', '--sample_size', dest='sample_size', type='int', default=None, help='Fit a random sample of this many tiles per slide and magnification, default=every tile')
+    parser.add_option('--stats', dest='stats_path', type='string', default=None, help='Statistics file (.json, or the attributes of an .h5 file) loaded if it exists, otherwise saved after fitting')
+    parser.add_option('--seed', dest='seed', type='int', default=None, help='Seed for the sampled fit, default=None')
+    parser.add_option('--backend', dest='backend', type='choice', choices=list(BACKENDS), default='skimage', help='RGB/LAB conversion backend: skimage or fast, default=skimage')
     (opts, args) = parser.parse_args()
 
     try:
@@ -107,6 +597,12 @@ if __name__ == "__main__":
     except IndexError:
         parser.error('Missing tile directory argument')
 
-    normalizer = Normalizer()
-    normalizer.fit_dir(tile_dir)
-    normalizer.normalize_dir(tile_dir)
\ No newline at end of file
+    if opts.stats_path is not None and os.path.isfile(opts.stats_path):
+        normalizer = Normalizer.load(opts.stats_path, opts.backend)
+    else:
+        normalizer = Normalizer(opts.sample_size, opts.seed, opts.backend)
+        normalizer.fit_dir(tile_dir, opts.block_size, opts.workers)
+        if opts.stats_path is not None:
+            normalizer.save(opts.stats_path)
+
+    normalizer.normalize_dir(tile_dir, opts.block_size, opts.workers)
\ No newline at end of file
@@ -0,0 +1,373 @@
+import collections
+import contextlib
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing.shared_memory import SharedMemory
+
+import h5py
+import numpy as np
+
+from tile import Tile, create_slide_group, save_grid
+from tile_writer import merge_write_stats, format_write_stats
+from tissue_filter import merge_filter_stats, format_filter_stats
+
+
+def _slot_view(slot, batch_size, size):
+    return np.ndarray((batch_size, size, size, 3), dtype=np.uint8, buffer=slot.buf)
+
+
+def _tile_worker(task_queue, result_queue, free_slots, slot_names, batch_size, tile_kwargs, normalizer):
+    """
+        Worker process: read and filter bands of tiles and stream them to the writer through the
+        shared memory slots. Accepted tiles either fit a per task copy of the normalizer or, with
+        normalize_on_write, are normalized with its frozen target.
+    """
+    np.random.seed()
+    slots = [SharedMemory(name=name) for name in slot_names]
+    # The last slides opened and their tissue masks, as consecutive tasks usually share a slide
+    opened = collections.OrderedDict()
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        task_id, slide_loc, mask_path, level, row_start, row_end = task
+        try:
+            if slide_loc not in opened:
+                tissue_mask = None
+                if mask_path is not None:
+                    with open(mask_path, "rb") as mask_file:
+                        tissue_mask = pickle.load(mask_file)
+                opened[slide_loc] = (Tile(slide_loc, None, normalizer=normalizer, **tile_kwargs), tissue_mask)
+                if len(opened) > 2:
+                    opened.popitem(last=False)
+            tile, tissue_mask = opened[slide_loc]
+
+            if normalizer is not None and not tile.normalize_on_write:
+                tile.normalizer = normalizer.spawn(task_id)
+            # Pyramid tasks cover a band of rows of the highest magnification and every level below
+            if tile.pyramid:
+                counts = {}
+                tiles = tile.iter_pyramid(row_start, row_end, tissue_mask, counts)
+            else:
+                counts = {level: {"skipped": 0}}
+                tiles = ((level,) + entry for entry in tile.iter_tiles(level, row_start, row_end, tissue_mask, counts[level]))
+
+            slot, view, kinds, positions = None, None, [], []
+
+            for tile_level, keep, tile_array, position in tiles:
+                for dataset, array, array_position in tile.outputs(keep, tile_array, position, tile_level):
+                    if slot is None:
+                        slot = free_slots.get()
+                        view = _slot_view(slots[slot], batch_size, tile.size)
+
+                    view[len(positions)] = array
+                    kinds.append((tile_level, dataset))
+                    positions.append(array_position)
+
+                    if len(positions) == batch_size:
+                        result_queue.put(("batch", task_id, slot, kinds, positions))
+                        slot, view, kinds, positions = None, None, [], []
+
+            if slot is not None:
+                result_queue.put(("batch", task_id, slot, kinds, positions))
+
+            task_normalizer = None if tile.normalize_on_write else tile.normalizer
+            skipped = {level: level_counts["skipped"] for level, level_counts in counts.items()}
+            result_queue.put(("done", task_id, skipped, task_normalizer, tile.tissue_filter.reset_stats()))
+        except Exception:
+            result_queue.put(("error", task_id, traceback.format_exc()))
+
+    for slot in slots:
+        slot.close()
+
+
+def _feed_slides(slides, ready):
+    """
+        Feeder thread: pass the slides on to the writer as they become available, e.g. as
+        DownloadManager.prefetch finishes downloading them.
+    """
+    try:
+        for slide in slides:
+            ready.put(("slide", slide))
+        ready.put(("end", None))
+    except BaseException as error:
+        ready.put(("error", error))
+
+
+def tile_slides(slides, workers=4, normalizer=None, ignore_repeat=False, ordered=False,
+                band_rows=8, batch_size=64, n_slots=None, on_slide_done=None, **tile_kwargs):
+    """
+        Tile a number of slides with a pool of worker processes. The workers each open their own
+        OpenSlide handles and send the accepted and rejected tiles through shared memory to this
+        process, which is the only one writing to the HDF5 files.
+
+        Slides are taken from slides as they become available, so a single pool tiles a whole set
+        while the later slides are still downloading. The bands of the next slide are queued once
+        fewer than 2*workers tasks are in flight, so the workers move on to it while the last
+        bands of the previous slide finish. The tissue mask of each slide is built once, here.
+
+        Args:
+            - slides: An iterable of (slide_loc, target) pairs, where target is the HDF5 group
+                      holding the slides of a set, or a context manager yielding it, such as
+                      open_shard, which is entered when the first tasks of the slide are queued
+                      and exited once the slide has been written
+            - workers: The number of worker processes
+            - normalizer: A Normalizer fit with the statistics of every accepted tile, or with
+                          normalize_on_write in tile_kwargs the fitted Normalizer applied to them
+            - ignore_repeat: Automatically overwrte repeated files in the dataset
+            - ordered: Write the tiles in the same order as a serial run. Tiles of bands that finish
+                       early are held in memory until the earlier bands have been written.
+            - band_rows: The number of tile rows in each task. With pyramid in tile_kwargs it is
+                         rounded up so every task builds whole rows of the lowest level.
+            - batch_size: The number of tiles in each shared memory slot
+            - n_slots: The number of shared memory slots, default=4*workers
+            - on_slide_done: Called with the slide_loc of every slide once it has been written,
+                             e.g. to release it from a DownloadManager
+            - tile_kwargs: Keyword arguments passed to Tile, e.g. background, size or seed
+
+        Returns:
+            - The combined write statistics of all slides
+            - The combined filter stage statistics of all slides
+    """
+    size = tile_kwargs.get("size", 255)
+    n_slots = n_slots or 4 * workers
+    normalize_on_write = tile_kwargs.get("normalize_on_write", False)
+    if normalize_on_write and normalizer is not None:
+        normalizer.freeze()
+
+    tasks = []
+    units = {}
+    slide_groups = {}
+    write_stats = merge_write_stats()
+    filter_stats = merge_filter_stats()
+    mask_dir = tempfile.mkdtemp(prefix="tile_masks_")
+
+    ctx = mp.get_context()
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    free_slots = ctx.Queue()
+
+    slots = [SharedMemory(create=True, size=batch_size * size * size * 3) for _ in range(n_slots)]
+    for slot in range(n_slots):
+        free_slots.put(slot)
+
+    processes = [
+        ctx.Process(target=_tile_worker,
+                    args=(task_queue, result_queue, free_slots, [slot.name for slot in slots], batch_size,
+                          tile_kwargs, normalizer),
+                    daemon=True)
+        for _ in range(workers)
+    ]
+
+    def schedule_slide(slide_loc, target):
+        """
+            Create the group and datasets of a slide in the writer, build its tissue mask and
+            queue the bands of the slide.
+        """
+        slide_index = len(slide_groups)
+        slide = slide_groups[slide_index] = {"loc": slide_loc, "stack": contextlib.ExitStack(), "group": None,
+                                             "levels": 0, "total": 0, "skipped": 0, "mask_path": None}
+        set_hdf5_file = target if isinstance(target, h5py.Group) else slide["stack"].enter_context(target)
+
+        tile = Tile(slide_loc, None, normalizer=normalizer, **tile_kwargs)
+        slide["group"] = create_slide_group(set_hdf5_file, tile.file_name, ignore_repeat)
+        if slide["group"] is None:
+            return finish_slide(slide_index)
+
+        tissue_mask = tile.tissue_mask()
+        if tissue_mask is not None:
+            tissue_mask.save(slide["group"])
+            slide["mask_path"] = os.path.join(mask_dir, f"{slide_index}.pkl")
+            with open(slide["mask_path"], "wb") as mask_file:
+                pickle.dump(tissue_mask, mask_file)
+
+        for level, this_mag, cols, rows in tile.levels():
+            zoom_hdf5 = slide["group"].create_group(str(this_mag))
+            units[(slide_index, level)] = {"zoom": zoom_hdf5, "writers": tile._create_writers(zoom_hdf5, level, this_mag),
+                                           "remaining": 0, "cols": cols, "rows": rows, "total": cols * rows, "skipped": 0}
+            slide["levels"] += 1
+
+        # Each entry of bands is (level read, its rows, levels written)
+        if tile.pyramid:
+            chain = tile.pyramid_levels()
+            bands = [] if len(chain) == 0 else [(chain[0][0], chain[0][3], [level for level, _, _, _ in tile.levels()])]
+            step = pow(2, len(chain) - 1)
+            task_rows = -(-band_rows // step) * step
+        else:
+            bands = [(level, rows, [level]) for level, _, _, rows in tile.levels()]
+            task_rows = band_rows
+
+        first_task = len(tasks)
+        for level, rows, unit_levels in bands:
+            for row_start in range(0, rows, task_rows):
+                row_end = min(row_start + task_rows, rows)
+                task = (len(tasks), slide_loc, slide["mask_path"], level, row_start, row_end)
+                tasks.append((slide_index, unit_levels, task))
+                task_queue.put(task)
+                for unit_level in unit_levels:
+                    units[(slide_index, unit_level)]["remaining"] += 1
+
+        if len(tasks) == first_task:
+            # Nothing to read, e.g. no level of the slide has any rows
+            unit_keys = [key for key in units if key[0] == slide_index]
+            for unit_key in unit_keys:
+                units[unit_key]["remaining"] = 1
+                finish_unit(unit_key, 0)
+            if len(unit_keys) == 0:
+                finish_slide(slide_index)
+
+    def finish_slide(slide_index):
+        slide = slide_groups[slide_index]
+        if slide["group"] is not None:
+            slide["group"].attrs["tiles_total"] = slide["total"]
+            slide["group"].attrs["tiles_skipped"] = slide["skipped"]
+            if normalize_on_write:
+                normalizer.record(slide["group"])
+
+        slide["stack"].close()
+        if slide["mask_path"] is not None:
+            os.remove(slide["mask_path"])
+        if on_slide_done is not None:
+            on_slide_done(slide["loc"])
+
+    def write_batch(task_id, tiles, kinds, positions):
+        slide_index = tasks[task_id][0]
+        for i, (level, dataset) in enumerate(kinds):
+            units[(slide_index, level)]["writers"][dataset].add(tiles[i], positions[i])
+
+    def finish_task(task_id, skipped, task_normalizer, task_filter_stats):
+        nonlocal filter_stats
+        filter_stats = merge_filter_stats(filter_stats, task_filter_stats)
+
+        if task_normalizer is not None and normalizer is not None:
+            normalizer.merge(task_normalizer)
+
+        slide_index, unit_levels, _ = tasks[task_id]
+        return merge_write_stats(*[finish_unit((slide_index, level), skipped.get(level, 0)) for level in unit_levels])
+
+    def finish_unit(unit_key, skipped):
+        unit = units[unit_key]
+        unit["skipped"] += skipped
+        unit["remaining"] -= 1
+
+        if unit["remaining"] == 0:
+            for writer in unit["writers"].values():
+                writer.close()
+            save_grid(unit["zoom"], unit["cols"], unit["rows"])
+            unit["zoom"].attrs["tiles_total"] = unit["total"]
+            unit["zoom"].attrs["tiles_skipped"] = unit["skipped"]
+
+            slide = slide_groups[unit_key[0]]
+            slide["total"] += unit["total"]
+            slide["skipped"] += unit["skipped"]
+            slide["levels"] -= 1
+            if slide["levels"] == 0:
+                finish_slide(unit_key[0])
+
+            return merge_write_stats(*[writer.stats() for writer in unit["writers"].values()])
+
+        return merge_write_stats()
+
+    start_time = time.perf_counter()
+    for process in processes:
+        process.start()
+
+    ready = queue.Queue(maxsize=1)
+    threading.Thread(target=_feed_slides, args=(slides, ready), daemon=True).start()
+
+    try:
+        # In ordered mode tiles of tasks after next_task are copied out of their slot and held
+        # in pending until every earlier task is done
+        next_task = 0
+        pending = {}
+        finished = {}
+        n_done = 0
+        feeding = True
+
+        while feeding or n_done < len(tasks):
+            # Queue the next slide once the tasks in flight run low, waiting for it if the pool is idle
+            while feeding and len(tasks) - n_done < 2 * workers:
+                try:
+                    kind, item = ready.get(block=n_done == len(tasks))
+                except queue.Empty:
+                    break
+
+                if kind == "error":
+                    raise item
+                elif kind == "end":
+                    feeding = False
+                else:
+                    schedule_slide(*item)
+
+            if n_done == len(tasks):
+                continue
+
+            try:
+                message = result_queue.get(timeout=0.1 if feeding else None)
+            except queue.Empty:
+                continue
+            kind, task_id = message[0], message[1]
+
+            if kind == "error":
+                raise RuntimeError(f"Tiling task {tasks[task_id][2]} failed:\n{message[2]}")
+
+            elif kind == "batch":
+                _, _, slot, kinds, positions = message
+                tiles = _slot_view(slots[slot], batch_size, size)[:len(positions)]
+
+                if not ordered or task_id == next_task:
+                    write_batch(task_id, tiles, kinds, positions)
+                else:
+                    pending.setdefault(task_id, []).append((tiles.copy(), kinds, positions))
+                free_slots.put(slot)
+
+            elif kind == "done":
+                n_done += 1
+
+                if not ordered:
+                    write_stats = merge_write_stats(write_stats, finish_task(task_id, *message[2:]))
+                else:
+                    finished[task_id] = message[2:]
+                    while next_task in finished:
+                        write_stats = merge_write_stats(write_stats, finish_task(next_task, *finished.pop(next_task)))
+                        next_task += 1
+
+                        # The new next task may already have sent batches which are held in pending
+                        for batch in pending.pop(next_task, []):
+                            write_batch(next_task, *batch)
+
+            print(f"\rTiling {len(slide_groups)} slides with {workers} workers | {n_done}/{len(tasks)} tasks", end="")
+
+        for _ in range(workers):
+            task_queue.put(None)
+        for process in processes:
+            process.join()
+    except BaseException as error:
+        # Slides still being written are closed with the error, so their shards are discarded
+        for slide in slide_groups.values():
+            slide["stack"].__exit__(type(error), error, error.__traceback__)
+        raise
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for slot in slots:
+            slot.close()
+            slot.unlink()
+        shutil.rmtree(mask_dir, ignore_errors=True)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"\rTiled {len(slide_groups)} slides with {workers} workers in {elapsed:.1f}s | "
+          f"{format_write_stats(write_stats)}")
+    print(f"Filter stages | {format_filter_stats(filter_stats)}")
+
+    return write_stats, filter_stats
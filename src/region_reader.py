@@ -0,0 +1,139 @@
+import collections
+import math
+
+import numpy as np
+import openslide
+from PIL import Image
+
+
+class RegionReader:
+    """
+        This class serves DeepZoom tiles out of large regions of the slide, each read with a single
+        read_region call, instead of one read_region call per tile.
+
+        A region covers a block of region_cols x region_rows tiles. The block is read at the slide
+        level DeepZoomGenerator.get_tile would read, composited on the slide background once if it
+        is not fully opaque and kept as a single NumPy array. Tiles which need no resizing are
+        returned as views of that array; the others are cropped out of it and resized exactly as
+        get_tile does, so every tile is byte-identical to get_tile. Blocks whose tiles do not
+        start on whole pixels of the slide level are read tile by tile with get_tile.
+    """
+
+    def __init__(self, slide, dz, region_cols=16, region_rows=1, max_region_pixels=1 << 24, cache_blocks=4):
+        """
+            Args:
+                - slide: The OpenSlide object the DeepZoomGenerator reads from
+                - dz: The DeepZoomGenerator
+                - region_cols: The number of tile columns read together
+                - region_rows: The number of tile rows read together. With more than one row, a
+                               whole row of blocks is kept in memory so it should stay small.
+                - max_region_pixels: The maximum number of slide pixels in a region. Blocks of
+                                     levels read from a much larger area of the slide have fewer
+                                     columns.
+                - cache_blocks: The number of blocks kept in memory with a single row per block,
+                                which should cover the reject samples of background tiles read
+                                after each filter batch
+        """
+        if region_cols < 1 or region_rows < 1:
+            raise ValueError("region_cols and region_rows must be at least 1.")
+
+        self.slide = slide
+        self.dz = dz
+        self.region_cols = region_cols
+        self.region_rows = region_rows
+        self.max_region_pixels = max_region_pixels
+        self.cache_blocks = cache_blocks
+        self.bg_color = '#' + slide.properties.get(openslide.PROPERTY_NAME_BACKGROUND_COLOR, 'ffffff')
+
+        self.blocks = collections.OrderedDict()
+        self.block_cols = {}
+        self.regions_read = 0
+        self.tiles_read = 0
+
+
+    def _level_block_cols(self, level):
+        """
+            The number of tile columns in the blocks of a level, limited by max_region_pixels.
+        """
+        if level not in self.block_cols:
+            _, _, (width, height) = self.dz.get_tile_coordinates(level, (0, 0))
+            per_tile = max(width * height * self.region_rows, 1)
+            self.block_cols[level] = max(1, min(self.region_cols, self.max_region_pixels // per_tile))
+
+        return self.block_cols[level]
+
+
+    def _read_block(self, level, block_col, block_row):
+        """
+            Returns:
+                - The block covering the tiles, as a dictionary from (col, row) to the view of
+                  the region read for the tile, or None if the tiles cannot be sliced from a
+                  single region
+        """
+        cols, rows = self.dz.level_tiles[level]
+        n_cols = self._level_block_cols(level)
+        positions = [(col, row)
+                     for row in range(block_row * self.region_rows, min((block_row + 1) * self.region_rows, rows))
+                     for col in range(block_col * n_cols, min((block_col + 1) * n_cols, cols))]
+
+        coordinates = [self.dz.get_tile_coordinates(level, position) for position in positions]
+        (x0, y0), slide_level, _ = coordinates[0]
+        downsample = self.slide.level_downsamples[slide_level]
+
+        # Offsets of every tile in the pixels of the slide level
+        offsets = [((x - x0) / downsample, (y - y0) / downsample) for (x, y), _, _ in coordinates]
+        if any(dx != int(dx) or dy != int(dy) for dx, dy in offsets) or (x0 / downsample) != int(x0 / downsample) \
+                or (y0 / downsample) != int(y0 / downsample):
+            return None
+
+        width = max(int(dx) + w for (dx, _), (_, _, (w, _)) in zip(offsets, coordinates))
+        height = max(int(dy) + h for (_, dy), (_, _, (_, h)) in zip(offsets, coordinates))
+
+        image = self.slide.read_region((x0, y0), slide_level, (width, height))
+        region = np.array(image)
+        self.regions_read += 1
+
+        # Compositing only changes pixels which are not fully opaque, e.g. past the slide edge
+        if region[..., 3].min() == 255:
+            region = region[..., :3]
+        else:
+            region = np.array(Image.composite(image, Image.new('RGB', image.size, self.bg_color), image))
+
+        return {position: region[int(dy):int(dy) + h, int(dx):int(dx) + w]
+                for position, (dx, dy), (_, _, (w, h)) in zip(positions, offsets, coordinates)}
+
+
+    def get_tile(self, level, col, row):
+        """
+            Returns:
+                - The (H, W, 3) uint8 tile DeepZoomGenerator.get_tile(level, (col, row)) gives.
+                  The array may be a view of a region and should not be written to.
+        """
+        self.tiles_read += 1
+        key = (level, col // self._level_block_cols(level), row // self.region_rows)
+
+        if key not in self.blocks:
+            self.blocks[key] = self._read_block(level, *key[1:])
+
+            # Blocks of several rows are used again by every row, so a whole row of blocks is kept
+            capacity = self.cache_blocks
+            if self.region_rows > 1:
+                capacity = math.ceil(self.dz.level_tiles[level][0] / self._level_block_cols(level)) + 1
+            while len(self.blocks) > capacity:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(key)
+
+        block = self.blocks[key]
+        if block is None:
+            return np.array(self.dz.get_tile(level, (col, row)))
+
+        # Tiles are resized when first requested, as get_tile does
+        tile = block[(col, row)]
+        width, height = self.dz.get_tile_dimensions(level, (col, row))
+        if tile.shape[:2] != (height, width):
+            image = Image.fromarray(tile)
+            image.thumbnail((width, height), getattr(Image, 'Resampling', Image).LANCZOS)
+            tile = block[(col, row)] = np.array(image)
+
+        return tile
@@ -0,0 +1,156 @@
+import contextlib
+import os
+from optparse import OptionParser
+
+import h5py
+import numpy as np
+
+
+SHARD_DIR = "shards"
+SPLITS = ("train", "val", "test")
+
+
+def split_shard_dir(output_dir, split):
+    """
+        Returns:
+            - The directory holding the slide shards of a split, e.g. <output_dir>/shards/train
+    """
+    return os.path.join(output_dir, SHARD_DIR, split)
+
+
+def shard_path(shard_dir, file_name):
+    return os.path.join(shard_dir, file_name + ".h5")
+
+
+def completed_shards(shard_dir):
+    """
+        Returns:
+            - The sorted names of the slides whose shards were written in full
+    """
+    if not os.path.isdir(shard_dir):
+        return []
+
+    return sorted(name[:-3] for name in os.listdir(shard_dir) if name.endswith(".h5"))
+
+
+@contextlib.contextmanager
+def open_shard(shard_dir, file_name):
+    """
+        Open the shard of a slide for writing. The shard has the layout of a set file, with the
+        slide group under images, and is written to <slide>.h5.part, which is only renamed to
+        <slide>.h5 once the slide has been written. A crash leaves no partial shard behind and
+        only the slide being written has to be tiled again.
+
+        Yields:
+            - The images group of the shard, to pass to Tile or tile_slides as the set
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    path = shard_path(shard_dir, file_name)
+    part_path = path + ".part"
+
+    shard_h5 = h5py.File(part_path, "w")
+    try:
+        yield shard_h5.require_group("images")
+    except BaseException:
+        shard_h5.close()
+        os.remove(part_path)
+        raise
+
+    shard_h5.close()
+    os.replace(part_path, path)
+
+
+def stitch_shards(set_hdf5_file, shard_dir, datasets=("images",)):
+    """
+        Make a set file the manifest of the shards of its split. Every shard is linked into the
+        images group of the set with an HDF5 external link, so readers of the set see the same
+        layout as with unsharded files, and links to shards which no longer exist are removed.
+
+        The accepted tiles of every magnification are also exposed as a single virtual dataset,
+        virtual/<magnification>/<dataset>, next to an index table of the slides it holds
+        (virtual/<magnification>/<dataset>_slides) and where each one starts
+        (virtual/<magnification>/<dataset>_offsets). The tables are written per dataset since a
+        slide may hold tiles in one dataset and none in another.
+
+        Args:
+            - set_hdf5_file: The set file, opened for writing
+            - shard_dir: The directory holding the shards of the split
+            - datasets: The tile datasets of each magnification exposed as virtual datasets
+
+        Returns:
+            - The number of linked shards
+    """
+    set_dir = os.path.dirname(os.path.abspath(set_hdf5_file.filename))
+    images = set_hdf5_file.require_group("images")
+    shards = completed_shards(shard_dir)
+
+    for name in list(images.keys()):
+        link = images.get(name, getlink=True)
+        if isinstance(link, h5py.ExternalLink) and not os.path.isfile(os.path.join(set_dir, link.filename)):
+            del images[name]
+
+    for name in shards:
+        if images.get(name, getlink=True) is not None:
+            del images[name]
+        images[name] = h5py.ExternalLink(os.path.relpath(shard_path(shard_dir, name), set_dir), f"/images/{name}")
+
+    # Sources of each (magnification, dataset), in slide order
+    sources = {}
+    for name in sorted(images.keys()):
+        for magnification, zoom in images[name].items():
+            if not isinstance(zoom, h5py.Group):
+                continue
+            for dataset in datasets:
+                if dataset in zoom and zoom[dataset].shape[0] > 0:
+                    sources.setdefault((magnification, dataset), []).append((name, zoom[dataset]))
+
+    if "virtual" in set_hdf5_file:
+        del set_hdf5_file["virtual"]
+
+    for (magnification, dataset), slides in sources.items():
+        tile_shape = slides[0][1].shape[1:]
+        offsets = np.cumsum([0] + [source.shape[0] for _, source in slides])
+        layout = h5py.VirtualLayout(shape=(int(offsets[-1]),) + tile_shape, dtype=slides[0][1].dtype)
+
+        for (name, source), start, end in zip(slides, offsets[:-1], offsets[1:]):
+            file_name = os.path.abspath(source.file.filename)
+            # The set file refers to itself as ".", shards by their path relative to it
+            if file_name == os.path.abspath(set_hdf5_file.filename):
+                file_name = "."
+            else:
+                file_name = os.path.relpath(file_name, set_dir)
+            layout[start:end] = h5py.VirtualSource(file_name, source.name, shape=source.shape)
+
+        zoom = set_hdf5_file.require_group(f"virtual/{magnification}")
+        zoom.create_virtual_dataset(dataset, layout)
+        zoom.create_dataset(f"{dataset}_slides", data=np.array([name for name, _ in slides], dtype="S"))
+        zoom.create_dataset(f"{dataset}_offsets", data=offsets)
+
+    return len(shards)
+
+
+def stitch_dir(output_dir, datasets=("images",)):
+    """
+        Stitch the shards of every split of a dataset directory into its set files, e.g. after
+        shards were written by other processes or nodes, or deleted to be tiled again.
+    """
+    for split in SPLITS:
+        set_path = os.path.join(output_dir, f"{split}.h5")
+        if os.path.isfile(set_path):
+            with h5py.File(set_path, "a") as set_hdf5_file:
+                n_shards = stitch_shards(set_hdf5_file, split_shard_dir(output_dir, split), datasets)
+            print(f"Stitched {n_shards} shards into {set_path}")
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog <output_folder> [options]')
+    parser.add_option('--raw', dest='raw', action="store_true", help='Also expose raw_images as virtual datasets, default=False')
+
+    (opts, args) = parser.parse_args()
+
+    try:
+        output_dir = args[0]
+    except IndexError:
+        parser.error('Missing output directory argument.')
+
+    stitch_dir(output_dir, ("images", "raw_images") if opts.raw else ("images",))
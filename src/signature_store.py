@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+SIGNATURES_CSV = os.path.join("manifest", "TCGA_WES_sigProfiler_SBS_signatures_in_samples.csv")
+
+
+class SignatureStore:
+    """
+        This class holds the mutational signatures of the TCGA samples as a float32 matrix with
+        one row per sample and an index from case id to the first row of the case.
+
+        The CSV is parsed once and cached as an .npz file next to it, which is rebuilt when the
+        size or modification time of the CSV changes.
+    """
+
+    _loaded = {}
+
+    def __init__(self, case_ids, columns, matrix):
+        """
+            Args:
+                - case_ids: The case id of each row
+                - columns: The names of the signatures
+                - matrix: The (rows, signatures) float32 matrix
+        """
+        self.case_ids = np.asarray(case_ids)
+        self.columns = list(columns)
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+
+        # Cases with several samples keep the first one, as the CSV order gives them
+        unique_ids, first_rows = np.unique(self.case_ids, return_index=True)
+        self.index = dict(zip(unique_ids.tolist(), first_rows.tolist()))
+
+
+    @classmethod
+    def from_csv(cls, csv_path):
+        signatures = pd.read_csv(csv_path)
+        case_ids = signatures['Sample Names'].apply(lambda x: '-'.join(x.split('-')[:3])).to_numpy(dtype=str)
+        signatures = signatures.iloc[:, 3:]
+        return cls(case_ids, signatures.columns, signatures.to_numpy(dtype=np.float32))
+
+
+    @classmethod
+    def load(cls, csv_path=SIGNATURES_CSV):
+        """
+            Load the store of a signatures CSV, from the .npz cache next to it when the CSV has
+            not changed since the cache was written. Stores are kept for the rest of the process.
+        """
+        csv_stat = os.stat(csv_path)
+        version = np.array([csv_stat.st_size, csv_stat.st_mtime_ns], dtype=np.int64)
+        key = os.path.abspath(csv_path)
+        if key in cls._loaded and np.array_equal(cls._loaded[key][0], version):
+            return cls._loaded[key][1]
+
+        cache_path = os.path.splitext(csv_path)[0] + ".npz"
+        store = None
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as cache:
+                if np.array_equal(cache["version"], version):
+                    store = cls(cache["case_ids"], cache["columns"].tolist(), cache["matrix"])
+
+        if store is None:
+            store = cls.from_csv(csv_path)
+            temp_path = cache_path + ".tmp.npz"
+            np.savez(temp_path, version=version, case_ids=store.case_ids, columns=np.array(store.columns),
+                     matrix=store.matrix)
+            os.replace(temp_path, cache_path)
+
+        cls._loaded[key] = (version, store)
+        return store
+
+
+    def lookup(self, case_id):
+        """
+            Returns:
+                - The signatures of the first sample of the case as a list, or an empty list if
+                  the case has none
+        """
+        row = self.index.get(case_id)
+        return [] if row is None else self.matrix[row].tolist()
+
+
+    def rows(self, case_ids):
+        """
+            Returns:
+                - The row of each case, or -1 for cases without signatures
+        """
+        return np.array([self.index.get(case_id, -1) for case_id in case_ids], dtype=np.int64)
+
+
+    def to_frame(self):
+        """
+            Returns:
+                - A DataFrame with a column per signature and the case_id of each row
+        """
+        frame = pd.DataFrame(self.matrix, columns=self.columns)
+        frame['case_id'] = self.case_ids
+        return frame
@@ -8,6 +8,7 @@ from openslide import open_slide
 from openslide.deepzoom import DeepZoomGenerator
 from PIL import Image
 import shutil
+import zlib
 
 
 from scipy.ndimage.morphology import binary_fill_holes
@@ -15,119 +16,535 @@ from skimage.color import rgb2gray
 from skimage.feature import canny
 from skimage.morphology import binary_closing, binary_dilation, disk
 
+from tile_writer import TileWriter, merge_write_stats, format_write_stats, storage_options
+from tissue_mask import TissueMask
+from region_reader import RegionReader
+from tissue_filter import TissueFilter, merge_filter_stats, format_filter_stats
+
+def create_slide_group(set_hdf5_file, file_name, ignore_repeat=False):
+    """
+        Create the HDF5 group for a slide, asking before overwriting a slide already in the dataset.
+
+        Args:
+            - set_hdf5_file: The HDF5 group holding the slides of a set
+            - file_name: The name of the slide without its extension
+            - ignore_repeat: Automatically overwrte repeated files in the dataset
+
+        Returns:
+            - The new group, or None if the existing tiles should be kept
+    """
+    proceed = "y"
+
+    if file_name in set_hdf5_file:
+        if not ignore_repeat:
+            print(f"{file_name} is already in the dataset. Do you wish to overwrite these tiles? [y/n]")
+            proceed = input()
+        if proceed == "y":
+            del set_hdf5_file[file_name]
+
+    if proceed == "y":
+        return set_hdf5_file.create_group(file_name)
+
+    return None
+
+
+def save_grid(zoom_hdf5, cols, rows):
+    """
+        Save the grid index of a zoom level: a (rows, cols) int32 array holding the row of the
+        accepted tile at each (col, row) in the images dataset, or -1 where no tile was accepted.
+    """
+    coordinates = zoom_hdf5["coordinates"][:]
+    grid = np.full((rows, cols), -1, dtype=np.int32)
+    grid[coordinates[:, 1], coordinates[:, 0]] = np.arange(len(coordinates), dtype=np.int32)
+
+    return zoom_hdf5.create_dataset("grid", data=grid, compression="gzip")
+
+
 class Tile:
     """
         This class will save tiles of the given H&E stained slide at different zoom levels.
     """
 
     def __init__(self, slide_loc, set_hdf5_file, normalizer=None, background=0.2,
-                 size=255, reject_rate=0.1, ignore_repeat=False):
+                 size=255, reject_rate=0.1, ignore_repeat=False, chunk_size=32, buffer_size=256,
+                 growth=2.0, use_mask=True, mask_downsample=64, seed=None, filter_batch=32,
+                 glass_fraction=0.05, normalize_on_write=False, keep_raw=False, pyramid=False,
+                 magnifications=None, region_cols=16, region_rows=1, slide_cache=None, codec="none",
+                 codec_level=None, byte_shuffle=False):
         """
             Args:
                 - slide_loc: A .svs file of the H&E stained slides
-                - normalizer: A tile normalizer object
+                - set_hdf5_file: The HDF5 group to save the tiles to. If None the slide is only opened.
+                - normalizer: A tile normalizer object, fit with every accepted tile unless
+                              normalize_on_write is set
                 - background: The maximum precentage of background allowed for a saved tile 
                 - size: The width and hight of the tiles at each zoom level
                 - reject_rate: The precentage of rejected tiles to save
                 - ignore_repeat: Automatically overwrte repeated files in the dataset
+                - chunk_size: The number of tiles in each HDF5 chunk of the image datasets
+                - buffer_size: The number of tiles buffered in memory before they are written
+                - growth: The factor the image datasets grow by when they run out of space
+                - use_mask: Skip tiles which do not overlap the thumbnail tissue mask
+                - mask_downsample: The number of level 0 pixels covered by each tissue mask pixel
+                - seed: Seed for sampling rejected tiles. When set, the sample only depends on the
+                        position of each tile, so serial and parallel runs save the same tiles.
+                - filter_batch: The number of tiles read and filtered together
+                - glass_fraction: The fraction of dark pixels below which the first filter stage
+                                  checks a tile against an upper bound of the tissue check,
+                                  0 disables the stage
+                - normalize_on_write: Write accepted tiles already normalized with the target of
+                                      the (fitted) normalizer instead of fitting it
+                - keep_raw: With normalize_on_write, also keep the unnormalized tiles in raw_images
+                - pyramid: Only read the highest saved magnification from the slide and build the
+                           lower ones by 2x2 area downsampling
+                - magnifications: A list of the magnifications to save, default=every level
+                - region_cols, region_rows: The size of the blocks of tiles read from the slide in
+                                            a single region, region_cols=0 reads tile by tile
+                - slide_cache: The size of the OpenSlide tile cache in bytes, default=OpenSlide's
+                - codec: The compression of the image datasets: none, gzip, lzf, blosc or lz4
+                - codec_level: The compression level of gzip or blosc, default=the codec's own
+                - byte_shuffle: Apply the byte shuffle filter before compressing the image datasets
         """
+        self.slide_loc = slide_loc
         self.normalizer = normalizer
         self.background = background
         self.size = size
         self.reject_rate = reject_rate
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.growth = growth
+        self.use_mask = use_mask
+        self.mask_downsample = mask_downsample
+        self.seed = seed
+        self.filter_batch = filter_batch
+        self.normalize_on_write = normalize_on_write
+        self.keep_raw = keep_raw
+        self.pyramid = pyramid
+        self.magnifications = magnifications
+        self.storage = storage_options(codec, codec_level, byte_shuffle)
+        self.tiles_read = 0
+        self.tissue_filter = TissueFilter(1 - background, glass_fraction=glass_fraction)
+        self.filter_stats = merge_filter_stats()
+        self.write_stats = merge_write_stats()
+
+        if normalize_on_write and normalizer is None:
+            raise ValueError("normalize_on_write needs a fitted normalizer.")
 
         self.slide = open_slide(slide_loc)
+        if slide_cache is not None:
+            self.slide.set_cache(openslide.OpenSlideCache(slide_cache))
         self.dz = DeepZoomGenerator(self.slide, size, 0)
+        self.region_reader = None
+        if region_cols > 0:
+            self.region_reader = RegionReader(self.slide, self.dz, region_cols, region_rows)
 
         self.file_name = ".".join(os.path.basename(slide_loc).split(".")[:-1])
         self.tiles = {}
         self.reject_tiles = {}
 
-        proceed = "y"
-
-        if self.file_name in set_hdf5_file:
-            if not ignore_repeat:
-                print(f"{self.file_name} is already in the dataset. Do you wish to overwrite these tiles? [y/n]")
-                proceed = input()
-            if proceed == "y":
-                del set_hdf5_file[self.file_name]
-
-        if proceed == "y":
-            self.h5_group = set_hdf5_file.create_group(self.file_name)
-            self._save_tiles()
-            print()
+        if set_hdf5_file is not None:
+            self.h5_group = create_slide_group(set_hdf5_file, self.file_name, ignore_repeat)
+            if self.h5_group is not None:
+                self._save_tiles()
+                print()
 
 
-    def _create_name_dataset(self, hdf5_file, name):
-        names_db_shape = (0, 1)
-        max_names_db_shape = (None, 1)
-        dt = h5py.special_dtype(vlen=str)
+    def _create_coordinate_dataset(self, hdf5_file, name, level, magnification):
+        coordinate_storage = hdf5_file.create_dataset(name=name, shape=(0, 2), maxshape=(None, 2),
+                                                      chunks=(1024, 2), dtype=np.int32)
+        coordinate_storage.attrs["columns"] = ["col", "row"]
+        coordinate_storage.attrs["level"] = level
+        coordinate_storage.attrs["magnification"] = magnification
 
-        return hdf5_file.create_dataset(name=name, shape=names_db_shape, maxshape=max_names_db_shape, dtype=dt)
+        return coordinate_storage
 
 
     def _create_image_dataset(self, hdf5_file, name, size, n_ch=3):
         img_db_shape = (0, size, size, n_ch)
         max_img_db_shape = (None, size, size, n_ch)
+        chunk_shape = (self.chunk_size, size, size, n_ch)
 
-        return hdf5_file.create_dataset(name=name, shape=img_db_shape, maxshape=max_img_db_shape, dtype=np.uint8)
+        return hdf5_file.create_dataset(name=name, shape=img_db_shape, maxshape=max_img_db_shape,
+                                        chunks=chunk_shape, dtype=np.uint8, **self.storage)
 
 
-    def _save_tiles(self):
+    def _create_writers(self, zoom_hdf5, level, magnification):
         """
-            This function will save all the relevant tiles for a given zoom level.
+            Create the tile datasets of a zoom level and their writers. The position of each tile
+            is stored as an int32 (col, row) in coordinates and reject_coordinates.
 
-            Args:
-                - level: The level of zoom to save
-                - tile_dir: The output directory for this zoom level
+            Returns:
+                - A dictionary from dataset name to TileWriter
+        """
+        img_storage = self._create_image_dataset(zoom_hdf5, 'images', self.size)
+        name_storage = self._create_coordinate_dataset(zoom_hdf5, 'coordinates', level, magnification)
+
+        reject_img_storage = self._create_image_dataset(zoom_hdf5, "reject_images", self.size)
+        reject_name_storage = self._create_coordinate_dataset(zoom_hdf5, "reject_coordinates", level, magnification)
+
+        writers = {
+            "images": TileWriter(img_storage, name_storage, self.buffer_size, self.growth),
+            "reject_images": TileWriter(reject_img_storage, reject_name_storage, self.buffer_size, self.growth)
+        }
 
+        if self.normalize_on_write and self.keep_raw:
+            # Raw tiles share the positions in coordinates
+            raw_img_storage = self._create_image_dataset(zoom_hdf5, "raw_images", self.size)
+            writers["raw_images"] = TileWriter(raw_img_storage, None, self.buffer_size, self.growth)
+
+        return writers
+
+
+    def outputs(self, keep, tile, position, level=None):
+        """
+            Turn a tile from iter_tiles into the (dataset name, tile, position) entries to write,
+            fitting or applying the normalizer to accepted tiles. The slide and level are the
+            stratum of a sampling normalizer.
+        """
+        if not keep:
+            return [("reject_images", tile, position)]
+
+        if self.normalize_on_write:
+            entries = [("images", self.normalizer.normalize_tile(tile), position)]
+            if self.keep_raw:
+                entries.append(("raw_images", tile, position))
+            return entries
+
+        if self.normalizer is not None:
+            self.normalizer.fit_tile(tile, (self.file_name, level))
+
+        return [("images", tile, position)]
+
+
+    def all_levels(self):
+        """
             Returns:
-                - None
+                - A list of (level, magnification, cols, rows) for every DeepZoom level but the first
         """
         max_zoom = float(self.slide.properties[openslide.PROPERTY_NAME_OBJECTIVE_POWER]) / self.slide.level_downsamples[0]
 
+        levels = []
         for level in range(1, self.dz.level_count):
             this_mag = max_zoom/pow(2,self.dz.level_count-(level+1))
             cols, rows = self.dz.level_tiles[level]
+            levels.append((level, this_mag, cols, rows))
+
+        return levels
+
+
+    def levels(self):
+        """
+            Returns:
+                - A list of (level, magnification, cols, rows) for every saved DeepZoom level
+        """
+        if self.magnifications is None:
+            return self.all_levels()
+
+        return [entry for entry in self.all_levels()
+                if any(np.isclose(entry[1], mag) for mag in self.magnifications)]
+
+
+    def pyramid_levels(self):
+        """
+            Returns:
+                - The levels from the highest saved magnification down to the lowest, including
+                  the levels between them which are only built to downsample further
+        """
+        saved = [level for level, _, _, _ in self.levels()]
+        if len(saved) == 0:
+            return []
+
+        return [entry for entry in reversed(self.all_levels()) if min(saved) <= entry[0] <= max(saved)]
 
-            zoom_hdf5 = self.h5_group.create_group(str(this_mag))
-        
-            img_storage = self._create_image_dataset(zoom_hdf5, 'images', self.size)
-            name_storage = self._create_name_dataset(zoom_hdf5, 'file_name')
 
-            reject_img_storage = self._create_image_dataset(zoom_hdf5, "reject_images", self.size)
-            reject_name_storage = self._create_name_dataset(zoom_hdf5, "reject_file_name")
+    def tissue_mask(self):
+        """
+            Returns:
+                - The thumbnail tissue mask of the slide, or None if masking is disabled
+        """
+        if self.use_mask:
+            return TissueMask(self.slide, self.mask_downsample)
+
+        return None
+
+
+    def _sample_reject(self, level, col, row):
+        """
+            Decide if a rejected tile is saved.
+        """
+        if self.seed is None:
+            return np.random.uniform() < self.reject_rate
+
+        key = f"{self.seed}/{self.file_name}/{level}/{col}/{row}".encode()
+        return zlib.crc32(key) / 2**32 < self.reject_rate
 
-            print(f"\rCreating {self.file_name} | zoom: x{this_mag:.2f}", end="")
-            for row in range(rows):
-                for col in range(cols):
-                    tile = np.array(self.dz.get_tile(level, (col, row)))
-                    tile_name = f"{col}_{row}"
 
-                    if self._keep_tile(tile, self.size, 1 - self.background):
-                        if self.normalizer is not None:
-                            self.normalizer.fit_tile(tile)
-                        
-                        max_index = img_storage.shape[0] + 1
-                        img_storage.resize(max_index, axis=0)
-                        name_storage.resize(max_index, axis=0)
+    def _read_tile(self, level, col, row):
+        self.tiles_read += 1
+        if self.region_reader is not None:
+            return self.region_reader.get_tile(level, col, row)
 
-                        img_storage[max_index-1, :, :, :] = tile
-                        name_storage[max_index-1, :] = tile_name
+        return np.array(self.dz.get_tile(level, (col, row)))
 
-                    else:
-                        if np.random.uniform() < self.reject_rate and tile.shape == (self.size, self.size, 3):
-                            max_index = reject_img_storage.shape[0] + 1
-                            reject_img_storage.resize(max_index, axis=0)
-                            reject_name_storage.resize(max_index, axis=0)
 
-                            reject_img_storage[max_index-1, :, :, :] = tile
-                            reject_name_storage[max_index-1, :] = tile_name
+    def _read_batch(self, level, batch, tissue_mask=None, counts=None):
+        """
+            Read and filter a batch of tiles.
+
+            Returns:
+                - tiles: The tile arrays, with None for background tiles outside the tissue mask
+                - keep: A Boolean array of the tiles passing the tissue filter
+        """
+        l0_size = self.size * pow(2,self.dz.level_count-(level+1))
+        full_shape = (self.size, self.size, 3)
+
+        # Read the batch, leaving None for background tiles outside the tissue mask
+        tiles = []
+        for col, row in batch:
+            if tissue_mask is not None and not tissue_mask.overlaps_tissue(col*l0_size, row*l0_size, l0_size, l0_size):
+                if counts is not None:
+                    counts["skipped"] += 1
+                tiles.append(None)
+            else:
+                tiles.append(self._read_tile(level, col, row))
+
+        full = [i for i, tile in enumerate(tiles) if tile is not None and tile.shape == full_shape]
+        keep = np.zeros(len(batch), dtype=bool)
+        for start in range(0, len(full), self.filter_batch):
+            index = full[start:start+self.filter_batch]
+            keep[index] = self.tissue_filter.filter(np.stack([tiles[i] for i in index]))[0]
+
+        return tiles, keep
+
+
+    def _select(self, level, batch, tiles, keep):
+        """
+            Yield (keep, tile, position) for the accepted tiles of a batch and a sample of the
+            rejected ones, where position is the (col, row) of the tile.
+        """
+        full_shape = (self.size, self.size, 3)
+
+        for i, (col, row) in enumerate(batch):
+            position = (col, row)
+
+            if tiles[i] is None:
+                # Only read background tiles that are sampled as rejects
+                if self._sample_reject(level, col, row):
+                    tile = self._read_tile(level, col, row)
+                    if tile.shape == full_shape:
+                        yield False, tile, position
+
+            elif keep[i]:
+                yield True, tiles[i], position
+
+            elif self._sample_reject(level, col, row) and tiles[i].shape == full_shape:
+                yield False, tiles[i], position
+
+
+    def iter_tiles(self, level, row_start, row_end, tissue_mask=None, counts=None):
+        """
+            Read and filter the tiles of a band of rows at a given zoom level.
+
+            Args:
+                - level: The DeepZoom level to read
+                - row_start, row_end: The range of tile rows to read
+                - tissue_mask: A TissueMask used to skip background tiles
+                - counts: A dictionary whose "skipped" entry is incremented for every skipped tile
+
+            Yields:
+                - (keep, tile, position) for every accepted tile and every sampled rejected tile
+        """
+        cols = self.dz.level_tiles[level][0]
+
+        positions = [(col, row) for row in range(row_start, row_end) for col in range(cols)]
+        for batch_start in range(0, len(positions), self.filter_batch):
+            batch = positions[batch_start:batch_start+self.filter_batch]
+            tiles, keep = self._read_batch(level, batch, tissue_mask, counts)
+            yield from self._select(level, batch, tiles, keep)
+
+
+    def _downsample_row(self, level, row, upper, counts=None):
+        """
+            Build a row of tiles from the two rows above it in the pyramid. A tile is the 2x2 area
+            average of its four children and is kept if all of them were kept. Tiles whose
+            children disagree are run through the tissue filter, and tiles whose children were not
+            all read in full, e.g. at the edge of the tissue mask, are read from the slide and run
+            through the tissue filter, as _read_batch does.
+
+            Args:
+                - level: The DeepZoom level of the row
+                - row: The tile row
+                - upper: The (tiles, keep) of the upper rows 2*row and 2*row+1, None past the end
+                - counts: A dictionary whose "skipped" entry is incremented for every skipped tile
+
+            Returns:
+                - The tiles and keep decisions of the row, as _read_batch
+        """
+        cols = self.dz.level_tiles[level][0]
+        width, height = self.dz.level_dimensions[level]
+        full_shape = (self.size, self.size, 3)
+
+        tiles = []
+        keep = np.zeros(cols, dtype=bool)
+        # Tiles whose keep decision is left to the tissue filter
+        undecided = []
+        for col in range(cols):
+            children = [(upper_tiles[child], upper_keep[child]) for upper_tiles, upper_keep in filter(None, upper)
+                        for child in (2*col, 2*col+1) if child < len(upper_tiles)]
+
+            if all(child is None for child, _ in children):
+                # Every child was outside the tissue mask
+                if counts is not None:
+                    counts["skipped"] += 1
+                tiles.append(None)
+
+            elif (col+1)*self.size > width or (row+1)*self.size > height:
+                # Partial tiles at the right and bottom edges are never saved
+                tiles.append(np.empty((0, 0, 3), dtype=np.uint8))
+
+            elif len(children) == 4 and all(child is not None and child.shape == full_shape for child, _ in children):
+                block = np.concatenate([np.concatenate([children[0][0], children[1][0]], axis=1),
+                                        np.concatenate([children[2][0], children[3][0]], axis=1)], axis=0)
+                block = block.reshape(self.size, 2, self.size, 2, 3).sum(axis=(1, 3), dtype=np.uint16)
+                tiles.append(((block + 2) // 4).astype(np.uint8))
+                child_keep = [child_keep for _, child_keep in children]
+                if all(child_keep):
+                    keep[col] = True
+                elif any(child_keep):
+                    undecided.append(col)
+
+            else:
+                tiles.append(self._read_tile(level, col, row))
+                if tiles[-1].shape == full_shape:
+                    undecided.append(col)
+
+        for start in range(0, len(undecided), self.filter_batch):
+            index = undecided[start:start+self.filter_batch]
+            keep[index] = self.tissue_filter.filter(np.stack([tiles[i] for i in index]))[0]
+
+        return tiles, keep
+
+
+    def iter_pyramid(self, row_start, row_end, tissue_mask=None, counts=None):
+        """
+            Read a band of rows of the highest saved magnification and build the lower
+            magnifications from it by 2x2 area downsampling, carrying the tissue decisions down
+            the pyramid. row_start should be a multiple of 2^(number of pyramid levels - 1) so
+            every lower row is built from whole pairs of rows.
+
+            Args:
+                - row_start, row_end: The range of tile rows of the highest magnification
+                - tissue_mask: A TissueMask used to skip background tiles
+                - counts: A dictionary from level to a dictionary whose "skipped" entry is
+                          incremented for every skipped tile of that level
+
+            Yields:
+                - (level, keep, tile, position) for the saved levels, as iter_tiles
+        """
+        chain = self.pyramid_levels()
+        saved = set(level for level, _, _, _ in self.levels())
+        counts = counts if counts is not None else {}
+        for level, _, _, _ in chain:
+            counts.setdefault(level, {"skipped": 0})
+
+        # The last row of each level built from this band
+        last_rows = [min(-(-row_end // pow(2, index)), rows) - 1 for index, (_, _, _, rows) in enumerate(chain)]
+        pending = [{} for _ in chain]
+
+        def emit(index, row, tiles, keep):
+            level, _, cols, _ = chain[index]
+            if level in saved:
+                batch = [(col, row) for col in range(cols)]
+                for tile_keep, tile, position in self._select(level, batch, tiles, keep):
+                    yield level, tile_keep, tile, position
+
+            if index + 1 < len(chain):
+                pending[index][row] = (tiles, keep)
+                if row % 2 == 1 or row == last_rows[index]:
+                    upper = [pending[index].pop(row - row % 2), pending[index].pop(row - row % 2 + 1, None)]
+                    lower_level = chain[index + 1][0]
+                    lower_tiles, lower_keep = self._downsample_row(lower_level, row // 2, upper, counts[lower_level])
+                    yield from emit(index + 1, row // 2, lower_tiles, lower_keep)
+
+        top, _, cols, rows = chain[0]
+        for row in range(row_start, min(row_end, rows)):
+            batch = [(col, row) for col in range(cols)]
+            tiles, keep = self._read_batch(top, batch, tissue_mask, counts[top])
+            yield from emit(0, row, tiles, keep)
+
+
+    def _save_tiles(self):
+        """
+            This function will save all the relevant tiles for every zoom level.
+
+            Returns:
+                - None
+        """
+        tissue_mask = self.tissue_mask()
+        if tissue_mask is not None:
+            tissue_mask.save(self.h5_group)
+        slide_total, slide_skipped = 0, 0
+
+        if self.pyramid:
+            counts = {}
+            zooms, writers = {}, {}
+            for level, this_mag, _, _ in self.levels():
+                zooms[level] = self.h5_group.create_group(str(this_mag))
+                writers[level] = self._create_writers(zooms[level], level, this_mag)
+
+            print(f"\rCreating {self.file_name} | pyramid", end="")
+            if len(zooms) > 0:
+                top_rows = self.pyramid_levels()[0][3]
+                for level, keep, tile, position in self.iter_pyramid(0, top_rows, tissue_mask, counts):
+                    for dataset, array, array_position in self.outputs(keep, tile, position, level):
+                        writers[level][dataset].add(array, array_position)
+
+        for level, this_mag, cols, rows in self.levels():
+            if self.pyramid:
+                zoom_hdf5 = zooms[level]
+            else:
+                counts = {level: {"skipped": 0}}
+
+                zoom_hdf5 = self.h5_group.create_group(str(this_mag))
+                writers = {level: self._create_writers(zoom_hdf5, level, this_mag)}
+
+                print(f"\rCreating {self.file_name} | zoom: x{this_mag:.2f}", end="")
+                for keep, tile, position in self.iter_tiles(level, 0, rows, tissue_mask, counts[level]):
+                    for dataset, array, array_position in self.outputs(keep, tile, position, level):
+                        writers[level][dataset].add(array, array_position)
+
+            for writer in writers[level].values():
+                writer.close()
+                self.write_stats = merge_write_stats(self.write_stats, writer.stats())
+            save_grid(zoom_hdf5, cols, rows)
+
+            zoom_hdf5.attrs["tiles_total"] = cols * rows
+            zoom_hdf5.attrs["tiles_skipped"] = counts[level]["skipped"]
+            slide_total += cols * rows
+            slide_skipped += counts[level]["skipped"]
+
+        self.h5_group.attrs["tiles_total"] = slide_total
+        self.h5_group.attrs["tiles_skipped"] = slide_skipped
+        self.filter_stats = self.tissue_filter.reset_stats()
+        if self.normalize_on_write:
+            self.normalizer.record(self.h5_group)
+
+        print(f"\rWrote {self.file_name} | skipped {slide_skipped}/{slide_total} background tiles | read {self.tiles_read} tiles{self._region_summary()} | "
+              f"{format_write_stats(self.write_stats)}")
+        print(f"Filter stages | {format_filter_stats(self.filter_stats)}", end="")
+
+
+    def _region_summary(self):
+        if self.region_reader is None:
+            return ""
+
+        return f" in {self.region_reader.regions_read} regions"
 
 
     def _keep_tile(self, tile, tile_size, tissue_threshold):
         """
-        Determine if a tile should be kept.
+        Determine if a tile should be kept. This is the reference version of the checks, iter_tiles
+        uses TissueFilter which makes the same decisions for a stack of tiles at once.
         
         Args:
             - tile: A PIL Image object of the slide tile
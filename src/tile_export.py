@@ -0,0 +1,291 @@
+import io
+import json
+import os
+import tarfile
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+from tile_loader import TileIndex, iter_chunk_batches
+from tile_writer import format_write_stats
+
+
+FORMATS = ("memmap", "tar")
+TILES_FILE = "tiles.npy"
+INDEX_FILE = "index.npz"
+LABELS_FILE = "labels.csv"
+
+
+def _export(index, output_dir, write_batch, batch_size=256, shuffle=False, window=8, seed=None):
+    """
+        Read every tile of an index in whole HDF5 chunks, hand each batch to write_batch and save
+        the index of the exported tiles, in the order they were written, to index.npz: the source
+        index, slide, magnification, (column, row) and labels table row of every tile, and the
+        names and signatures of the slides. The labels table is saved to labels.csv.
+
+        Returns:
+            - A stats dictionary of the tiles written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    coordinates = index.coordinates()
+    sources = np.zeros(len(index), dtype=np.int64)
+    stats = {"tiles": 0, "bytes": 0, "seconds": 0.0}
+
+    start_time = time.perf_counter()
+    position = 0
+    for indices, tiles in iter_chunk_batches(index, index.chunks(), batch_size, shuffle, window, seed):
+        write_batch(position, tiles, index.targets(indices), coordinates[indices])
+        sources[position:position + len(indices)] = indices
+        position += len(indices)
+
+        stats["tiles"] += len(tiles)
+        stats["bytes"] += tiles.nbytes
+        print(f"\rExported {position}/{len(index)} tiles", end="")
+
+    targets = index.targets(sources)
+    np.savez(os.path.join(output_dir, INDEX_FILE), source=sources, slide=targets["slide"].astype(np.int32),
+             magnification=targets["magnification"], coordinates=coordinates[sources], label=targets["label"],
+             slides=np.array([name for _, name in index.slides], dtype=str), signatures=index.signatures,
+             tile_shape=np.array(index.tile_shape))
+    if len(index.labels) > 0:
+        index.labels.to_csv(os.path.join(output_dir, LABELS_FILE), index=False)
+
+    stats["seconds"] = time.perf_counter() - start_time
+    print()
+    return stats
+
+
+def export_memmap(index, output_dir, batch_size=256, shuffle=False, window=8, seed=None):
+    """
+        Export the tiles of an index to a single contiguous (N, size, size, 3) uint8 array,
+        tiles.npy, which is read back as a memory map by MemmapTiles.
+
+        Args:
+            - index: The TileIndex of the set files
+            - output_dir: The directory the array and its index are written to
+            - batch_size: The number of tiles read from the HDF5 files at once
+            - shuffle: Write the tiles in a chunk window shuffled order instead of storage order
+            - window: The number of HDF5 chunks shuffled together
+            - seed: Seed of the shuffle
+
+        Returns:
+            - A stats dictionary of the tiles written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tiles_path = os.path.join(output_dir, TILES_FILE)
+    tiles_out = np.lib.format.open_memmap(tiles_path + ".part", mode="w+", dtype=np.uint8,
+                                          shape=(len(index),) + tuple(index.tile_shape))
+
+    def write_batch(position, tiles, targets, coordinates):
+        tiles_out[position:position + len(tiles)] = tiles
+
+    stats = _export(index, output_dir, write_batch, batch_size, shuffle, window, seed)
+    tiles_out.flush()
+    del tiles_out
+    os.replace(tiles_path + ".part", tiles_path)
+    return stats
+
+
+def export_tar(index, output_dir, shard_size=1000, batch_size=256, shuffle=True, window=8, seed=None):
+    """
+        Export the tiles of an index to WebDataset style tar shards of shard_size tiles,
+        shard-000000.tar, shard-000001.tar, ... Each tile is stored as <key>.npy next to
+        <key>.json holding its slide, magnification, column, row and labels table row, where key
+        is the position of the tile in the export.
+
+        Args:
+            - index: The TileIndex of the set files
+            - output_dir: The directory the shards and their index are written to
+            - shard_size: The number of tiles per shard
+            - batch_size: The number of tiles read from the HDF5 files at once
+            - shuffle: Write the tiles in a chunk window shuffled order, so sequential reads of
+                       a shard mix tiles of many slides
+            - window: The number of HDF5 chunks shuffled together
+            - seed: Seed of the shuffle
+
+        Returns:
+            - A stats dictionary of the tiles written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shard = {"tar": None, "number": -1}
+    slide_names = [name for _, name in index.slides]
+
+    def add_member(name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        shard["tar"].addfile(info, io.BytesIO(data))
+
+    def write_batch(position, tiles, targets, coordinates):
+        for i, tile in enumerate(tiles):
+            if (position + i) // shard_size != shard["number"]:
+                if shard["tar"] is not None:
+                    shard["tar"].close()
+                shard["number"] = (position + i) // shard_size
+                shard["tar"] = tarfile.open(os.path.join(output_dir, f"shard-{shard['number']:06d}.tar"), "w")
+
+            key = f"{position + i:09d}"
+            tile_bytes = io.BytesIO()
+            np.save(tile_bytes, tile)
+            add_member(f"{key}.npy", tile_bytes.getvalue())
+            add_member(f"{key}.json", json.dumps({
+                "slide": slide_names[targets["slide"][i]],
+                "magnification": float(targets["magnification"][i]),
+                "col": int(coordinates[i, 0]),
+                "row": int(coordinates[i, 1]),
+                "label": int(targets["label"][i])
+            }).encode())
+
+    try:
+        stats = _export(index, output_dir, write_batch, batch_size, shuffle, window, seed)
+    finally:
+        if shard["tar"] is not None:
+            shard["tar"].close()
+
+    return stats
+
+
+class MemmapTiles:
+    """
+        This class reads the tiles exported by export_memmap through a memory map, with the
+        targets of each tile from the exported index.
+    """
+
+    def __init__(self, export_dir):
+        self.tiles = np.load(os.path.join(export_dir, TILES_FILE), mmap_mode="r")
+        with np.load(os.path.join(export_dir, INDEX_FILE)) as export_index:
+            self.index = {key: export_index[key] for key in export_index.files}
+
+
+    def __len__(self):
+        return self.tiles.shape[0]
+
+
+    def read(self, indices):
+        """
+            Returns:
+                - The tiles at a number of positions, read in sorted order
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        rows, inverse = np.unique(indices, return_inverse=True)
+        return self.tiles[rows][inverse]
+
+
+    def targets(self, indices):
+        """
+            Returns:
+                - A dictionary with the position, slide, magnification, (column, row), labels
+                  table row and signatures of each tile, as TileIndex.targets
+        """
+        slides = self.index["slide"][indices]
+        return {
+            "index": np.asarray(indices, dtype=np.int64),
+            "slide": slides,
+            "magnification": self.index["magnification"][indices],
+            "coordinates": self.index["coordinates"][indices],
+            "label": self.index["label"][indices],
+            "signatures": self.index["signatures"][slides]
+        }
+
+
+    def iter_batches(self, batch_size=64, shuffle=True, seed=None):
+        """
+            Yield the batches of an epoch as dictionaries of arrays, as TileLoader.
+        """
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            batch = self.targets(indices)
+            batch["images"] = self.read(indices)
+            yield batch
+
+
+def iter_tar_samples(export_dir, shuffle=True, seed=None):
+    """
+        Yield the (key, tile, metadata) samples of the tar shards of an export, reading each shard
+        sequentially. With shuffle the shards are visited in a random order.
+    """
+    shards = sorted(name for name in os.listdir(export_dir) if name.startswith("shard-") and name.endswith(".tar"))
+    if shuffle:
+        shards = [shards[i] for i in np.random.default_rng(seed).permutation(len(shards))]
+
+    for shard in shards:
+        sample = {}
+        with tarfile.open(os.path.join(export_dir, shard), "r|") as tar:
+            for member in tar:
+                key, extension = member.name.split(".", 1)
+                data = tar.extractfile(member).read()
+                sample[extension] = np.load(io.BytesIO(data)) if extension == "npy" else json.loads(data)
+
+                if len(sample) == 2:
+                    yield int(key), sample["npy"], sample["json"]
+                    sample = {}
+
+
+def iter_tar_batches(export_dir, batch_size=64, shuffle=True, buffer_size=1000, seed=None):
+    """
+        Yield batches of the tar shards of an export as dictionaries of arrays, as TileLoader.
+        With shuffle the shards are read in a random order and samples are drawn at random from
+        a buffer of buffer_size samples, as WebDataset does.
+    """
+    with np.load(os.path.join(export_dir, INDEX_FILE)) as export_index:
+        slide_index = {name: i for i, name in enumerate(export_index["slides"].tolist())}
+        signatures = export_index["signatures"]
+
+    rng = np.random.default_rng(seed)
+    buffer, batch = [], []
+
+    def make_batch(samples):
+        slides = np.array([slide_index[metadata["slide"]] for _, _, metadata in samples], dtype=np.int32)
+        return {
+            "index": np.array([key for key, _, _ in samples], dtype=np.int64),
+            "slide": slides,
+            "magnification": np.array([metadata["magnification"] for _, _, metadata in samples], dtype=np.float32),
+            "coordinates": np.array([(metadata["col"], metadata["row"]) for _, _, metadata in samples], dtype=np.int32),
+            "label": np.array([metadata["label"] for _, _, metadata in samples], dtype=np.int64),
+            "signatures": signatures[slides],
+            "images": np.stack([tile for _, tile, _ in samples])
+        }
+
+    for sample in iter_tar_samples(export_dir, shuffle, seed):
+        if shuffle:
+            buffer.append(sample)
+            if len(buffer) < buffer_size:
+                continue
+            position = rng.integers(len(buffer))
+            buffer[position], buffer[-1] = buffer[-1], buffer[position]
+            sample = buffer.pop()
+
+        batch.append(sample)
+        if len(batch) == batch_size:
+            yield make_batch(batch)
+            batch = []
+
+    rng.shuffle(buffer)
+    batch.extend(buffer)
+    for start in range(0, len(batch), batch_size):
+        yield make_batch(batch[start:start + batch_size])
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog <set_file> [<set_file> ...] <output_folder> [options]')
+    parser.add_option('-f', '--format', dest='format', type='choice', choices=list(FORMATS), default='memmap', help='Export format: memmap or tar, default=memmap')
+    parser.add_option('--shard_size', dest='shard_size', type='int', default=1000, help='Number of tiles per tar shard, default=1000')
+    parser.add_option('--dataset', dest='dataset', type='string', default='images', help='Tile dataset to export, e.g. images or raw_images, default=images')
+    parser.add_option('--shuffle', dest='shuffle', action="store_true", help='Write the tiles in a shuffled order, always on for tar, default=False')
+    parser.add_option('--window', dest='window', type='int', default=8, help='Number of HDF5 chunks shuffled together, default=8')
+    parser.add_option('--seed', dest='seed', type='int', default=None, help='Seed of the shuffle, default=None')
+
+    (opts, args) = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error('Missing set file or output directory argument.')
+
+    index = TileIndex(args[:-1], opts.dataset)
+    if opts.format == "memmap":
+        stats = export_memmap(index, args[-1], shuffle=opts.shuffle, window=opts.window, seed=opts.seed)
+    else:
+        stats = export_tar(index, args[-1], opts.shard_size, window=opts.window, seed=opts.seed)
+    index.close()
+
+    print(f"Export: {format_write_stats(stats)}")
@@ -0,0 +1,527 @@
+import multiprocessing as mp
+import os
+import time
+import traceback
+from multiprocessing.shared_memory import SharedMemory
+from optparse import OptionParser
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from labeling_util import load_hugo
+
+
+# The datasets holding the positions of each tile dataset, and the "<col>_<row>" names of older sets
+COORDINATE_DATASETS = {"images": "coordinates", "raw_images": "coordinates", "reject_images": "reject_coordinates"}
+NAME_DATASETS = {"images": "file_name", "raw_images": "file_name", "reject_images": "reject_file_name"}
+
+
+class TileIndex:
+    """
+        This class indexes the tiles of one or more set files (train.h5, val.h5, test.h5) across
+        every slide and magnification, so they can be addressed by a single global index, and
+        joins each slide to the labels, mutational signatures and hugo symbols stored with it.
+
+        HDF5 files are opened lazily by each process that reads from them, so an index can be
+        shared with worker processes created by fork.
+    """
+
+    def __init__(self, h5_paths, dataset="images", magnifications=None, hugo=False):
+        """
+            Args:
+                - h5_paths: A set file or a list of set files
+                - dataset: The tile dataset of each magnification, e.g. images or raw_images
+                - magnifications: The magnifications to index e.g. [20, 5], default=every magnification
+                - hugo: Whether batches include the dense hugo symbol counts of their tiles
+        """
+        self.h5_paths = [h5_paths] if isinstance(h5_paths, str) else list(h5_paths)
+        self.dataset = dataset
+        self.hugo = hugo
+
+        # Each group is a (file, slide, magnification) dataset of tiles
+        self.groups = []
+        self.slides = []
+        self.tile_shape = None
+        group_slides, group_mags, counts, chunk_rows = [], [], [], []
+        slide_index = {}
+
+        for file_index, h5_path in enumerate(self.h5_paths):
+            with h5py.File(h5_path, "r") as h5_file:
+                for slide_name, slide_group in h5_file.get("images", {}).items():
+                    for mag, zoom_group in slide_group.items():
+                        if not isinstance(zoom_group, h5py.Group) or dataset not in zoom_group:
+                            continue
+                        if magnifications is not None and not any(np.isclose(float(mag), m) for m in magnifications):
+                            continue
+
+                        tiles = zoom_group[dataset]
+                        key = (file_index, slide_name)
+                        if key not in slide_index:
+                            slide_index[key] = len(self.slides)
+                            self.slides.append(key)
+
+                        self.groups.append((file_index, f"images/{slide_name}/{mag}/{dataset}"))
+                        group_slides.append(slide_index[key])
+                        group_mags.append(float(mag))
+                        counts.append(tiles.shape[0])
+                        chunk_rows.append(tiles.chunks[0] if tiles.chunks is not None else 64)
+                        self.tile_shape = tiles.shape[1:]
+
+        self.group_slides = np.array(group_slides, dtype=np.int64)
+        self.group_mags = np.array(group_mags, dtype=np.float32)
+        self.counts = np.array(counts, dtype=np.int64)
+        self.chunk_rows = np.array(chunk_rows, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+        self._join_labels()
+
+        self._pid = None
+        self._files = {}
+        # Positions and grid indexes of the groups, read as they are first needed
+        self._coordinates = {}
+        self._grids = {}
+
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+
+    def _join_labels(self):
+        """
+            Find the row of the labels table, the signatures and the hugo symbol row of every slide.
+            Slides are matched by the sample barcode (the first four fields of their name) and the
+            case barcode (the first three).
+        """
+        label_tables, signatures, hugos = [], [], []
+        for h5_path in self.h5_paths:
+            with h5py.File(h5_path, "r") as h5_file:
+                keys = set(h5_file.keys())
+                hugo = load_hugo(h5_file) if self.hugo and "hugo_symbols" in keys else None
+            label_tables.append(pd.read_hdf(h5_path, key="labels") if "labels" in keys else None)
+            signatures.append(pd.read_hdf(h5_path, key="mutational_signatures") if "mutational_signatures" in keys else None)
+            hugos.append(hugo)
+
+        tables = [table for table in label_tables if table is not None]
+        self.labels = pd.concat(tables, ignore_index=True) if len(tables) > 0 else pd.DataFrame()
+
+        self.label_rows = np.full(len(self.slides), -1, dtype=np.int64)
+        signature_columns = next((list(table.columns[:-1]) for table in signatures if table is not None), [])
+        self.signatures = np.full((len(self.slides), len(signature_columns)), np.nan, dtype=np.float32)
+        self.hugo_symbols = sorted({symbol for table in hugos if table is not None for symbol in table.columns[:-1]})
+        self.hugo_counts = np.zeros((len(self.slides) if self.hugo else 0, len(self.hugo_symbols)), dtype=np.float32)
+
+        offset = 0
+        for file_index, table in enumerate(label_tables):
+            slides = [(i, name) for i, (slide_file, name) in enumerate(self.slides) if slide_file == file_index]
+            samples = ["-".join(name.split("-")[:4]) for _, name in slides]
+            cases = ["-".join(name.split("-")[:3]) for _, name in slides]
+            rows = np.array([i for i, _ in slides], dtype=np.int64)
+
+            if table is not None:
+                first = pd.Series(np.arange(len(table)), index=table["sample.barcode"].to_numpy())
+                first = first[~first.index.duplicated()]
+                match = first.reindex(samples).fillna(-1).to_numpy(dtype=np.int64)
+                self.label_rows[rows] = np.where(match >= 0, match + offset, -1)
+                offset += len(table)
+
+            if signatures[file_index] is not None and len(slides) > 0:
+                first = signatures[file_index].drop_duplicates("case_id").set_index("case_id")
+                self.signatures[rows] = first.reindex(cases).to_numpy(dtype=np.float32)
+
+            if hugos[file_index] is not None and len(slides) > 0:
+                first = hugos[file_index].drop_duplicates("case_barcode").set_index("case_barcode")
+                first = first.sparse.to_dense()
+                self.hugo_counts[rows] = first.reindex(index=cases, columns=self.hugo_symbols).fillna(0).to_numpy(dtype=np.float32)
+
+
+    def _tiles(self, group):
+        """
+            The tile dataset of a group, from the files opened by this process.
+        """
+        if self._pid != os.getpid():
+            # Handles inherited through fork are never used, each process opens its own
+            self._pid = os.getpid()
+            self._files = {}
+
+        file_index, path = self.groups[group]
+        if file_index not in self._files:
+            self._files[file_index] = h5py.File(self.h5_paths[file_index], "r")
+        return self._files[file_index][path]
+
+
+    def locate(self, indices):
+        """
+            Returns:
+                - The group of each global index
+                - The index of each tile in its group
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        groups = np.searchsorted(self.offsets, indices, side="right") - 1
+        return groups, indices - self.offsets[groups]
+
+
+    def read(self, indices, out=None):
+        """
+            Read the tiles at a number of global indices, with a single sorted fancy index read per
+            dataset.
+
+            Returns:
+                - The (len(indices), size, size, 3) uint8 tiles in the order of indices
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        groups, local = self.locate(indices)
+        out = np.empty((len(indices),) + self.tile_shape, dtype=np.uint8) if out is None else out
+
+        for group in np.unique(groups):
+            positions = np.flatnonzero(groups == group)
+            rows, inverse = np.unique(local[positions], return_inverse=True)
+            tiles = self._tiles(group)
+            if len(rows) == rows[-1] - rows[0] + 1:
+                block = tiles[rows[0]:rows[-1] + 1]
+            else:
+                block = tiles[rows]
+            out[positions] = block[inverse]
+
+        return out
+
+
+    def targets(self, indices):
+        """
+            Returns:
+                - A dictionary with the slide, magnification, labels table row (-1 if missing),
+                  signatures (NaN if missing) and, with hugo, hugo symbol counts of each tile
+        """
+        groups, _ = self.locate(indices)
+        slides = self.group_slides[groups]
+        batch = {
+            "index": np.asarray(indices, dtype=np.int64),
+            "slide": slides,
+            "magnification": self.group_mags[groups],
+            "label": self.label_rows[slides],
+            "signatures": self.signatures[slides]
+        }
+        if self.hugo:
+            batch["hugo"] = self.hugo_counts[slides]
+
+        return batch
+
+
+    def _group_coordinates(self, group):
+        """
+            Returns:
+                - The (col, row) of every tile of a group as a (n, 2) int32 array, parsing the
+                  names of sets written before positions were stored as coordinates
+        """
+        if group not in self._coordinates:
+            zoom_group = self._tiles(group).parent
+            dataset = self.groups[group][1].rsplit("/", 1)[1]
+
+            if COORDINATE_DATASETS.get(dataset, "coordinates") in zoom_group:
+                coordinates = zoom_group[COORDINATE_DATASETS.get(dataset, "coordinates")][:]
+            else:
+                names = zoom_group[NAME_DATASETS.get(dataset, "file_name")][:, 0]
+                coordinates = np.array([name.decode().split("_") for name in names], dtype=np.int32).reshape(-1, 2)
+            self._coordinates[group] = coordinates
+
+        return self._coordinates[group]
+
+
+    def coordinates(self):
+        """
+            Returns:
+                - The (col, row) of every tile in its DeepZoom level, as a (len, 2) int32 array
+        """
+        coordinates = np.zeros((len(self), 2), dtype=np.int32)
+        for group in range(len(self.groups)):
+            coordinates[self.offsets[group]:self.offsets[group + 1]] = self._group_coordinates(group)
+
+        return coordinates
+
+
+    def grid(self, group):
+        """
+            Returns:
+                - The (rows, cols) grid of a group holding the row of the tile at each (col, row),
+                  or -1 where there is none, built from the coordinates for older sets
+        """
+        if group not in self._grids:
+            zoom_group = self._tiles(group).parent
+            dataset = self.groups[group][1].rsplit("/", 1)[1]
+
+            if dataset != "reject_images" and "grid" in zoom_group:
+                grid = zoom_group["grid"][:]
+            else:
+                coordinates = self._group_coordinates(group)
+                grid = np.full(tuple(coordinates.max(axis=0)[::-1] + 1) if len(coordinates) > 0 else (0, 0), -1,
+                               dtype=np.int32)
+                grid[coordinates[:, 1], coordinates[:, 0]] = np.arange(len(coordinates), dtype=np.int32)
+            self._grids[group] = grid
+
+        return self._grids[group]
+
+
+    def neighbours(self, indices, radius=1):
+        """
+            Find the tiles around a number of tiles at the same slide and magnification, e.g. for
+            context windows or multi-instance bags.
+
+            Args:
+                - indices: The global indices of the centre tiles
+                - radius: The number of tiles on each side of the centre
+
+            Returns:
+                - A (len(indices), 2*radius+1, 2*radius+1) array of the global indices of the tiles
+                  at each (row, col) offset from the centre, -1 where there is no tile
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        groups, local = self.locate(indices)
+        offsets = np.arange(-radius, radius + 1)
+        neighbours = np.full((len(indices), len(offsets), len(offsets)), -1, dtype=np.int64)
+
+        for group in np.unique(groups):
+            positions = np.flatnonzero(groups == group)
+            grid = self.grid(group)
+            centres = self._group_coordinates(group)[local[positions]]
+
+            cols = centres[:, 0, None, None] + offsets[None, None, :]
+            rows = centres[:, 1, None, None] + offsets[None, :, None]
+            inside = (cols >= 0) & (cols < grid.shape[1]) & (rows >= 0) & (rows < grid.shape[0])
+            rows_in, cols_in = np.where(inside, rows, 0), np.where(inside, cols, 0)
+
+            found = np.where(inside, grid[rows_in, cols_in], -1) if grid.size > 0 else np.full(inside.shape, -1)
+            neighbours[positions] = np.where(found >= 0, found + self.offsets[group], -1)
+
+        return neighbours
+
+
+    def chunks(self):
+        """
+            Returns:
+                - The (start, end) global indices of every HDF5 chunk of tiles
+        """
+        units = []
+        for group in range(len(self.groups)):
+            for start in range(0, int(self.counts[group]), int(self.chunk_rows[group])):
+                end = min(start + int(self.chunk_rows[group]), int(self.counts[group]))
+                units.append((int(self.offsets[group]) + start, int(self.offsets[group]) + end))
+
+        return units
+
+
+    def close(self):
+        for h5_file in self._files.values():
+            h5_file.close()
+        self._files = {}
+
+
+def iter_chunk_batches(index, units, batch_size=64, shuffle=True, window=8, seed=None, drop_last=False):
+    """
+        Yield batches of global indices and tiles, reading whole HDF5 chunks. With shuffle the
+        chunks are visited in a random order and the tiles of window consecutive chunks are
+        shuffled together, so every read stays contiguous while batches mix several slides.
+
+        Args:
+            - index: The TileIndex
+            - units: The (start, end) chunks to read
+            - batch_size: The number of tiles per batch
+            - shuffle: Whether to shuffle the chunks and the tiles within each window
+            - window: The number of chunks shuffled together
+            - seed: Seed of the shuffle
+            - drop_last: Whether to drop the last incomplete batch
+    """
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(units)) if shuffle else np.arange(len(units))
+    held_indices = np.zeros(0, dtype=np.int64)
+    held_tiles = np.zeros((0,) + index.tile_shape, dtype=np.uint8)
+
+    for window_start in range(0, len(order), window):
+        window_units = [units[unit] for unit in order[window_start:window_start + window]]
+        indices = np.concatenate([held_indices] + [np.arange(start, end) for start, end in window_units])
+        tiles = np.concatenate([held_tiles] + [index.read(np.arange(start, end)) for start, end in window_units])
+
+        if shuffle:
+            permutation = rng.permutation(len(indices))
+            indices, tiles = indices[permutation], tiles[permutation]
+
+        n_full = len(indices) // batch_size * batch_size
+        for start in range(0, n_full, batch_size):
+            yield indices[start:start + batch_size], tiles[start:start + batch_size]
+        held_indices, held_tiles = indices[n_full:], tiles[n_full:]
+
+    if len(held_indices) > 0 and not drop_last:
+        yield held_indices, held_tiles
+
+
+def _loader_worker(index, units, kwargs, result_queue, free_slots, slot_names, batch_size):
+    """
+        Worker process: read the batches of a share of the chunks into the shared memory slots.
+    """
+    slots = [SharedMemory(name=name) for name in slot_names]
+    try:
+        for indices, tiles in iter_chunk_batches(index, units, batch_size, **kwargs):
+            slot = free_slots.get()
+            np.ndarray((batch_size,) + index.tile_shape, dtype=np.uint8, buffer=slots[slot].buf)[:len(tiles)] = tiles
+            result_queue.put(("batch", slot, indices))
+        result_queue.put(("done", None, None))
+    except Exception:
+        result_queue.put(("error", None, traceback.format_exc()))
+    finally:
+        index.close()
+        for slot in slots:
+            slot.close()
+
+
+class TileLoader:
+    """
+        This class iterates over batches of the tiles of a TileIndex with chunk aware shuffling,
+        either in this process or split over worker processes which send the batches through
+        shared memory slots.
+    """
+
+    def __init__(self, index, batch_size=64, shuffle=True, window=8, workers=0, seed=None, drop_last=False,
+                 n_slots=None):
+        """
+            Args:
+                - index: The TileIndex
+                - batch_size: The number of tiles per batch
+                - shuffle: Whether to shuffle the chunks and the tiles within each window
+                - window: The number of HDF5 chunks shuffled together
+                - workers: The number of worker processes, 0 reads in this process
+                - seed: Seed of the shuffle, each epoch uses seed + epoch
+                - drop_last: Whether to drop the last incomplete batch of each worker
+                - n_slots: The number of shared memory slots, default=4*workers
+        """
+        self.index = index
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.window = window
+        self.workers = workers
+        self.seed = seed
+        self.drop_last = drop_last
+        self.n_slots = n_slots or 4 * workers
+
+        self.epoch = 0
+        self.stats = {"tiles": 0, "bytes": 0, "seconds": 0.0}
+
+
+    def _epoch_seed(self):
+        return None if self.seed is None else self.seed + self.epoch
+
+
+    def _batch(self, indices, tiles):
+        batch = self.index.targets(indices)
+        batch["images"] = tiles
+        self.stats["tiles"] += len(tiles)
+        self.stats["bytes"] += tiles.nbytes
+        return batch
+
+
+    def __iter__(self):
+        """
+            Yield the batches of an epoch as dictionaries of arrays: images, index, slide,
+            magnification, label, signatures and, if the index has them, hugo.
+        """
+        start_time = time.perf_counter()
+        kwargs = {"shuffle": self.shuffle, "window": self.window, "seed": self._epoch_seed(), "drop_last": self.drop_last}
+        self.epoch += 1
+
+        try:
+            if self.workers == 0:
+                for indices, tiles in iter_chunk_batches(self.index, self.index.chunks(), self.batch_size, **kwargs):
+                    yield self._batch(indices, tiles)
+            else:
+                yield from self._iter_workers(kwargs)
+        finally:
+            self.stats["seconds"] += time.perf_counter() - start_time
+
+
+    def _iter_workers(self, kwargs):
+        # Workers get interleaved chunks of the same shuffled order
+        units = self.index.chunks()
+        if self.shuffle:
+            units = [units[unit] for unit in np.random.default_rng(kwargs["seed"]).permutation(len(units))]
+
+        ctx = mp.get_context()
+        result_queue = ctx.Queue()
+        free_slots = ctx.Queue()
+        slot_bytes = self.batch_size * int(np.prod(self.index.tile_shape))
+        slots = [SharedMemory(create=True, size=slot_bytes) for _ in range(self.n_slots)]
+        for slot in range(self.n_slots):
+            free_slots.put(slot)
+
+        # The open handles of this process must not be shared with the workers
+        self.index.close()
+        processes = [
+            ctx.Process(target=_loader_worker,
+                        args=(self.index, units[worker::self.workers], dict(kwargs, seed=None if kwargs["seed"] is None else kwargs["seed"] + worker),
+                              result_queue, free_slots, [slot.name for slot in slots], self.batch_size),
+                        daemon=True)
+            for worker in range(self.workers)
+        ]
+
+        try:
+            for process in processes:
+                process.start()
+
+            n_done = 0
+            while n_done < self.workers:
+                kind, slot, indices = result_queue.get()
+                if kind == "error":
+                    raise RuntimeError(f"Tile loader worker failed:\n{indices}")
+                if kind == "done":
+                    n_done += 1
+                    continue
+
+                view = np.ndarray((self.batch_size,) + self.index.tile_shape, dtype=np.uint8, buffer=slots[slot].buf)
+                tiles = view[:len(indices)].copy()
+                free_slots.put(slot)
+                yield self._batch(indices, tiles)
+
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for slot in slots:
+                slot.close()
+                slot.unlink()
+
+
+
+def format_read_stats(stats):
+    """
+        Format a TileLoader.stats dictionary as the tiles read, tiles/s and MB/s. The time covers
+        whole epochs, including the time the consumer of the batches spends between them.
+    """
+    seconds = max(stats["seconds"], 1e-9)
+    return (f"{stats['tiles']} tiles ({stats['bytes'] / 1e6:.1f} MB) read in {stats['seconds']:.2f}s | "
+            f"{stats['tiles'] / seconds:.0f} tiles/s | {stats['bytes'] / 1e6 / seconds:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='Usage: %prog <set_file> [<set_file> ...] [options]')
+    parser.add_option('-b', '--batch_size', dest='batch_size', type='int', default=64, help='Number of tiles per batch, default=64')
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=0, help='Number of loader processes, 0 reads in this process, default=0')
+    parser.add_option('--window', dest='window', type='int', default=8, help='Number of HDF5 chunks shuffled together, default=8')
+    parser.add_option('-n', '--n_batches', dest='n_batches', type='int', default=0, help='Number of batches to read, 0 reads a whole epoch, default=0')
+    parser.add_option('--no_shuffle', dest='shuffle', action="store_false", default=True, help='Read the tiles in the order they are stored')
+    parser.add_option('--seed', dest='seed', type='int', default=None, help='Seed of the shuffle, default=None')
+
+    (opts, args) = parser.parse_args()
+
+    if len(args) == 0:
+        parser.error('Missing set file argument.')
+
+    index = TileIndex(args)
+    print(f"Indexed {len(index)} tiles of {len(index.slides)} slides in {len(index.groups)} datasets")
+
+    loader = TileLoader(index, batch_size=opts.batch_size, shuffle=opts.shuffle, window=opts.window,
+                        workers=opts.workers, seed=opts.seed)
+    for n_batches, batch in enumerate(loader, 1):
+        print(f"\rRead {n_batches} batches", end="")
+        if n_batches == opts.n_batches:
+            break
+
+    print(f"\rTile loader: {format_read_stats(loader.stats)}")
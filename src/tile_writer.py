@@ -0,0 +1,185 @@
+import time
+
+import numpy as np
+
+try:
+    # Importing hdf5plugin registers the Blosc and LZ4 filters with HDF5, for writing and reading
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+CODECS = ("none", "gzip", "lzf", "blosc", "lz4")
+
+
+def storage_options(codec="none", level=None, shuffle=False):
+    """
+        The compression keyword arguments of h5py's create_dataset for a tile codec.
+
+        Args:
+            - codec: One of none, gzip, lzf, blosc (Blosc with its LZ4 compressor) or lz4. blosc
+                     and lz4 need the hdf5plugin package.
+            - level: The compression level of gzip (0-9) or blosc (0-9), default=the codec's own
+            - shuffle: Apply the byte shuffle filter before compressing. Blosc shuffles internally.
+
+        Returns:
+            - A dictionary of keyword arguments for create_dataset
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}, expected one of {', '.join(CODECS)}.")
+
+    if codec == "none":
+        return {}
+
+    if codec in ("gzip", "lzf"):
+        options = {"compression": codec, "shuffle": shuffle}
+        if codec == "gzip" and level is not None:
+            options["compression_opts"] = level
+        return options
+
+    if hdf5plugin is None:
+        raise ImportError(f"The {codec} codec needs the hdf5plugin package, e.g. pip install hdf5plugin.")
+
+    if codec == "blosc":
+        blosc_shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+        return dict(hdf5plugin.Blosc(cname="lz4", clevel=5 if level is None else level, shuffle=blosc_shuffle))
+
+    options = dict(hdf5plugin.LZ4())
+    options["shuffle"] = shuffle
+    return options
+
+
+class TileWriter:
+    """
+        This class buffers tiles in a preallocated NumPy block and writes them to a pair of
+        resizable HDF5 datasets (images and coordinates) in large batches.
+    """
+
+    def __init__(self, img_storage, name_storage, buffer_size=256, growth=2.0):
+        """
+            Args:
+                - img_storage: A resizable (N, size, size, n_ch) HDF5 dataset
+                - name_storage: A resizable HDF5 dataset holding the position of each tile, e.g. the
+                                (N, 2) int32 coordinates, or None if the positions are already
+                                stored alongside another dataset
+                - buffer_size: The number of tiles held in memory before a flush
+                - growth: The factor the datasets are grown by when they run out of space.
+                          buffer_size=1 and growth=1 reproduces a resize for every tile.
+        """
+        if buffer_size < 1:
+            raise ValueError("buffer_size must be at least 1.")
+        if growth < 1:
+            raise ValueError("growth must be at least 1.")
+
+        self.img_storage = img_storage
+        self.name_storage = name_storage
+        self.buffer_size = buffer_size
+        self.growth = growth
+
+        self.img_buffer = np.empty((buffer_size,) + img_storage.shape[1:], dtype=img_storage.dtype)
+        self.name_buffer = None
+        if name_storage is not None:
+            self.name_buffer = np.empty((buffer_size,) + name_storage.shape[1:], dtype=name_storage.dtype)
+        self.n_buffered = 0
+        self.n_written = img_storage.shape[0]
+
+        self.tiles_written = 0
+        self.bytes_written = 0
+        self.write_time = 0.0
+
+
+    def add(self, tile, name):
+        """
+            Add a single tile to the buffer, flushing it to disk when full.
+
+            Args:
+                - tile: A (size, size, n_ch) array
+                - name: The position stored alongside the tile, e.g. its (col, row)
+        """
+        self.img_buffer[self.n_buffered] = tile
+        if self.name_buffer is not None:
+            self.name_buffer[self.n_buffered] = name
+        self.n_buffered += 1
+
+        if self.n_buffered == self.buffer_size:
+            self.flush()
+
+
+    def flush(self):
+        """
+            Write the buffered tiles to the datasets in a single slice assignment, growing the
+            datasets geometrically if they are too small.
+        """
+        if self.n_buffered == 0:
+            return
+
+        start_time = time.perf_counter()
+        start = self.n_written
+        end = start + self.n_buffered
+
+        capacity = self.img_storage.shape[0]
+        if end > capacity:
+            capacity = max(end, int(np.ceil(capacity * self.growth)))
+            self.img_storage.resize(capacity, axis=0)
+            if self.name_storage is not None:
+                self.name_storage.resize(capacity, axis=0)
+
+        self.img_storage[start:end] = self.img_buffer[:self.n_buffered]
+        if self.name_storage is not None:
+            self.name_storage[start:end] = self.name_buffer[:self.n_buffered]
+
+        self.tiles_written += self.n_buffered
+        self.bytes_written += self.img_buffer[:self.n_buffered].nbytes
+        self.write_time += time.perf_counter() - start_time
+
+        self.n_written = end
+        self.n_buffered = 0
+
+
+    def close(self):
+        """
+            Flush any remaining tiles and trim the datasets to the number of tiles written.
+        """
+        self.flush()
+
+        start_time = time.perf_counter()
+        if self.img_storage.shape[0] != self.n_written:
+            self.img_storage.resize(self.n_written, axis=0)
+            if self.name_storage is not None:
+                self.name_storage.resize(self.n_written, axis=0)
+        self.write_time += time.perf_counter() - start_time
+
+
+    def stats(self):
+        """
+            Returns:
+                - A dictionary with the tiles and bytes written and the time spent writing
+        """
+        return {
+            "tiles": self.tiles_written,
+            "bytes": self.bytes_written,
+            "seconds": self.write_time
+        }
+
+
+def merge_write_stats(*all_stats):
+    """
+        Sum a number of TileWriter.stats() dictionaries.
+    """
+    total = {"tiles": 0, "bytes": 0, "seconds": 0.0}
+    for stats in all_stats:
+        for key in total:
+            total[key] += stats[key]
+
+    return total
+
+
+def format_write_stats(stats):
+    """
+        Format a stats dictionary as tiles/s and MB/s.
+    """
+    seconds = max(stats["seconds"], 1e-9)
+    return (
+        f"{stats['tiles']} tiles ({stats['bytes'] / 1e6:.1f} MB) in {stats['seconds']:.2f}s | "
+        f"{stats['tiles'] / seconds:.0f} tiles/s | {stats['bytes'] / 1e6 / seconds:.1f} MB/s"
+    )
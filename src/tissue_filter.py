@@ -0,0 +1,294 @@
+import time
+
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.color import rgb2gray
+from skimage.feature import canny
+from skimage.morphology import disk
+
+
+# Disks at least this large are applied with a distance transform, which gives the same result
+# as the footprint but does not slow down with the radius
+EDT_RADIUS = 4
+
+_FOOTPRINTS = {}
+
+def stack_footprint(radius):
+    """
+        A disk footprint which only connects pixels within the same tile of an (N, H, W) stack.
+        Footprints are built once and cached.
+    """
+    if radius not in _FOOTPRINTS:
+        _FOOTPRINTS[radius] = disk(radius).astype(bool)[np.newaxis]
+
+    return _FOOTPRINTS[radius]
+
+
+def density_cutoff(beta=0.15):
+    """
+        The largest uint8 value whose optical density -log((v+1)/240) is at least beta.
+        A pixel passes the optical density threshold in every channel iff its largest channel
+        is at most this value, so the check needs no floating point math per pixel.
+    """
+    values = np.arange(256, dtype=np.float64)
+    passing = np.nonzero(-np.log((values+1)/240) >= beta)[0]
+
+    return int(passing.max()) if len(passing) > 0 else -1
+
+
+STAGES = ("glass", "density", "edge")
+
+
+def merge_filter_stats(*all_stats):
+    """
+        Sum a number of TissueFilter.stats dictionaries.
+    """
+    total = {stage: {"tiles": 0, "rejected": 0, "seconds": 0.0} for stage in STAGES}
+    for stats in all_stats:
+        for stage in STAGES:
+            for key in total[stage]:
+                total[stage][key] += stats[stage][key]
+
+    return total
+
+
+def format_filter_stats(stats):
+    """
+        Format a stats dictionary as the tiles rejected by and the time spent in each stage.
+    """
+    return " | ".join(
+        f"{stage}: rejected {stats[stage]['rejected']}/{stats[stage]['tiles']} in {stats[stage]['seconds']:.2f}s"
+        for stage in STAGES
+    )
+
+
+class TissueFilter:
+    """
+        This class applies the checks of Tile._keep_tile to a stack of tiles at once.
+
+        With cascade=True the checks run as stages from cheapest to most expensive and each stage
+        only sees the tiles accepted by the previous one:
+            - glass: a cheap upper bound of check 2 of Tile._keep_tile, for tiles with few pixels
+                     passing the optical density cutoff on a strided subsample
+            - density: check 2 of Tile._keep_tile
+            - edge: check 1 of Tile._keep_tile
+        Every stage gives the same decisions as _keep_tile in any order. The glass stage only
+        rejects tiles which the density stage would reject too, so it only saves time.
+    """
+
+    def __init__(self, tissue_threshold=0.8, beta=0.15, edge_radius=10, density_radius=2,
+                 cascade=True, glass_fraction=0.05, glass_stride=4):
+        """
+            Args:
+                - tissue_threshold: Tissue percentage threshold
+                - beta: The optical density threshold
+                - edge_radius: The radius of the disk used to close the Canny edges
+                - density_radius: The radius of the disk used to close the optical density mask
+                - cascade: Stop checking a tile as soon as one stage rejects it
+                - glass_fraction: Tiles with fewer subsampled pixels passing the optical density
+                                  cutoff are checked against the upper bound of the density
+                                  stage and rejected as glass if it is below tissue_threshold,
+                                  0 disables the stage
+                - glass_stride: The stride of the glass stage subsample and the size of the
+                                blocks of its upper bound
+        """
+        self.tissue_threshold = tissue_threshold
+        self.cascade = cascade
+        self.glass_fraction = glass_fraction
+        self.glass_stride = glass_stride
+        self.stats = merge_filter_stats()
+        self.cutoff = density_cutoff(beta)
+        self.edge_radius = edge_radius
+        self.density_radius = density_radius
+        self.fill_structure = ndi.generate_binary_structure(2, 1)[np.newaxis]
+
+
+    def _dilate(self, masks, radius):
+        """
+            Binary dilation of every tile in an (N, H, W) stack by disk(radius), treating pixels
+            outside the tile as background.
+        """
+        if radius < EDT_RADIUS:
+            return ndi.binary_dilation(masks, structure=stack_footprint(radius), border_value=False)
+
+        # A pixel is in the dilation iff a tissue pixel lies within the disk around it
+        out = np.zeros(masks.shape, dtype=bool)
+        for i, mask in enumerate(masks):
+            if mask.any():
+                out[i] = ndi.distance_transform_edt(~mask) <= radius
+        return out
+
+
+    def _erode(self, masks, radius):
+        """
+            Binary erosion of every tile in an (N, H, W) stack by disk(radius), treating pixels
+            outside the tile as tissue.
+        """
+        if radius < EDT_RADIUS:
+            return ndi.binary_erosion(masks, structure=stack_footprint(radius), border_value=True)
+
+        # A pixel survives the erosion iff no background pixel lies within the disk around it
+        out = np.ones(masks.shape, dtype=bool)
+        for i, mask in enumerate(masks):
+            if not mask.all():
+                out[i] = ndi.distance_transform_edt(mask) > radius
+        return out
+
+
+    def _close_dilate_fill(self, masks, radius):
+        """
+            Binary closing then dilation then hole filling of every tile in an (N, H, W) stack,
+            with the same border handling as skimage.morphology.
+        """
+        masks = self._dilate(masks, radius)
+        masks = self._erode(masks, radius)
+        masks = self._dilate(masks, radius)
+        return ndi.binary_fill_holes(masks, structure=self.fill_structure)
+
+
+    def edge_percentage(self, tiles):
+        """
+            Check 1 of Tile._keep_tile for an (N, H, W, 3) uint8 stack.
+        """
+        gray = 1 - rgb2gray(tiles)
+        edges = np.empty(gray.shape, dtype=bool)
+        for i in range(len(gray)):
+            edges[i] = canny(gray[i])
+
+        edges = self._close_dilate_fill(edges, self.edge_radius)
+        return edges.mean(axis=(1, 2))
+
+
+    def density_percentage(self, tiles):
+        """
+            Check 2 of Tile._keep_tile for an (N, H, W, 3) uint8 stack.
+        """
+        density = np.max(tiles, axis=3) <= self.cutoff
+        density = self._close_dilate_fill(density, self.density_radius)
+        return density.mean(axis=(1, 2))
+
+
+    def filter(self, tiles):
+        """
+            Args:
+                - tiles: An (N, H, W, 3) uint8 stack of tiles
+
+            Returns:
+                - keep: A Boolean array indicating which tiles pass both checks
+                - edge_percentage: The tissue percentage found by the Canny check
+                - density_percentage: The tissue percentage found by the optical density check
+        """
+        tiles = np.asarray(tiles)
+        if len(tiles) == 0:
+            empty = np.zeros(0)
+            return empty.astype(bool), empty, empty
+
+        if not self.cascade:
+            edge_percentage = self.edge_percentage(tiles)
+            density_percentage = self.density_percentage(tiles)
+            keep = (edge_percentage >= self.tissue_threshold) & (density_percentage >= self.tissue_threshold)
+
+            return keep, edge_percentage, density_percentage
+
+        # Percentages of stages a tile never reached are left as NaN
+        edge_percentage = np.full(len(tiles), np.nan)
+        density_percentage = np.full(len(tiles), np.nan)
+        remaining = np.arange(len(tiles))
+
+        if self.glass_fraction > 0:
+            def glass_stage(index):
+                passed = self.glass_percentage(tiles[index]) >= self.glass_fraction
+                sparse = np.flatnonzero(~passed)
+                if len(sparse) > 0:
+                    passed[sparse] = self.density_bound(tiles[index[sparse]]) >= self.tissue_threshold
+                return passed
+
+            remaining = self._run_stage("glass", remaining, glass_stage)
+
+        def density_stage(index):
+            density_percentage[index] = self.density_percentage(tiles[index])
+            return density_percentage[index] >= self.tissue_threshold
+
+        def edge_stage(index):
+            edge_percentage[index] = self.edge_percentage(tiles[index])
+            return edge_percentage[index] >= self.tissue_threshold
+
+        remaining = self._run_stage("density", remaining, density_stage)
+        remaining = self._run_stage("edge", remaining, edge_stage)
+
+        keep = np.zeros(len(tiles), dtype=bool)
+        keep[remaining] = True
+
+        return keep, edge_percentage, density_percentage
+
+
+    def glass_percentage(self, tiles):
+        """
+            The fraction of pixels passing the optical density cutoff on a strided subsample of
+            an (N, H, W, 3) uint8 stack.
+        """
+        subsample = tiles[:, ::self.glass_stride, ::self.glass_stride]
+        return (np.max(subsample, axis=3) <= self.cutoff).mean(axis=(1, 2))
+
+
+    def density_bound(self, tiles):
+        """
+            An upper bound of density_percentage for an (N, H, W, 3) uint8 stack, computed on
+            blocks of glass_stride pixels.
+
+            The closing and dilation of the density mask only add pixels within 2*density_radius
+            of a passing pixel, and hole filling can only add the holes of the result. A block
+            is marked if any of its pixels passes the cutoff, the marks are dilated by enough
+            blocks to cover 2*density_radius pixels and their holes are filled. Every pixel the
+            density check could count lies in a marked block, so the fraction of the tile they
+            cover is never below density_percentage.
+        """
+        n, height, width = tiles.shape[:3]
+        block = self.glass_stride
+        rows, cols = -(-height // block), -(-width // block)
+
+        density = np.zeros((n, rows * block, cols * block), dtype=bool)
+        density[:, :height, :width] = np.max(tiles, axis=3) <= self.cutoff
+        blocks = density.reshape(n, rows, block, cols, block).any(axis=(2, 4))
+
+        reach = -(-2 * self.density_radius // block)
+        blocks = ndi.binary_dilation(blocks, structure=np.ones((1, 2 * reach + 1, 2 * reach + 1), dtype=bool))
+        blocks = ndi.binary_fill_holes(blocks, structure=self.fill_structure)
+
+        # The number of tile pixels in each block, as the last row and column may be partial
+        block_rows = np.minimum(block, height - np.arange(rows) * block)
+        block_cols = np.minimum(block, width - np.arange(cols) * block)
+        area = block_rows[:, None] * block_cols[None, :]
+
+        return (blocks * area).sum(axis=(1, 2)) / (height * width)
+
+
+    def _run_stage(self, stage, index, check):
+        """
+            Run a check on the tiles at index, recording how many tiles it rejected and how long
+            it took.
+
+            Returns:
+                - The index of the tiles which passed the check
+        """
+        if len(index) == 0:
+            return index
+
+        start = time.perf_counter()
+        passed = index[check(index)]
+
+        self.stats[stage]["tiles"] += len(index)
+        self.stats[stage]["rejected"] += len(index) - len(passed)
+        self.stats[stage]["seconds"] += time.perf_counter() - start
+
+        return passed
+
+
+    def reset_stats(self):
+        """
+            Returns:
+                - The stage statistics collected so far, which are then reset
+        """
+        stats = self.stats
+        self.stats = merge_filter_stats()
+        return stats
@@ -0,0 +1,86 @@
+import numpy as np
+
+from scipy.ndimage.morphology import binary_fill_holes
+from skimage.color import rgb2gray
+from skimage.feature import canny
+from skimage.morphology import binary_closing, binary_dilation, disk
+
+
+class TissueMask:
+    """
+        This class builds a low resolution tissue mask of a slide from its thumbnail so that tiles
+        which only cover glass can be skipped before they are read.
+    """
+
+    def __init__(self, slide, downsample=64, margin=1):
+        """
+            Args:
+                - slide: An OpenSlide object
+                - downsample: The number of level 0 pixels covered by each mask pixel
+                - margin: The number of mask pixels the tissue is grown by to stay conservative
+        """
+        width, height = slide.dimensions
+        thumbnail = slide.get_thumbnail((max(1, width // downsample), max(1, height // downsample)))
+        thumbnail = np.array(thumbnail.convert("RGB"))
+
+        self.mask = self._build_mask(thumbnail, margin)
+        self.scale_x = self.mask.shape[1] / width
+        self.scale_y = self.mask.shape[0] / height
+
+
+    def _build_mask(self, thumbnail, margin):
+        """
+            Apply the checks of Tile._keep_tile pixelwise to the thumbnail. A pixel is tissue if
+            either check finds tissue there, so a tile is only skipped when both checks would fail.
+        """
+        edges = 1 - rgb2gray(thumbnail)
+        edges = canny(edges)
+        edges = binary_closing(edges, disk(2))
+        edges = binary_dilation(edges, disk(2))
+        edges = binary_fill_holes(edges)
+
+        density = thumbnail.astype(np.float64)
+        density = -np.log((density+1)/240) #convert to optical density
+        beta = 0.15
+        density = np.min(density, axis=2) >= beta
+        density = binary_closing(density, disk(1))
+        density = binary_fill_holes(density)
+
+        mask = edges | density
+        if margin > 0:
+            mask = binary_dilation(mask, disk(margin))
+
+        return mask
+
+
+    def overlaps_tissue(self, x, y, width, height):
+        """
+            Check if a level 0 region overlaps the tissue mask.
+
+            Args:
+                - x, y: The top left corner of the region in level 0 pixels
+                - width, height: The size of the region in level 0 pixels
+
+            Returns:
+                - A Boolean indicating whether any mask pixel in the region is tissue
+        """
+        x0 = int(np.floor(x * self.scale_x))
+        y0 = int(np.floor(y * self.scale_y))
+        x1 = max(x0 + 1, int(np.ceil((x + width) * self.scale_x)))
+        y1 = max(y0 + 1, int(np.ceil((y + height) * self.scale_y)))
+
+        return bool(self.mask[y0:y1, x0:x1].any())
+
+
+    def save(self, h5_group, name="tissue_mask"):
+        """
+            Store the mask and its scale in the given HDF5 group.
+        """
+        if name in h5_group:
+            del h5_group[name]
+
+        mask_storage = h5_group.create_dataset(name, data=self.mask.astype(np.uint8), compression="gzip")
+        mask_storage.attrs["scale_x"] = self.scale_x
+        mask_storage.attrs["scale_y"] = self.scale_y
+
+        return mask_storage